@@ -1,5 +1,9 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, stream_with_context
+import gzip
+import json
 import os
+import threading
+import time
 import uuid
 import logging
 import sys
@@ -9,6 +13,8 @@ from datetime import datetime, timezone
 import data_manager
 import scheduler_tasks
 import monitor_engine
+import host_policies
+import rollups
 
 # Telegram sender поки не обов'язковий
 try:
@@ -17,6 +23,12 @@ except ImportError:
     def send_telegram_message(message):
         logging.warning("Telegram sender not available")
 
+# Brotli не обов'язковий - без нього відповіді стискаються лише gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 # Налаштування логування
 logging.basicConfig(
     level=logging.INFO, 
@@ -32,6 +44,18 @@ logging.info("Starting Web Monitor application")
 
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
+# Максимальний розмір сторінки /api/checks/<id>/history
+HISTORY_PAGE_MAX_LIMIT = 200
+# Максимальна кількість рядків в одному запиті /api/checks/bulk
+BULK_MAX_ROWS = int(os.getenv('MONITOR_BULK_MAX_ROWS', 5000))
+# Мінімальний розмір JSON-відповіді (байти), з якого вона стискається (gzip / brotli)
+COMPRESS_MIN_BYTES = int(os.getenv('MONITOR_COMPRESS_MIN_BYTES', 1024))
+# Скільки секунд /api/system-status віддається з кешу, поки перевірки не змінювались (0 - не кешувати)
+SYSTEM_STATUS_CACHE_SECONDS = float(os.getenv('MONITOR_SYSTEM_STATUS_CACHE_SECONDS', 5))
+
+_json_cache = {}  # ключ ендпоінта -> (etag, тіло, {кодування: стиснуте тіло})
+_json_cache_lock = threading.Lock()
+
 def format_datetime_filter(value, format='%d %B %Y %H:%M:%S'):
     """Форматирует строку ISO datetime в читаемый вид в локальном времени системы."""
     if value is None or value == "":
@@ -65,6 +89,64 @@ def format_datetime_filter(value, format='%d %B %Y %H:%M:%S'):
 
 app.jinja_env.filters['format_datetime'] = format_datetime_filter
 
+def _accepted_encoding():
+    """Кодування стиснення, яке приймає клієнт (brotli, якщо встановлений, інакше gzip), або None."""
+    if brotli is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+def cached_json_response(cache_key, version, build):
+    """
+    JSON-відповідь з ETag від version: клієнт, що вже має цю версію (If-None-Match), отримує 304 без тіла.
+    Тіло (та його стиснені варіанти) будується build() лише раз на версію і спільне для всіх клієнтів.
+    version треба брати до build(), щоб зміна під час побудови дала нову версію.
+    """
+    etag = f"{cache_key}-{version}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        with _json_cache_lock:
+            cached = _json_cache.get(cache_key)
+        if cached is None or cached[0] != etag:
+            cached = (etag, app.json.dumps(build()).encode('utf-8'), {})
+            with _json_cache_lock:
+                _json_cache[cache_key] = cached
+        body = cached[1]
+        encoding = _accepted_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+        if encoding:
+            if encoding not in cached[2]:
+                cached[2][encoding] = _compress(body, encoding)
+            response = Response(cached[2][encoding], mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+        else:
+            response = Response(body, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    # Браузер щоразу перепитує сервер з If-None-Match і отримує 304, поки дані не змінились
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_json_response(response):
+    """Стискає великі JSON-відповіді інших ендпоінтів, якщо клієнт це підтримує."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    encoding = _accepted_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding:
+        response.set_data(_compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    return response
+
 # Конфигурация логирования (будет добавлена позже)
 
 # --- HTML Страницы ---
@@ -92,15 +174,11 @@ def monitor_details_page(check_id):
             return render_template('error.html', 
                                  error_message=f"Check with ID {check_id} not found"), 404
         
-        # Получаем историю проверок
-        check_history = data_manager.load_check_history(check_id)
+        # Історію сторінка завантажує посторінково з /api/checks/<id>/history
+        latest_history = data_manager.get_latest_history_entry(check_id)
         
         # ВИПРАВЛЕНО: Перевіряємо синхронізацію даних з історією
-        if check_history:
-            # Сортуємо історію за часом (нові спочатку)
-            check_history.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-            latest_history = check_history[0]
-            
+        if latest_history:
             # Перевіряємо, чи основні дані застарілі
             check_time = check_details.get('last_checked_at')
             history_time = latest_history.get('timestamp')
@@ -113,8 +191,10 @@ def monitor_details_page(check_id):
         
         return render_template('monitor_details.html', 
                              check=check_details, 
-                             history=check_history,
-                             check_id=check_id)
+                             check_id=check_id,
+                             latest_history=latest_history,
+                             history_page_size=data_manager.MAX_HISTORY_ENTRIES,
+                             check_rollups=rollups.get_check_rollups(check_id))
     except Exception as e:
         app.logger.error(f"Error loading check details for {check_id}: {e}", exc_info=True)
         return render_template('error.html', 
@@ -137,6 +217,73 @@ def edit_check_page(check_id):
 
 # --- API Эндпоинты ---
 
+def validate_new_check(data):
+    """
+    Перевіряє дані нової перевірки (POST /api/checks, рядок /api/checks/bulk).
+    Повертає (дані для data_manager.add_check, None) або (None, текст помилки).
+    """
+    if not isinstance(data, dict):
+        return None, "Check must be a JSON object"
+
+    # Валидация обязательных полей
+    required_fields = ['url', 'interval']
+    missing_fields = [field for field in required_fields if field not in data]
+    if missing_fields:
+        return None, f"Missing required fields: {', '.join(missing_fields)}"
+
+    # Дополнительная валидация типов данных
+    if not isinstance(data['url'], str) or not data['url'].startswith(('http://', 'https://')):
+        return None, "Invalid URL format"
+    if not isinstance(data['interval'], int) or data['interval'] < 1:
+        return None, "Interval must be a positive integer (minutes)"
+    
+    # Опциональные поля и их валидация
+    name = data.get('name')
+    if name is not None and not isinstance(name, str):
+        return None, "Name must be a string"
+        
+    selector = data.get('selector')
+    if selector is not None and not isinstance(selector, str):
+        return None, "Selector must be a string"
+
+    change_threshold = data.get('change_threshold')
+    if change_threshold is not None:
+        if not isinstance(change_threshold, (int, float)) or not (0 <= change_threshold <= 100):
+            return None, "Change threshold must be a number between 0 and 100"
+
+    parser = data.get('parser')
+    if parser is not None and parser not in monitor_engine.PARSER_BACKENDS:
+        return None, f"Parser must be one of: {', '.join(monitor_engine.PARSER_BACKENDS)}"
+
+    host_policy = data.get('host_policy')
+    host_policy_error = host_policies.validate_host_policy(host_policy)
+    if host_policy_error:
+        return None, host_policy_error
+
+    history_retention = data.get('history_retention')
+    retention_error = data_manager.validate_history_retention(history_retention)
+    if retention_error:
+        return None, retention_error
+
+    # Ліміти потокового завантаження (необов'язкові)
+    for field in ('max_body_bytes', 'target_within_kb'):
+        value = data.get(field)
+        if value is not None and (not isinstance(value, int) or value < 1):
+            return None, f"{field} must be a positive integer"
+    
+    return {
+        "name": name,
+        "url": data["url"],
+        "selector": selector,
+        "change_threshold": change_threshold,
+        "interval": data["interval"],
+        "parser": parser,
+        "max_body_bytes": data.get('max_body_bytes'),
+        "target_within_kb": data.get('target_within_kb'),
+        "host_policy": host_policy,
+        "history_retention": history_retention
+    }, None
+
 @app.route('/api/checks', methods=['POST'])
 def api_add_check():
     """
@@ -146,58 +293,17 @@ def api_add_check():
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 400
 
-    data = request.get_json()
-
-    # Валидация обязательных полей
-    required_fields = ['url', 'interval']
-    missing_fields = [field for field in required_fields if field not in data]
-    if missing_fields:
-        return jsonify({"error": f"Missing required fields: {', '.join(missing_fields)}"}), 400
-
     try:
-        # Дополнительная валидация типов данных
-        if not isinstance(data['url'], str) or not data['url'].startswith(('http://', 'https://')):
-            return jsonify({"error": "Invalid URL format"}), 400
-        if not isinstance(data['interval'], int) or data['interval'] < 1:
-            return jsonify({"error": "Interval must be a positive integer (minutes)"}), 400
-        
-        # Опциональные поля и их валидация
-        name = data.get('name')
-        if name is not None and not isinstance(name, str):
-            return jsonify({"error": "Name must be a string"}), 400
-            
-        selector = data.get('selector')
-        if selector is not None and not isinstance(selector, str):
-            return jsonify({"error": "Selector must be a string"}), 400
-
-        change_threshold = data.get('change_threshold')
-        if change_threshold is not None:
-            if not isinstance(change_threshold, (int, float)) or not (0 <= change_threshold <= 100):
-                return jsonify({"error": "Change threshold must be a number between 0 and 100"}), 400
-        
-        new_check_data = {
-            "name": name,
-            "url": data["url"],
-            "selector": selector,
-            "change_threshold": change_threshold,
-            "interval": data["interval"]
-        }
+        new_check_data, error = validate_new_check(request.get_json())
+        if error:
+            return jsonify({"error": error}), 400
         
         created_check = data_manager.add_check(new_check_data)
         
         # ВИПРАВЛЕНО: Додаємо нову перевірку до планувальника
         if created_check.get("status") == "active":
             try:
-                # ВИПРАВЛЕНО: Додаємо check_id як аргумент функції
-                scheduler_tasks.scheduler.add_job(
-                    func=scheduler_tasks.scheduled_check_task,
-                    trigger='interval',
-                    minutes=created_check['interval'],
-                    args=[created_check['id']],  # Передаємо check_id як аргумент
-                    id=created_check['id'],
-                    name=f"Check: {created_check.get('name', created_check['id'])}",
-                    replace_existing=True
-                )
+                scheduler_tasks.update_job(created_check['id'], created_check['interval'])
                 logging.info(f"Додано завдання до планувальника для перевірки: {created_check['id']}")
             except Exception as e:
                 logging.error(f"Помилка додавання завдання до планувальника: {e}")
@@ -207,28 +313,82 @@ def api_add_check():
         app.logger.error(f"Error adding check: {e}", exc_info=True)
         return jsonify({"error": "An unexpected error occurred while adding the check."}), 500
 
+@app.route('/api/checks/bulk', methods=['POST'])
+def api_bulk_add_checks():
+    """
+    API эндпоінт для масового створення перевірок.
+    Тіло - NDJSON (один JSON-об'єкт перевірки на рядок), читається потоково.
+    Коректні рядки зберігаються одним записом і додаються до планувальника одним пакетом;
+    відповідь містить результат для кожного рядка.
+    """
+    results = []
+    valid_rows = []  # (індекс у results, дані перевірки)
+    try:
+        for line_number, raw_line in enumerate(request.stream, start=1):
+            line = raw_line.strip()
+            if not line:
+                continue
+            if len(results) >= BULK_MAX_ROWS:
+                return jsonify({"error": f"Too many rows, the limit is {BULK_MAX_ROWS}"}), 413
+            try:
+                new_check_data, error = validate_new_check(json.loads(line))
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                new_check_data, error = None, f"Invalid JSON: {e}"
+            if error:
+                results.append({"line": line_number, "status": "error", "error": error})
+            else:
+                results.append({"line": line_number, "status": "pending"})
+                valid_rows.append((len(results) - 1, new_check_data))
+
+        created_checks = data_manager.add_checks([check_data for _, check_data in valid_rows])
+        for (result_index, _), created_check in zip(valid_rows, created_checks):
+            results[result_index].update({"status": "created", "id": created_check['id']})
+
+        scheduled = scheduler_tasks.add_jobs([c for c in created_checks if c.get("status") == "active"])
+        logging.info(f"Bulk import: {len(created_checks)} checks created, {len(results) - len(created_checks)} rows rejected, {scheduled} jobs scheduled")
+
+        return jsonify({
+            "created": len(created_checks),
+            "failed": len(results) - len(created_checks),
+            "results": results
+        }), 200
+    except Exception as e:
+        app.logger.error(f"Error in bulk check import: {e}", exc_info=True)
+        return jsonify({"error": "An unexpected error occurred while importing checks."}), 500
+
+@app.route('/api/checks/export', methods=['GET'])
+def api_export_checks():
+    """
+    API эндпоінт для експорту перевірок у NDJSON (сумісний з /api/checks/bulk).
+    Кожен рядок - конфігурація, стан виконання та поточний контент перевірки; відповідь формується потоково.
+    """
+    def generate():
+        for check in data_manager.iter_checks():
+            latest_entry = data_manager.get_latest_history_entry(check['id'])
+            if latest_entry:
+                check['current_content'] = latest_entry.get('extracted_value')
+                check['current_timestamp'] = latest_entry.get('timestamp')
+            yield json.dumps(check, ensure_ascii=False, default=str) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={"Content-Disposition": "attachment; filename=checks.ndjson"})
 
 @app.route('/api/checks', methods=['GET'])
 def api_get_checks():
-    """API эндпоінт для получения списка всех проверок."""
-    checks = data_manager.load_checks()
-    
-    # ДОДАНО: Додаємо поточний контент до кожної перевірки
-    for check in checks:
-        check_id = check.get('id')
-        if check_id:
-            # Завантажуємо останній запис з історії
-            history = data_manager.load_check_history(check_id)
-            if history:
-                # Сортуємо за часом (найновіші спочатку)
-                history.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-                latest_entry = history[0]
-                
-                # Додаємо поточний контент
+    """API эндпоінт для получения списка всех проверок (304, поки сховище перевірок не змінилось)."""
+    def build():
+        checks = data_manager.load_checks()
+
+        # ДОДАНО: Додаємо поточний контент до кожної перевірки (з індексу останніх записів, без читання історії)
+        latest_entries = data_manager.get_latest_history_entries()
+        for check in checks:
+            latest_entry = latest_entries.get(check.get('id'))
+            if latest_entry:
                 check['current_content'] = latest_entry.get('extracted_value')
                 check['current_timestamp'] = latest_entry.get('timestamp')
-    
-    return jsonify(checks), 200
+        return checks
+
+    return cached_json_response('checks', data_manager.get_store_version(), build)
 
 @app.route('/api/checks/<check_id>', methods=['GET'])
 def api_get_check_details(check_id):
@@ -239,40 +399,98 @@ def api_get_check_details(check_id):
     else:
         return jsonify({"error": "Check not found"}), 404
 
+@app.route('/api/checks/<check_id>/history', methods=['GET'])
+def api_get_check_history(check_id):
+    """
+    API эндпоінт для історії перевірки посторінково (від найновіших записів).
+    Параметри: limit (1-200), cursor (next_cursor попередньої сторінки), since / until (ISO-час),
+    status (через кому, напр. 'changed,error').
+    """
+    if not data_manager.get_check_by_id(check_id):
+        return jsonify({"error": "Check not found"}), 404
+
+    limit = request.args.get('limit', default=data_manager.MAX_HISTORY_ENTRIES, type=int)
+    if limit is None or not (1 <= limit <= HISTORY_PAGE_MAX_LIMIT):
+        return jsonify({"error": f"limit must be an integer between 1 and {HISTORY_PAGE_MAX_LIMIT}"}), 400
+    cursor = request.args.get('cursor')
+    if cursor is not None and not cursor.isdigit():
+        return jsonify({"error": "Invalid cursor"}), 400
+    status_param = request.args.get('status')
+    statuses = [status.strip() for status in status_param.split(',') if status.strip()] if status_param else None
+
+    try:
+        entries, next_cursor = data_manager.query_check_history(
+            check_id, limit=limit, cursor=cursor,
+            since=request.args.get('since'), until=request.args.get('until'), statuses=statuses
+        )
+    except ValueError as e:
+        return jsonify({"error": f"since / until must be ISO datetimes: {e}"}), 400
+    return jsonify({"entries": entries, "next_cursor": next_cursor}), 200
+
+@app.route('/api/checks/<check_id>/rollups', methods=['GET'])
+def api_get_check_rollups(check_id):
+    """API эндпоінт для агрегатів перевірки: uptime, частота змін, перцентилі часу завантаження (1h / 24h / 30d)."""
+    if not data_manager.get_check_by_id(check_id):
+        return jsonify({"error": "Check not found"}), 404
+    return jsonify(rollups.get_check_rollups(check_id)), 200
+
 @app.route('/api/system-status', methods=['GET'])
 def api_get_system_status():
-    """API эндпоінт для получения состояния системы."""
+    """
+    API эндпоінт для получения состояния системы.
+    Метрики кешуються на SYSTEM_STATUS_CACHE_SECONDS (або до зміни перевірок).
+    """
+    if SYSTEM_STATUS_CACHE_SECONDS > 0:
+        time_window = int(time.time() // SYSTEM_STATUS_CACHE_SECONDS)
+    else:
+        time_window = uuid.uuid4().hex
     try:
-        active_jobs = scheduler_tasks.scheduler.get_jobs()
-        
-        # ДОДАНО: Перевіряємо прострочені завдання
-        current_time = datetime.now(timezone.utc)
-        overdue_jobs = []
-        
-        for job in active_jobs:
-            if job.next_run_time and job.next_run_time < current_time:
-                overdue_jobs.append({
-                    "id": job.id,
-                    "name": job.name,
-                    "overdue_by_seconds": (current_time - job.next_run_time).total_seconds()
-                })
-        
-        status_info = {
-            "scheduler_status": "Running" if scheduler_tasks.scheduler.running else "Stopped",
-            "active_scheduled_jobs": len(active_jobs),
-            "overdue_jobs_count": len(overdue_jobs),
-            "overdue_jobs": overdue_jobs,
-            "current_time_utc": current_time.isoformat(),
-            "current_time_local": current_time.astimezone().isoformat(),
-            "job_ids": [job.id for job in active_jobs],
-            "last_global_error": None,
-            "app_version": "0.1.2"
-        }
-        return jsonify(status_info), 200
+        return cached_json_response('system-status', f"{data_manager.get_store_version()}-{time_window}",
+                                    build_system_status)
     except Exception as e:
         app.logger.error(f"Error getting system status: {e}", exc_info=True)
         return jsonify({"error": "Failed to get system status"}), 500
 
+def build_system_status():
+    """Стан планувальника, диспетчера, пулів та сховища для /api/system-status."""
+    active_jobs = scheduler_tasks.scheduler.get_jobs()
+    
+    # ДОДАНО: Перевіряємо прострочені завдання
+    current_time = datetime.now(timezone.utc)
+    overdue_jobs = []
+    
+    for job in active_jobs:
+        if job.next_run_time and job.next_run_time < current_time:
+            overdue_jobs.append({
+                "id": job.id,
+                "name": job.name,
+                "overdue_by_seconds": (current_time - job.next_run_time).total_seconds()
+            })
+    
+    status_info = {
+        "scheduler_status": "Running" if scheduler_tasks.scheduler.running else "Stopped",
+        "active_scheduled_jobs": len(active_jobs),
+        "overdue_jobs_count": len(overdue_jobs),
+        "overdue_jobs": overdue_jobs,
+        "current_time_utc": current_time.isoformat(),
+        "current_time_local": current_time.astimezone().isoformat(),
+        "job_ids": [job.id for job in active_jobs],
+        "dispatcher": scheduler_tasks.scheduler.get_metrics(),
+        "warm_start": scheduler_tasks.get_warm_start_status(),
+        "session_pool": monitor_engine.get_session_pool_stats(),
+        "host_limiter": host_policies.get_limiter_stats(),
+        "history_writer": data_manager.get_history_writer_stats(),
+        "history_blobs": data_manager.get_history_blob_stats(),
+        "circuit_breakers": host_policies.get_circuit_stats(),
+        "parser_backends": {
+            "default": monitor_engine.DEFAULT_PARSER_BACKEND,
+            "available": monitor_engine.get_available_parser_backends()
+        },
+        "last_global_error": None,
+        "app_version": "0.1.2"
+    }
+    return status_info
+
 @app.route('/api/checks/<check_id>', methods=['PUT'])
 def api_update_check(check_id):
     """API эндпоінт для обновления существующей проверки."""
@@ -280,24 +498,41 @@ def api_update_check(check_id):
         return jsonify({"error": "Request must be JSON"}), 400
     
     data = request.get_json()
-    existing_check = data_manager.get_check_by_id(check_id)
-    if not existing_check:
+    if not data_manager.get_check_by_id(check_id):
         return jsonify({"error": "Check not found"}), 404
 
-    # Обновляем только те поля, которые переданы
+    # Спершу валідація, потім зміна перевірки однією транзакцією (паралельні записи не губляться)
     for key, value in data.items():
-        if key in existing_check and key != "id" and key != "created_at": # Не даем менять id и created_at
-            # TODO: Добавить валидацию для каждого обновляемого поля
-            if key == "interval" and (not isinstance(value, int) or value < 1):
-                 return jsonify({"error": "Interval must be a positive integer (minutes)"}), 400
-            existing_check[key] = value
-    
-    all_checks = data_manager.load_checks()
-    for i, chk in enumerate(all_checks):
-        if chk.get("id") == check_id:
-            all_checks[i] = existing_check
-            break
-    data_manager.save_checks(all_checks)
+        # TODO: Добавить валидацию для каждого обновляемого поля
+        if key == "interval" and (not isinstance(value, int) or value < 1):
+             return jsonify({"error": "Interval must be a positive integer (minutes)"}), 400
+        if key == "parser" and value is not None and value not in monitor_engine.PARSER_BACKENDS:
+             return jsonify({"error": f"Parser must be one of: {', '.join(monitor_engine.PARSER_BACKENDS)}"}), 400
+        if key in ("max_body_bytes", "target_within_kb") and value is not None and (not isinstance(value, int) or value < 1):
+             return jsonify({"error": f"{key} must be a positive integer"}), 400
+        if key == "host_policy" and host_policies.validate_host_policy(value):
+             return jsonify({"error": host_policies.validate_host_policy(value)}), 400
+        if key == "history_retention" and data_manager.validate_history_retention(value):
+             return jsonify({"error": data_manager.validate_history_retention(value)}), 400
+
+    with data_manager.check_transaction(check_id) as existing_check:
+        if not existing_check:
+            return jsonify({"error": "Check not found"}), 404
+
+        # Валідатори HTTP-кешу та хеш тіла відносяться до старої сторінки, селектора, бекенду розбору
+        # та меж читання тіла - скидаємо їх при зміні, інакше пропуск незмінного тіла не дасть нового результату
+        if any(key in data and data[key] != existing_check.get(key)
+               for key in ("url", "selector", "parser", "target_within_kb", "max_body_bytes")):
+            existing_check.update({'http_etag': None, 'http_last_modified': None, 'last_body_hash': None})
+
+        # Обновляем только те поля, которые переданы
+        for key, value in data.items():
+            # Поля 'parser', лімітів завантаження, політик хоста та зберігання історії дозволені і для перевірок, створених до їх появи
+            # Стан виконання (last_result, next_check_at...) змінює лише планувальник
+            if key in data_manager.RUNTIME_FIELDS:
+                continue
+            if (key in existing_check or key in ("parser", "max_body_bytes", "target_within_kb", "host_policy", "history_retention")) and key != "id" and key != "created_at": # Не даем менять id и created_at
+                existing_check[key] = value
     
     # Перепланируем или удаляем задачу в зависимости от статуса
     if existing_check.get("status") == "active":
@@ -320,13 +555,12 @@ def api_delete_check(check_id):
         # 1. Видаляємо завдання з планувальника
         scheduler_tasks.remove_job(check_id)
         
-        # 2. Видаляємо запис з checks.json
-        all_checks = data_manager.load_checks()
-        all_checks = [chk for chk in all_checks if chk.get("id") != check_id]
-        data_manager.save_checks(all_checks)
+        # 2. Видаляємо запис зі сховища перевірок
+        data_manager.delete_check(check_id)
         
         # 3. ВИПРАВЛЕНО: Видаляємо файл історії
         data_manager.delete_check_history(check_id)
+        rollups.delete_check_rollups(check_id)
         
         # 4. Логуємо успішне видалення
         logging.info(f"Check '{check_name}' (ID: {check_id}) completely deleted with all associated data")
@@ -393,80 +627,54 @@ def api_manual_check(check_id):
         
         logging.info(f"Manual check triggered for {check_id} by user")
         
-        # Виконуємо перевірку
-        status, new_hash, extracted_text, error_msg = monitor_engine.perform_check(
-            check_id=check_details['id'],
-            name=check_details.get('name', 'Manual Check'),
-            url=check_details['url'],
-            selector=check_details['selector'],
-            last_hash=check_details.get('last_content_hash')
-        )
+        # Виконуємо перевірку з валідаторами HTTP-кешу; історія, агрегати та стан виконання
+        # (хеш разом з ETag / Last-Modified / хешем тіла) зберігаються так само, як для запланованої перевірки
+        fetch_state = monitor_engine.get_fetch_state(check_details)
+        result = monitor_engine.perform_check_for_config(check_details, fetch_state)
+        history_entry = scheduler_tasks.save_check_result(check_id, result, fetch_state)
+        status, new_hash, extracted_text, error_msg = result
+        extracted_text = history_entry.get('extracted_value')
+        current_time_iso = history_entry.get('timestamp')
         
-        # Оновлюємо дані перевірки
-        current_time_utc = datetime.now(timezone.utc)
-        current_time_iso = current_time_utc.isoformat()
+        state_changes = {}
         
-        # Зберігаємо в історію
-        history_entry = {
-            "timestamp": current_time_iso,
-            "status": status,
-            "extracted_value": extracted_text,
-            "content_hash": new_hash,
-            "error_message": error_msg
-        }
-        data_manager.save_check_history_entry(check_id, history_entry)
-        
-        # Оновлюємо основні дані
-        all_checks = data_manager.load_checks()
-        for check in all_checks:
-            if check['id'] == check_id:
-                check['last_checked_at'] = current_time_iso
-                check['last_result'] = status
-                if status in ["changed", "no_change"]:
-                    check['last_content_hash'] = new_hash
-                if status != "error":
-                    check['last_error_message'] = None
+        # ВИПРАВЛЕНО: ОБОВ'ЯЗКОВО оновлюємо наступний час перевірки
+        if check_details.get('status') == 'active':
+            try:
+                job = scheduler_tasks.scheduler.get_job(check_id)
+                if job and job.next_run_time:
+                    next_run_local = job.next_run_time.astimezone()
+                    old_time = check_details.get('next_check_at')
+                    new_time = next_run_local.isoformat()
+                    state_changes['next_check_at'] = new_time
+                    logging.info(f"🔄 Manual check - updated next_check_at: {old_time} -> {new_time}")
                 else:
-                    check['last_error_message'] = error_msg
-                
-                # ВИПРАВЛЕНО: ОБОВ'ЯЗКОВО оновлюємо наступний час перевірки
-                if check.get('status') == 'active':
-                    try:
+                    # ДОДАНО: Якщо завдання не знайдено, створюємо його
+                    logging.warning(f"No job found for active check {check_id} during manual check. Creating job...")
+                    interval_minutes = check_details.get('interval', 5)
+                    if scheduler_tasks.update_job(check_id, interval_minutes):
+                        # Спробуємо отримати час ще раз
+                        import time
+                        time.sleep(0.1)
                         job = scheduler_tasks.scheduler.get_job(check_id)
                         if job and job.next_run_time:
                             next_run_local = job.next_run_time.astimezone()
-                            old_time = check.get('next_check_at')
-                            new_time = next_run_local.isoformat()
-                            check['next_check_at'] = new_time
-                            logging.info(f"🔄 Manual check - updated next_check_at: {old_time} -> {new_time}")
+                            state_changes['next_check_at'] = next_run_local.isoformat()
+                            logging.info(f"✅ Created missing job and set next_check_at: {state_changes['next_check_at']}")
                         else:
-                            # ДОДАНО: Якщо завдання не знайдено, створюємо його
-                            logging.warning(f"No job found for active check {check_id} during manual check. Creating job...")
-                            interval_minutes = check.get('interval', 5)
-                            if scheduler_tasks.update_job(check_id, interval_minutes):
-                                # Спробуємо отримати час ще раз
-                                import time
-                                time.sleep(0.1)
-                                job = scheduler_tasks.scheduler.get_job(check_id)
-                                if job and job.next_run_time:
-                                    next_run_local = job.next_run_time.astimezone()
-                                    check['next_check_at'] = next_run_local.isoformat()
-                                    logging.info(f"✅ Created missing job and set next_check_at: {check['next_check_at']}")
-                                else:
-                                    logging.error(f"❌ Failed to get next_check_at even after creating job for {check_id}")
-                                    check['next_check_at'] = None
-                            else:
-                                logging.error(f"❌ Failed to create missing job for {check_id}")
-                                check['next_check_at'] = None
-                    except Exception as e:
-                        logging.warning(f"Could not get next_run_time for job {check_id}: {e}")
-                        check['next_check_at'] = None
-                else:
-                    # Для неактивних перевірок очищуємо час
-                    check['next_check_at'] = None
-                break
+                            logging.error(f"❌ Failed to get next_check_at even after creating job for {check_id}")
+                            state_changes['next_check_at'] = None
+                    else:
+                        logging.error(f"❌ Failed to create missing job for {check_id}")
+                        state_changes['next_check_at'] = None
+            except Exception as e:
+                logging.warning(f"Could not get next_run_time for job {check_id}: {e}")
+                state_changes['next_check_at'] = None
+        else:
+            # Для неактивних перевірок очищуємо час
+            state_changes['next_check_at'] = None
         
-        data_manager.save_checks(all_checks)
+        data_manager.update_check_state(check_id, state_changes)
         
         # ДОДАНО: Повертаємо оновлену інформацію про планувальник
         scheduler_job = scheduler_tasks.scheduler.get_job(check_id)
@@ -476,7 +684,7 @@ def api_manual_check(check_id):
             "extracted_text": extracted_text,
             "error_message": error_msg,
             "timestamp": current_time_iso,
-            "next_check_at": all_checks[next(i for i, c in enumerate(all_checks) if c['id'] == check_id)].get('next_check_at'),
+            "next_check_at": state_changes.get('next_check_at'),
             "scheduler_job_exists": scheduler_job is not None,
             "scheduler_next_run": scheduler_job.next_run_time.astimezone().isoformat() if scheduler_job and scheduler_job.next_run_time else None
         }), 200
@@ -489,34 +697,24 @@ def api_manual_check(check_id):
 def api_toggle_check_status(check_id):
     """API ендпоінт для деактивації/активації перевірки."""
     try:
-        check_details = data_manager.get_check_by_id(check_id)
-        if not check_details:
-            return jsonify({"error": "Check not found"}), 404
-        
-        current_status = check_details.get('status', 'active')
-        new_status = 'paused' if current_status == 'active' else 'active'
-        
-        logging.info(f"Toggling check {check_id} from {current_status} to {new_status}")
+        # Читання та зміна статусу - однією транзакцією (два одночасні перемикання не дають однаковий статус)
+        with data_manager.check_transaction(check_id) as check_details:
+            if not check_details:
+                return jsonify({"error": "Check not found"}), 404
+            
+            current_status = check_details.get('status', 'active')
+            new_status = 'paused' if current_status == 'active' else 'active'
+            
+            logging.info(f"Toggling check {check_id} from {current_status} to {new_status}")
+            
+            # ВИПРАВЛЕНО: Зберігаємо дані ПЕРЕД роботою з планувальником
+            check_details['status'] = new_status
+            # ВИПРАВЛЕНО: Очищуємо старий час наступної перевірки при деактивації
+            if new_status == 'paused':
+                check_details['next_check_at'] = None
         
-        # Оновлюємо статус в базі даних
-        all_checks = data_manager.load_checks()
         check_result = None
-        target_check = None
-        
-        for check in all_checks:
-            if check['id'] == check_id:
-                check['status'] = new_status
-                target_check = check
-                # ВИПРАВЛЕНО: Очищуємо старий час наступної перевірки при деактивації
-                if new_status == 'paused':
-                    check['next_check_at'] = None
-                break
-        
-        if not target_check:
-            return jsonify({"error": "Check not found in data"}), 404
-        
-        # ВИПРАВЛЕНО: Зберігаємо дані ПЕРЕД роботою з планувальником
-        data_manager.save_checks(all_checks)
+        state_changes = {}
         
         # Управляємо планувальником
         if new_status == 'active':
@@ -544,8 +742,8 @@ def api_toggle_check_status(check_id):
                         job = scheduler_tasks.scheduler.get_job(check_id)
                         if job and job.next_run_time:
                             next_run_local = job.next_run_time.astimezone()
-                            target_check['next_check_at'] = next_run_local.isoformat()
-                            logging.info(f"✅ Attempt {attempt+1}: Set next_check_at for activated job {check_id}: {target_check['next_check_at']}")
+                            state_changes['next_check_at'] = next_run_local.isoformat()
+                            logging.info(f"✅ Attempt {attempt+1}: Set next_check_at for activated job {check_id}: {state_changes['next_check_at']}")
                             break
                         else:
                             logging.warning(f"❌ Attempt {attempt+1}: Could not get next_run_time for activated job {check_id}")
@@ -556,44 +754,19 @@ def api_toggle_check_status(check_id):
                         if attempt < 2:
                             time.sleep(0.1 * (attempt + 1))
                 
-                if not target_check.get('next_check_at'):
+                if not state_changes.get('next_check_at'):
                     logging.error(f"❌ Failed to set next_check_at after 3 attempts for {check_id}")
             else:
                 logging.error(f"❌ Failed to create job for {check_id}")
-                target_check['next_check_at'] = None
+                state_changes['next_check_at'] = None
             
-            # Виконуємо одразу перевірку при активації
+            # Виконуємо одразу перевірку при активації (збереження - як для запланованої перевірки)
             try:
-                status, new_hash, extracted_text, error_msg = monitor_engine.perform_check(
-                    check_id=check_details['id'],
-                    name=check_details.get('name', 'Activation Check'),
-                    url=check_details['url'],
-                    selector=check_details['selector'],
-                    last_hash=check_details.get('last_content_hash')
-                )
-                
-                # Зберігаємо результат
-                current_time_utc = datetime.now(timezone.utc)
-                current_time_iso = current_time_utc.isoformat()
-                
-                history_entry = {
-                    "timestamp": current_time_iso,
-                    "status": status,
-                    "extracted_value": extracted_text,
-                    "content_hash": new_hash,
-                    "error_message": error_msg
-                }
-                data_manager.save_check_history_entry(check_id, history_entry)
-                
-                # Оновлюємо основні дані після перевірки
-                target_check['last_checked_at'] = current_time_iso
-                target_check['last_result'] = status
-                if status in ["changed", "no_change"]:
-                    target_check['last_content_hash'] = new_hash
-                if status != "error":
-                    target_check['last_error_message'] = None
-                else:
-                    target_check['last_error_message'] = error_msg
+                fetch_state = monitor_engine.get_fetch_state(check_details)
+                result = monitor_engine.perform_check_for_config(check_details, fetch_state)
+                history_entry = scheduler_tasks.save_check_result(check_id, result, fetch_state)
+                status, new_hash, extracted_text, error_msg = result
+                extracted_text = history_entry.get('extracted_value')
                 
                 check_result = {
                     "status": status,
@@ -606,8 +779,8 @@ def api_toggle_check_status(check_id):
                     job = scheduler_tasks.scheduler.get_job(check_id)
                     if job and job.next_run_time:
                         next_run_local = job.next_run_time.astimezone()
-                        target_check['next_check_at'] = next_run_local.isoformat()
-                        logging.info(f"🔄 Updated next_check_at after activation check: {target_check['next_check_at']}")
+                        state_changes['next_check_at'] = next_run_local.isoformat()
+                        logging.info(f"🔄 Updated next_check_at after activation check: {state_changes['next_check_at']}")
                 except Exception as e:
                     logging.warning(f"Could not update next_check_at after activation check: {e}")
                 
@@ -621,8 +794,8 @@ def api_toggle_check_status(check_id):
             # Деактивуємо - видаляємо завдання
             scheduler_tasks.remove_job(check_id)
         
-        # ВИПРАВЛЕНО: Зберігаємо оновлені дані після всіх операцій
-        data_manager.save_checks(all_checks)
+        # ВИПРАВЛЕНО: Зберігаємо стан виконання після всіх операцій
+        data_manager.update_check_state(check_id, state_changes)
         
         # ДОДАНО: Повертаємо свіжі дані перевірки
         updated_check = data_manager.get_check_by_id(check_id)
@@ -659,6 +832,15 @@ def api_force_check_all():
         app.logger.error(f"Error during force check all: {e}", exc_info=True)
         return jsonify({"error": f"Примусова перевірка не вдалася: {str(e)}"}), 500
 
+@app.route('/api/warm-start-status', methods=['GET'])
+def api_warm_start_status():
+    """API ендпоінт для прогресу початкового проходу перевірок після старту."""
+    try:
+        return jsonify(scheduler_tasks.get_warm_start_status()), 200
+    except Exception as e:
+        app.logger.error(f"Error getting warm start status: {e}", exc_info=True)
+        return jsonify({"error": "Failed to get warm start status"}), 500
+
 @app.route('/api/scheduler-diagnostics', methods=['GET'])
 def api_scheduler_diagnostics():
     """API ендпоінт для діагностики планувальника."""
@@ -703,7 +885,7 @@ def api_test_selector():
             "content_hash": hash_value,
             "error_message": error_msg,
             "text_length": len(extracted_text) if extracted_text else 0,
-            "success": status != "error"
+            "success": status not in monitor_engine.ERROR_STATUSES
         }), 200
         
     except Exception as e:
@@ -783,23 +965,28 @@ def api_app_sleep_toggle():
 
 @app.route('/api/app-status', methods=['GET'])
 def api_app_status():
-    """API ендпоінт для отримання статусу застосунку (сон/активний)."""
+    """API ендпоінт для отримання статусу застосунку (сон/активний); 304, поки стан не змінився."""
     try:
         is_sleeping = scheduler_tasks.is_app_sleeping()
+        scheduler_running = scheduler_tasks.scheduler.running if hasattr(scheduler_tasks, 'scheduler') else False
         active_jobs = scheduler_tasks.scheduler.get_jobs() if scheduler_tasks.scheduler.running else []
-        
-        # ВИПРАВЛЕНО: Підраховуємо активні перевірки з файлу даних
-        all_checks = data_manager.load_checks()
-        active_checks_count = len([check for check in all_checks if check.get('status') == 'active'])
-        
-        return jsonify({
-            "is_sleeping": is_sleeping,
-            "scheduler_running": scheduler_tasks.scheduler.running if hasattr(scheduler_tasks, 'scheduler') else False,
-            "active_jobs_count": len(active_jobs),
-            "active_checks": active_checks_count,  # ДОДАНО: правильний підрахунок
-            "total_checks": len(all_checks),      # ДОДАНО: загальна кількість
-            "status": "sleeping" if is_sleeping else "active"
-        }), 200
+
+        def build():
+            # ВИПРАВЛЕНО: Підраховуємо активні перевірки з файлу даних
+            all_checks = data_manager.load_checks()
+            active_checks_count = len([check for check in all_checks if check.get('status') == 'active'])
+
+            return {
+                "is_sleeping": is_sleeping,
+                "scheduler_running": scheduler_running,
+                "active_jobs_count": len(active_jobs),
+                "active_checks": active_checks_count,  # ДОДАНО: правильний підрахунок
+                "total_checks": len(all_checks),      # ДОДАНО: загальна кількість
+                "status": "sleeping" if is_sleeping else "active"
+            }
+
+        version = f"{data_manager.get_store_version()}-{int(is_sleeping)}-{int(scheduler_running)}-{len(active_jobs)}"
+        return cached_json_response('app-status', version, build)
         
     except Exception as e:
         app.logger.error(f"Error getting app status: {e}", exc_info=True)
@@ -844,13 +1031,13 @@ if __name__ == '__main__':
         except Exception as e:
             print(f"⚠️  Помилка оновлення часів: {e}")
         
-        # ВИПРАВЛЕНО: Використовуємо функцію з scheduler_tasks для початкових перевірок
-        print("🔍 Виконуємо початкові перевірки...")
+        # Початкові перевірки виконуються у фоні, сервер стартує одразу
+        print("🔍 Запускаємо початкові перевірки у фоні...")
         try:
-            executed_count = scheduler_tasks.execute_all_active_checks()
-            print(f"✅ Виконано {executed_count} початкових перевірок")
+            scheduler_tasks.start_warm_start_sweep()
+            print("✅ Початковий прохід запущено (прогрес: /api/warm-start-status)")
         except Exception as e:
-            print(f"⚠️  Помилка виконання початкових перевірок: {e}")
+            print(f"⚠️  Помилка запуску початкових перевірок: {e}")
         
         # ВИПРАВЛЕНО: Запускаємо Flask сервер тільки якщо запущено безпосередньо
         print("🌐 Запускаємо Flask сервер...")
@@ -892,6 +1079,12 @@ if __name__ == '__main__':
                 print("✅ Планувальник зупинено")
             except Exception as e:
                 print(f"⚠️  Помилка зупинки планувальника: {e}")
+        # Записуємо в базу зміни перевірок та агрегати, що ще не збережені з пам'яті
+        try:
+            data_manager.flush_checks()
+            rollups.flush_rollups()
+        except Exception as e:
+            print(f"⚠️  Помилка збереження перевірок: {e}")
 
 # ДОДАНО: Створюємо Flask застосунок для імпорту
 else:
@@ -916,12 +1109,12 @@ else:
         except Exception as e:
             print(f"⚠️  Помилка оновлення часів при імпорті: {e}")
         
-        # ВИПРАВЛЕНО: Використовуємо правильну функцію при імпорті
+        # Початкові перевірки - у фоні, щоб WSGI-сервер одразу обслуговував запити
         try:
-            executed_count = scheduler_tasks.execute_all_active_checks()
-            print(f"✅ Виконано {executed_count} початкових перевірок при імпорті")
+            scheduler_tasks.start_warm_start_sweep()
+            print("✅ Початковий прохід запущено у фоні при імпорті")
         except Exception as e:
-            print(f"⚠️  Помилка початкових перевірок при імпорті: {e}")
+            print(f"⚠️  Помилка запуску початкових перевірок при імпорті: {e}")
         
     except Exception as e:
         print(f"⚠️  Помилка ініціалізації при імпорті: {e}")
@@ -0,0 +1,74 @@
+"""
+Бенчмарк запису історії для режимів надійності MONITOR_HISTORY_DURABILITY.
+Запуск: python benchmark_history.py [--entries 2000] [--checks 50] [--threads 4]
+Працює з тимчасовою базою, робочі дані не змінюються.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import data_manager
+
+def run_mode(mode, entries, checks, threads):
+    """Записує entries записів для checks перевірок з threads потоків; повертає (секунди, записів/с)."""
+    data_manager.set_history_durability(mode)
+    per_thread = entries // threads
+
+    def worker(thread_index):
+        for i in range(per_thread):
+            check_id = f"bench-{(thread_index * per_thread + i) % checks}"
+            data_manager.save_check_history_entry(check_id, {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "status": "no_change",
+                "extracted_value": f"value {i}",
+                "content_hash": f"hash{i % 7}",
+                "error_message": None
+            })
+        data_manager.close_connection()
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    data_manager.flush_history()
+    elapsed = time.perf_counter() - started
+
+    written = per_thread * threads
+    stats = data_manager.get_history_writer_stats()
+    return elapsed, written / elapsed, stats
+
+def main():
+    parser = argparse.ArgumentParser(description="History write throughput per durability mode")
+    parser.add_argument('--entries', type=int, default=2000)
+    parser.add_argument('--checks', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    test_dir = tempfile.mkdtemp(prefix='monitor_bench_')
+    data_manager.DB_FILE = os.path.join(test_dir, 'bench.db')
+    data_manager.CHECKS_FILE = os.path.join(test_dir, 'checks.json')
+    data_manager.HISTORY_DIR = os.path.join(test_dir, 'history')
+
+    data_manager.get_connection()  # створення схеми не входить у вимірювання
+
+    print(f"{args.entries} entries, {args.checks} checks, {args.threads} threads")
+    print(f"{'mode':<10} {'seconds':>8} {'entries/s':>10} {'batches':>8} {'avg batch':>10}")
+    try:
+        for mode in data_manager.HISTORY_DURABILITY_MODES:
+            elapsed, rate, stats = run_mode(mode, args.entries, args.checks, args.threads)
+            print(f"{mode:<10} {elapsed:>8.2f} {rate:>10.0f} {stats.get('batches', '-'):>8} {stats.get('avg_batch_size', '-'):>10}")
+    finally:
+        data_manager.set_history_durability('batched')
+        data_manager.close_connection()
+        shutil.rmtree(test_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,96 +1,1242 @@
+import atexit
+import copy
+import hashlib
 import json
 import os
 import logging
+import sqlite3
+import threading
+import time
 import uuid
-from datetime import datetime, timezone
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
+# Сховище - SQLite у режимі WAL (таблиці checks та history з індексами)
+DB_FILE = os.getenv('MONITOR_DB_FILE', 'data/monitor.db')
+# Старий формат на JSON-файлах, з якого виконується одноразова міграція
 CHECKS_FILE = 'data/checks.json'  # ВИПРАВЛЕНО: видалив 'web_monitor/' префікс
 HISTORY_DIR = 'data/history'       # ВИПРАВЛЕНО: видалив 'web_monitor/' префікс
-MAX_HISTORY_ENTRIES = 20
+MAX_HISTORY_ENTRIES = 20  # Кількість останніх записів на сторінці перевірки
 
-def load_checks():
-    """Загружает конфигурации проверок из файла checks.json."""
-    if not os.path.exists(CHECKS_FILE):
-        logging.info(f"Checks file {CHECKS_FILE} not found. Returning empty list.")
-        return []
+# Політика зберігання історії за замовчуванням (перевірка може перекрити її полем 'history_retention'):
+#   changed та помилки зберігаються завжди (в межах max_age_days);
+#   'no_change' зберігаються як є raw_no_change_hours годин, старіші серії згортаються в підсумкові записи;
+#   max_age_days / max_entries - необов'язкові загальні межі (None - без обмеження)
+DEFAULT_HISTORY_RETENTION = {
+    "raw_no_change_hours": float(os.getenv('MONITOR_HISTORY_RAW_NO_CHANGE_HOURS', 24)),
+    "max_age_days": int(os.getenv('MONITOR_HISTORY_MAX_AGE_DAYS', 0)) or None,
+    "max_entries": int(os.getenv('MONITOR_HISTORY_MAX_ENTRIES', 0)) or None
+}
+
+# Стан виконання перевірки (оновлюється кожним запуском) - зберігається окремо від конфігурації
+# в таблиці check_state і додається до перевірки при читанні
+RUNTIME_FIELDS = (
+    "last_checked_at", "last_result", "last_content_hash", "next_check_at", "last_error_message",
+    "http_etag", "http_last_modified", "last_body_hash"
+)
+
+# Поля запису історії, що зберігаються окремими колонками; решта - у колонці extra (JSON)
+HISTORY_FIELDS = ("timestamp", "status", "extracted_value", "content_hash", "error_message")
+
+# Значення extracted_value зберігаються один раз у таблиці history_blobs (ключ - MD5 тексту, як content_hash),
+# записи історії посилаються на них колонкою blob_hash. Значення від HISTORY_BLOB_COMPRESS_MIN_BYTES стискаються zlib.
+HISTORY_BLOB_COMPRESSION = os.getenv('MONITOR_HISTORY_BLOB_COMPRESSION', '1') not in ('0', 'false', 'no')
+HISTORY_BLOB_COMPRESS_MIN_BYTES = int(os.getenv('MONITOR_HISTORY_BLOB_COMPRESS_MIN_BYTES', 256))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checks (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_checks_status ON checks (status);
+CREATE INDEX IF NOT EXISTS idx_checks_position ON checks (position);
+
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    check_id TEXT NOT NULL,
+    timestamp TEXT,
+    status TEXT,
+    extracted_value TEXT,
+    content_hash TEXT,
+    error_message TEXT,
+    extra TEXT,
+    blob_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_history_check ON history (check_id, id);
+
+CREATE TABLE IF NOT EXISTS history_blobs (
+    hash TEXT PRIMARY KEY,
+    compressed INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS check_state (
+    check_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS check_rollups (
+    check_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Окреме з'єднання на кожен потік (Flask, диспетчер, пул перевірок)
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized_db = None
+
+# Затримка відкладеного запису перевірок у базу (секунди); 0 - записувати одразу
+CHECKS_FLUSH_DELAY_SECONDS = float(os.getenv('MONITOR_CHECKS_FLUSH_DELAY_SECONDS', 1))
+
+# Реєстр перевірок у пам'яті: читання без диску, зміни записуються в базу асинхронно.
+# Конфігурації та стани в _registry / _runtime_state не змінюються на місці, а замінюються новими словниками
+# (копіювання при записі): читачі під _registry_lock лише беруть посилання, а копіюють їх уже без блокування
+_registry = {}  # check_id -> конфігурація
+_registry_order = []  # порядок перевірок (як у списку load_checks)
+_positions = {}  # check_id -> позиція в базі (зростає вздовж _registry_order)
+_last_position = -1
+_registry_loaded = False
+_registry_lock = threading.RLock()
+_runtime_state = {}  # check_id -> стан виконання (RUNTIME_FIELDS)
+_dirty_ids = set()
+_dirty_state_ids = set()
+_deleted_ids = set()
+_order_dirty = False
+_flush_timer = None
+_flush_lock = threading.Lock()
+
+# Смугасті блокування перевірок: записи однієї перевірки (check_transaction, save_check, update_check_state,
+# delete_check) виконуються послідовно, різних перевірок - паралельно. Читання (get_check_by_id, load_checks)
+# їх не беруть. Порядок: блокування перевірки -> _registry_lock, ніколи навпаки
+CHECK_LOCK_STRIPES = int(os.getenv('MONITOR_CHECK_LOCK_STRIPES', 64))
+_check_locks = [threading.RLock() for _ in range(CHECK_LOCK_STRIPES)]
+
+# Надійність запису історії:
+#   'per_entry' - кожен запис окремою транзакцією з синхронізацією диску (synchronous=FULL);
+#   'batched'   - потік запису збирає записи в пакети, одна синхронізація диску на пакет;
+#   'none'      - пакети без синхронізації диску (synchronous=OFF), найшвидше, але запис може загубитись при збої ОС
+HISTORY_DURABILITY_MODES = ("none", "batched", "per_entry")
+HISTORY_DURABILITY = os.getenv('MONITOR_HISTORY_DURABILITY', 'batched')
+if HISTORY_DURABILITY not in HISTORY_DURABILITY_MODES:
+    logging.warning(f"Unknown MONITOR_HISTORY_DURABILITY '{HISTORY_DURABILITY}', using 'batched'")
+    HISTORY_DURABILITY = 'batched'
+HISTORY_BATCH_SIZE = int(os.getenv('MONITOR_HISTORY_BATCH_SIZE', 100))
+HISTORY_BATCH_INTERVAL_SECONDS = float(os.getenv('MONITOR_HISTORY_BATCH_INTERVAL_MS', 200)) / 1000
+# Повтор пакета, який не вдалося записати: затримка подвоюється від базової до максимальної (секунди)
+HISTORY_RETRY_BASE_SECONDS = 0.5
+HISTORY_RETRY_MAX_SECONDS = 30
+_history_writer = None
+_history_writer_lock = threading.Lock()
+
+# Фонове ущільнення історії: запис - лише INSERT, зайві записи видаляються періодично
+HISTORY_COMPACT_INTERVAL_SECONDS = float(os.getenv('MONITOR_HISTORY_COMPACT_INTERVAL_SECONDS', 60))
+HISTORY_FULL_COMPACT_EVERY = 60  # кожен N-й прохід ущільнює всі перевірки
+_compact_pending_ids = set()
+_compact_lock = threading.Lock()
+_compactor_thread = None
+_compactor_stop = threading.Event()
+
+# Індекс останнього запису історії кожної перевірки (для списку перевірок без читання історії).
+# Оновлюється при кожному записі історії; з бази читається лише раз - по одному запису на перевірку
+_latest_history = {}  # check_id -> останній запис історії
+_latest_versions = {}  # check_id -> лічильник змін (захист від перезапису новішого запису старішим з бази)
+_latest_loaded_db = None
+_latest_lock = threading.Lock()
+
+# Версія сховища перевірок: зростає при кожній зміні перевірок, їх стану виконання чи останнього запису історії.
+# З неї API будує ETag - незмінені відповіді віддаються як 304 без перебудови
+_STORE_EPOCH = uuid.uuid4().hex[:8]  # нова після перезапуску, щоб ETag попереднього процесу не збігся
+_store_version = 0
+_store_version_lock = threading.Lock()
+
+def _connect():
+    conn = sqlite3.connect(DB_FILE, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=" + ("FULL" if HISTORY_DURABILITY == "per_entry" else "NORMAL"))
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+def get_connection():
+    """
+    Повертає з'єднання з базою для поточного потоку.
+    При першому зверненні до бази створює схему та мігрує дані з JSON-файлів.
+    """
+    global _initialized_db
+
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'db_file', None) == DB_FILE:
+        return conn
+    if conn is not None:
+        conn.close()
+
+    db_dir = os.path.dirname(DB_FILE)
+    if db_dir:
+        os.makedirs(db_dir, exist_ok=True)
+    conn = _connect()
+    _local.conn = conn
+    _local.db_file = DB_FILE
+
+    with _init_lock:
+        if _initialized_db != DB_FILE:
+            conn.executescript(SCHEMA)
+            migrate_history_to_blobs(conn)
+            migrate_json_to_sqlite(conn)
+            _initialized_db = DB_FILE
+    return conn
+
+def migrate_json_to_sqlite(conn=None):
+    """
+    Одноразова міграція зі старого формату (data/checks.json та data/history/*.json).
+    Виконується лише раз для бази (позначка в таблиці meta); JSON-файли не змінюються.
+    Повертає кількість перенесених перевірок.
+    """
+    conn = conn or get_connection()
+    if conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone():
+        return 0
+
+    migrated_checks = 0
+    migrated_entries = 0
     try:
-        with open(CHECKS_FILE, 'r', encoding='utf-8') as f:
-            checks = json.load(f)
-        return checks
-    except (IOError, json.JSONDecodeError) as e:
-        logging.error(f"Error loading checks from {CHECKS_FILE}: {e}")
-        return []
+        with conn:
+            if os.path.exists(CHECKS_FILE):
+                with open(CHECKS_FILE, 'r', encoding='utf-8') as f:
+                    legacy_checks = json.load(f)
+                _write_checks(conn, legacy_checks)
+                migrated_checks = len(legacy_checks)
 
-def save_checks(checks):
-    """Сохраняет конфигурации проверок в файл checks.json."""
+            if os.path.isdir(HISTORY_DIR):
+                for filename in sorted(os.listdir(HISTORY_DIR)):
+                    if not filename.endswith('.json'):
+                        continue
+                    check_id = filename[:-len('.json')]
+                    try:
+                        with open(os.path.join(HISTORY_DIR, filename), 'r', encoding='utf-8') as f:
+                            entries = json.load(f)
+                    except (IOError, json.JSONDecodeError) as e:
+                        logging.error(f"Migration: could not read history file {filename}: {e}")
+                        continue
+                    _insert_history(conn, [(check_id, entry) for entry in entries])
+                    migrated_entries += len(entries)
+
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)",
+                         (datetime.now(timezone.utc).isoformat(),))
+        if migrated_checks or migrated_entries:
+            logging.info(f"Migration: imported {migrated_checks} checks and {migrated_entries} history entries into {DB_FILE}")
+    except (IOError, json.JSONDecodeError, sqlite3.Error) as e:
+        logging.error(f"Migration from JSON files to {DB_FILE} failed: {e}")
+    return migrated_checks
+
+def migrate_history_to_blobs(conn=None):
+    """
+    Переносить значення extracted_value, збережені в рядках history, у таблицю history_blobs.
+    Бази, створені до появи history_blobs, отримують колонку blob_hash; виконується лише раз (позначка в meta).
+    Повертає кількість оновлених записів історії.
+    """
+    conn = conn or get_connection()
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(history)")}
+    if 'blob_hash' not in columns:
+        conn.execute("ALTER TABLE history ADD COLUMN blob_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_history_blob ON history (blob_hash)")
+    if conn.execute("SELECT value FROM meta WHERE key = 'history_blobs_migrated'").fetchone():
+        return 0
+
+    migrated = 0
     try:
-        os.makedirs(os.path.dirname(CHECKS_FILE), exist_ok=True)
-        with open(CHECKS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(checks, f, indent=4, ensure_ascii=False, default=str) 
-        logging.info(f"Checks saved to {CHECKS_FILE}")
-    except IOError as e:
-        logging.error(f"Error saving checks to {CHECKS_FILE}: {e}")
+        with conn:
+            rows = conn.execute(
+                "SELECT id, extracted_value FROM history WHERE extracted_value IS NOT NULL AND blob_hash IS NULL"
+            ).fetchall()
+            blobs = {}
+            updates = []
+            for row in rows:
+                blob_hash, blob_row = _encode_blob(row['extracted_value'])
+                blobs[blob_hash] = blob_row
+                updates.append((blob_hash, row['id']))
+            conn.executemany(_INSERT_BLOB_SQL, blobs.values())
+            conn.executemany("UPDATE history SET blob_hash = ?, extracted_value = NULL WHERE id = ?", updates)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('history_blobs_migrated', ?)",
+                         (datetime.now(timezone.utc).isoformat(),))
+        migrated = len(updates)
+        if migrated:
+            logging.info(f"Migration: moved {migrated} history values into {len(blobs)} blobs in {DB_FILE}")
+    except sqlite3.Error as e:
+        logging.error(f"Migration of history values to blobs in {DB_FILE} failed: {e}")
+    return migrated
+
+def reset_registry():
+    """Скидає реєстр (наступне звернення перечитає перевірки з бази). Незаписані зміни спершу записуються."""
+    global _registry_loaded, _last_position
+    flush_checks()
+    with _registry_lock:
+        _registry.clear()
+        _registry_order.clear()
+        _positions.clear()
+        _runtime_state.clear()
+        _last_position = -1
+        _registry_loaded = False
+    _bump_store_version()
+
+def close_connection():
+    """Закриває з'єднання поточного потоку (якщо відкрите)."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def _write_checks(conn, checks):
+    """Записує повний список перевірок (порядок зберігається в колонці position)."""
+    rows = [
+        (check['id'], position, check.get('status'), json.dumps(check, ensure_ascii=False, default=str))
+        for position, check in enumerate(checks)
+    ]
+    conn.executemany(
+        "INSERT INTO checks (id, position, status, data) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET position = excluded.position, status = excluded.status, data = excluded.data",
+        rows
+    )
+    existing_ids = {row[0] for row in conn.execute("SELECT id FROM checks")}
+    removed_ids = existing_ids - {check['id'] for check in checks}
+    if removed_ids:
+        conn.executemany("DELETE FROM checks WHERE id = ?", [(check_id,) for check_id in removed_ids])
+
+_INSERT_HISTORY_SQL = (
+    "INSERT INTO history (check_id, timestamp, status, content_hash, error_message, extra, blob_hash) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+_INSERT_BLOB_SQL = "INSERT OR IGNORE INTO history_blobs (hash, compressed, size, data) VALUES (?, ?, ?, ?)"
+# Записи історії разом зі значеннями з history_blobs (значення старих рядків - у колонці extracted_value)
+_SELECT_HISTORY_SQL = (
+    "SELECT history.*, history_blobs.compressed AS blob_compressed, history_blobs.data AS blob_data "
+    "FROM history LEFT JOIN history_blobs ON history_blobs.hash = history.blob_hash"
+)
+
+def _encode_blob(value):
+    """Повертає (hash, рядок history_blobs) для значення extracted_value."""
+    raw = value.encode('utf-8')
+    blob_hash = hashlib.md5(raw).hexdigest()
+    data, compressed = raw, 0
+    if HISTORY_BLOB_COMPRESSION and len(raw) >= HISTORY_BLOB_COMPRESS_MIN_BYTES:
+        packed = zlib.compress(raw, 6)
+        if len(packed) < len(raw):
+            data, compressed = packed, 1
+    return blob_hash, (blob_hash, compressed, len(raw), data)
+
+def _decode_blob(compressed, data):
+    raw = zlib.decompress(data) if compressed else data
+    return bytes(raw).decode('utf-8')
+
+def _insert_history(conn, entries):
+    """Записує записи історії [(check_id, entry)]; значення extracted_value - один раз на вміст у history_blobs."""
+    blobs = {}
+    rows = []
+    for check_id, entry in entries:
+        extra = {key: value for key, value in entry.items() if key not in HISTORY_FIELDS}
+        blob_hash = None
+        if entry.get('extracted_value') is not None:
+            blob_hash, blob_row = _encode_blob(entry['extracted_value'])
+            blobs[blob_hash] = blob_row
+        rows.append((
+            check_id,
+            entry.get('timestamp'),
+            entry.get('status'),
+            entry.get('content_hash'),
+            entry.get('error_message'),
+            json.dumps(extra, ensure_ascii=False, default=str) if extra else None,
+            blob_hash
+        ))
+    if blobs:
+        conn.executemany(_INSERT_BLOB_SQL, blobs.values())
+    conn.executemany(_INSERT_HISTORY_SQL, rows)
+
+def _history_entry(row):
+    entry = {field: row[field] for field in HISTORY_FIELDS}
+    if row['blob_data'] is not None:
+        entry['extracted_value'] = _decode_blob(row['blob_compressed'], row['blob_data'])
+    if row['extra']:
+        entry.update(json.loads(row['extra']))
+    return entry
+
+def _ensure_registry():
+    """Завантажує перевірки з бази в реєстр при першому зверненні. Викликається під _registry_lock."""
+    global _registry_loaded, _last_position
+    if _registry_loaded:
+        return
+    conn = get_connection()
+    rows = conn.execute("SELECT position, data FROM checks ORDER BY position").fetchall()
+    state_rows = conn.execute("SELECT check_id, data FROM check_state").fetchall()
+    _registry.clear()
+    _registry_order.clear()
+    _positions.clear()
+    _runtime_state.clear()
+    _runtime_state.update({row['check_id']: json.loads(row['data']) for row in state_rows})
+    for row in rows:
+        check = json.loads(row['data'])
+        # Перевірки старого формату містять стан виконання в конфігурації - переносимо його в check_state
+        legacy_state = {field: check.pop(field) for field in RUNTIME_FIELDS if field in check}
+        if legacy_state:
+            if check['id'] not in _runtime_state:
+                _runtime_state[check['id']] = legacy_state
+                _dirty_state_ids.add(check['id'])
+            _dirty_ids.add(check['id'])
+        _registry[check['id']] = check
+        _registry_order.append(check['id'])
+        _positions[check['id']] = row['position']
+    _last_position = max(_positions.values(), default=-1)
+    _registry_loaded = True
+    logging.info(f"Check registry loaded: {len(_registry_order)} checks from {DB_FILE}")
+    if _dirty_ids and _schedule_flush():
+        threading.Thread(target=flush_checks, daemon=True).start()
+
+def _check_refs(check_id):
+    """Посилання (конфігурація, стан виконання) на незмінні словники реєстру. Викликається під _registry_lock."""
+    return _registry[check_id], _runtime_state.get(check_id, {})
+
+def _merge_refs(config, state):
+    """Копія конфігурації разом зі станом виконання; блокування не потрібне (див. _check_refs)."""
+    check = copy.deepcopy(config)
+    for field in RUNTIME_FIELDS:
+        check[field] = copy.deepcopy(state.get(field))
+    return check
+
+def _config_only(check):
+    """Конфігурація перевірки без полів стану виконання."""
+    return {key: value for key, value in check.items() if key not in RUNTIME_FIELDS}
+
+def _next_position():
+    """Позиція для нової перевірки в кінці списку. Викликається під _registry_lock."""
+    global _last_position
+    _last_position += 1
+    return _last_position
+
+def _schedule_flush():
+    """
+    Планує відкладений запис змін реєстру в базу (зміни у вікні об'єднуються в один запис).
+    Викликається під _registry_lock. Повертає True, якщо записувати треба одразу (затримку вимкнено).
+    """
+    global _flush_timer
+    if CHECKS_FLUSH_DELAY_SECONDS <= 0:
+        return True
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(CHECKS_FLUSH_DELAY_SECONDS, flush_checks)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+    return False
+
+def flush_checks():
+    """
+    Записує накопичені зміни реєстру (змінені та видалені перевірки) в базу однією транзакцією.
+    Викликається таймером, при завершенні процесу та явно перед зупинкою застосунку.
+    """
+    global _flush_timer, _order_dirty
+
+    with _flush_lock:
+        with _registry_lock:
+            _flush_timer = None
+            if not (_dirty_ids or _dirty_state_ids or _deleted_ids or _order_dirty):
+                return 0
+            dirty_ids = set(_registry_order) if _order_dirty else set(_dirty_ids)
+            rows = [
+                (check_id, _positions[check_id], _registry[check_id].get('status'),
+                 json.dumps(_registry[check_id], ensure_ascii=False, default=str))
+                for check_id in dirty_ids if check_id in _registry
+            ]
+            state_rows = [
+                (check_id, json.dumps(_runtime_state[check_id], ensure_ascii=False, default=str))
+                for check_id in _dirty_state_ids if check_id in _runtime_state
+            ]
+            deleted_ids = list(_deleted_ids)
+            _dirty_ids.clear()
+            _dirty_state_ids.clear()
+            _deleted_ids.clear()
+            _order_dirty = False
+
+        try:
+            conn = get_connection()
+            with conn:
+                conn.executemany(
+                    "INSERT INTO checks (id, position, status, data) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(id) DO UPDATE SET position = excluded.position, status = excluded.status, data = excluded.data",
+                    rows
+                )
+                conn.executemany(
+                    "INSERT INTO check_state (check_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(check_id) DO UPDATE SET data = excluded.data",
+                    state_rows
+                )
+                conn.executemany("DELETE FROM checks WHERE id = ?", [(check_id,) for check_id in deleted_ids])
+                conn.executemany("DELETE FROM check_state WHERE check_id = ?", [(check_id,) for check_id in deleted_ids])
+            if rows or deleted_ids:
+                logging.info(f"Checks saved to {DB_FILE} ({len(rows)} updated, {len(deleted_ids)} deleted)")
+            logging.debug(f"Runtime state saved for {len(state_rows)} checks")
+            return len(rows) + len(state_rows) + len(deleted_ids)
+        except sqlite3.Error as e:
+            # Повертаємо зміни в чергу, щоб наступний запис їх не втратив
+            with _registry_lock:
+                _dirty_ids.update(row[0] for row in rows)
+                _dirty_state_ids.update(row[0] for row in state_rows)
+                _deleted_ids.update(deleted_ids)
+                _schedule_flush()
+            logging.error(f"Error saving checks to {DB_FILE}: {e}")
+            return 0
+
+def load_checks():
+    """
+    Повертає копії перевірок з реєстру в пам'яті (у порядку додавання), без читання диску.
+    Конфігурація об'єднується зі станом виконання (RUNTIME_FIELDS).
+    Під _registry_lock береться лише список посилань, глибоке копіювання - без блокування,
+    тож записи в реєстр не чекають на копіювання всього списку.
+    """
+    with _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading checks from {DB_FILE}: {e}")
+            return []
+        refs = [_check_refs(check_id) for check_id in _registry_order]
+    return [_merge_refs(config, state) for config, state in refs]
+
+def save_checks(checks):
+    """
+    Зберігає конфігурацію повного списку перевірок; перевірки, яких немає в списку, видаляються.
+    У базу записуються лише змінені перевірки, асинхронно (flush_checks).
+    Поля стану виконання (RUNTIME_FIELDS) тут ігноруються - їх змінює update_check_state,
+    тож застаріла копія списку не перезапише свіжі результати перевірок.
+    """
+    global _last_position
+    with _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading checks from {DB_FILE}: {e}")
+            return
+        checks = [_config_only(check) for check in checks]
+        new_order = [check['id'] for check in checks]
+        changed_ids = {check['id'] for check in checks if _registry.get(check['id']) != check}
+        deleted_ids = set(_registry_order) - set(new_order)
+        if not changed_ids and not deleted_ids and new_order == _registry_order:
+            return
+
+        for check in checks:
+            if check['id'] not in _registry:
+                _positions[check['id']] = _next_position()
+            if check['id'] in changed_ids:
+                _registry[check['id']] = copy.deepcopy(check)
+        for check_id in deleted_ids:
+            _registry.pop(check_id, None)
+            _positions.pop(check_id, None)
+            _runtime_state.pop(check_id, None)
+            _dirty_state_ids.discard(check_id)
+
+        # Якщо порядок у списку не збігається з позиціями - перенумеровуємо всі перевірки
+        order_positions = [_positions[check_id] for check_id in new_order]
+        reorder = any(a >= b for a, b in zip(order_positions, order_positions[1:]))
+        if reorder:
+            for position, check_id in enumerate(new_order):
+                _positions[check_id] = position
+            _last_position = len(new_order) - 1
+        _registry_order[:] = new_order
+        _mark_changes(changed_ids, deleted_ids, reorder=reorder)
+        flush_now = _schedule_flush()
+    if flush_now:
+        flush_checks()
+
+def save_check(check):
+    """
+    Зберігає конфігурацію однієї перевірки (додає в кінець, якщо її ще немає) - O(1), без запису всього списку.
+    Поля стану виконання ігноруються (див. update_check_state).
+    """
+    check = _config_only(check)
+    with get_check_lock(check['id']), _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading checks from {DB_FILE}: {e}")
+            return
+        if _registry.get(check['id']) == check:
+            return
+        if check['id'] not in _registry:
+            _registry_order.append(check['id'])
+            _positions[check['id']] = _next_position()
+        _registry[check['id']] = copy.deepcopy(check)
+        _mark_changes([check['id']])
+        flush_now = _schedule_flush()
+    if flush_now:
+        flush_checks()
+
+def get_check_lock(check_id):
+    """Блокування (RLock) смуги, до якої належить перевірка."""
+    return _check_locks[zlib.crc32(str(check_id).encode('utf-8')) % CHECK_LOCK_STRIPES]
+
+@contextmanager
+def check_transaction(check_id):
+    """
+    Транзакційне оновлення перевірки: читання, зміна та запис під блокуванням перевірки.
+    Повертає копію перевірки (конфігурація + стан виконання) або None, якщо її немає; зміни копії
+    записуються при виході з блоку, при винятку - відкидаються.
+
+        with data_manager.check_transaction(check_id) as check:
+            check['last_result'] = 'changed'
+    """
+    with get_check_lock(check_id):
+        check = get_check_by_id(check_id)
+        yield check
+        if check is None:
+            return
+        state_changes = {field: check.get(field) for field in RUNTIME_FIELDS}
+        with _registry_lock:
+            if check_id not in _registry:
+                logging.warning(f"Check {check_id} was deleted during transaction, changes discarded")
+                return
+            current_state = _runtime_state.get(check_id, {})
+            state_changes = {field: value for field, value in state_changes.items() if current_state.get(field) != value}
+        save_check(check)
+        if state_changes:
+            update_check_state(check_id, state_changes)
+
+def _mark_changes(changed_ids=(), deleted_ids=(), reorder=False):
+    """Позначає перевірки для наступного flush_checks. Викликається під _registry_lock."""
+    global _order_dirty
+    _dirty_ids.update(changed_ids)
+    _dirty_ids.difference_update(deleted_ids)
+    _deleted_ids.update(deleted_ids)
+    _order_dirty = _order_dirty or reorder
+    _bump_store_version()
+
+def _bump_store_version():
+    global _store_version
+    with _store_version_lock:
+        _store_version += 1
+
+def get_store_version():
+    """Рядок версії сховища перевірок (для ETag); змінюється при будь-якій зміні перевірок, їх стану чи історії."""
+    with _store_version_lock:
+        return f"{_STORE_EPOCH}-{_store_version}"
+
+def delete_check(check_id):
+    """Видаляє перевірку та її стан виконання з реєстру (з бази - при наступному flush_checks)."""
+    with get_check_lock(check_id), _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading checks from {DB_FILE}: {e}")
+            return False
+        if check_id not in _registry:
+            return False
+        del _registry[check_id]
+        _registry_order.remove(check_id)
+        _positions.pop(check_id, None)
+        _runtime_state.pop(check_id, None)
+        _dirty_state_ids.discard(check_id)
+        _mark_changes(deleted_ids=[check_id])
+        flush_now = _schedule_flush()
+    if flush_now:
+        flush_checks()
+    return True
+
+def update_check_state(check_id, changes):
+    """
+    Оновлює стан виконання перевірки (лише передані поля з RUNTIME_FIELDS), не чіпаючи конфігурацію.
+    Запис у базу - відкладений (flush_checks). Повертає False, якщо перевірку не знайдено.
+    """
+    unknown_fields = set(changes) - set(RUNTIME_FIELDS)
+    if unknown_fields:
+        logging.warning(f"Ignoring non-runtime fields in state update for {check_id}: {sorted(unknown_fields)}")
+    with get_check_lock(check_id), _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading checks from {DB_FILE}: {e}")
+            return False
+        if check_id not in _registry:
+            logging.warning(f"Cannot update state: check {check_id} not found")
+            return False
+        # Новий словник замість зміни на місці: читачі могли взяти посилання на попередній
+        _runtime_state[check_id] = {
+            **_runtime_state.get(check_id, {}),
+            **{field: value for field, value in changes.items() if field in RUNTIME_FIELDS}
+        }
+        _dirty_state_ids.add(check_id)
+        flush_now = _schedule_flush()
+    _bump_store_version()
+    if flush_now:
+        flush_checks()
+    return True
+
+def iter_checks():
+    """Перевірки по одній (копії, як у load_checks) - для потокової віддачі без копії всього списку."""
+    with _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading checks from {DB_FILE}: {e}")
+            return
+        check_ids = list(_registry_order)
+    for check_id in check_ids:
+        with _registry_lock:
+            refs = _check_refs(check_id) if check_id in _registry else None
+        if refs is not None:
+            yield _merge_refs(*refs)
 
 def get_check_by_id(check_id):
-    """Загружает все проверки и возвращает одну по ее ID, или None если не найдена."""
-    all_checks = load_checks()
-    for check in all_checks:
-        if check['id'] == check_id:
-            return check
+    """Возвращает копію проверки по ее ID з реєстру (O(1), без читання диску), или None если не найдена."""
+    with _registry_lock:
+        try:
+            _ensure_registry()
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error loading check {check_id} from {DB_FILE}: {e}")
+            return None
+        refs = _check_refs(check_id) if check_id in _registry else None
+    if refs is not None:
+        return _merge_refs(*refs)
     logging.warning(f"Check with ID {check_id} not found in load_checks().") # Добавим лог
     return None
 
 def get_history_filepath(check_id):
-    """Возвращает путь к файлу истории для данного check_id."""
+    """Возвращает путь к старому JSON-файлу истории для данного check_id (використовується міграцією)."""
     return os.path.join(HISTORY_DIR, f"{check_id}.json")
 
-def load_check_history(check_id):
-    """Загружает историю проверок для указанного check_id."""
-    filepath = get_history_filepath(check_id)
-    if not os.path.exists(filepath):
-        return []
+def load_check_history(check_id, limit=None):
+    """
+    Загружает историю проверок для указанного check_id (від найстаріших до найновіших).
+    limit - лише N останніх записів (читаються з індексу з кінця, без читання всієї історії).
+    """
+    _wait_for_pending_history(check_id)
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            history = json.load(f)
-        return history
-    except (IOError, json.JSONDecodeError) as e:
-        logging.error(f"Error loading history for check_id {check_id} from {filepath}: {e}")
+        conn = get_connection()
+        if limit is None:
+            rows = conn.execute(_SELECT_HISTORY_SQL + " WHERE check_id = ? ORDER BY history.id", (check_id,)).fetchall()
+        else:
+            rows = conn.execute(
+                _SELECT_HISTORY_SQL + " WHERE check_id = ? ORDER BY history.id DESC LIMIT ?", (check_id, limit)
+            ).fetchall()
+            rows.reverse()
+        return [_history_entry(row) for row in rows]
+    except (sqlite3.Error, json.JSONDecodeError, zlib.error, UnicodeDecodeError) as e:
+        logging.error(f"Error loading history for check_id {check_id} from {DB_FILE}: {e}")
         return []
 
+def _query_latest_entry(conn, check_id):
+    row = conn.execute(
+        _SELECT_HISTORY_SQL + " WHERE check_id = ? ORDER BY history.id DESC LIMIT 1", (check_id,)
+    ).fetchone()
+    return _history_entry(row) if row else None
+
+def _ensure_latest_index():
+    """Заповнює індекс останніх записів при першому зверненні (або після зміни DB_FILE)."""
+    global _latest_loaded_db
+    if _latest_loaded_db == DB_FILE:
+        return
+    check_ids = [check['id'] for check in load_checks()]
+    with _latest_lock:
+        if _latest_loaded_db == DB_FILE:
+            return
+        flush_history()  # записи з черги потоку запису мають бути в базі
+        conn = get_connection()
+        # Перевірки з реєстру та ті, в історію яких уже писали (можуть ще не бути в реєстрі)
+        check_ids = list(dict.fromkeys(check_ids + list(_latest_history)))
+        _latest_history.clear()
+        for check_id in check_ids:
+            entry = _query_latest_entry(conn, check_id)
+            if entry:
+                _latest_history[check_id] = entry
+        _latest_loaded_db = DB_FILE
+        _bump_store_version()
+        logging.info(f"Latest history index loaded: {len(_latest_history)} checks")
+
+def _set_latest_entry(check_id, entry):
+    with _latest_lock:
+        _latest_versions[check_id] = _latest_versions.get(check_id, 0) + 1
+        if entry is None:
+            _latest_history.pop(check_id, None)
+        else:
+            _latest_history[check_id] = dict(entry)
+    _bump_store_version()
+
+def _refresh_latest_entries(conn, check_ids):
+    """Перечитує з бази останні записи перевірок після видалення записів історії (ущільнення, дублікати)."""
+    if _latest_loaded_db != DB_FILE:
+        return
+    with _latest_lock:
+        versions = {check_id: _latest_versions.get(check_id, 0) for check_id in check_ids}
+    entries = {check_id: _query_latest_entry(conn, check_id) for check_id in check_ids}
+    with _latest_lock:
+        for check_id, entry in entries.items():
+            # Запис, доданий під час читання, новіший за прочитаний з бази
+            if _latest_versions.get(check_id, 0) != versions[check_id]:
+                continue
+            if entry is None:
+                _latest_history.pop(check_id, None)
+            else:
+                _latest_history[check_id] = entry
+    _bump_store_version()
+
+def get_latest_history_entry(check_id):
+    """Останній запис історії перевірки з індексу (без читання історії) або None."""
+    try:
+        _ensure_latest_index()
+    except (sqlite3.Error, json.JSONDecodeError, zlib.error, UnicodeDecodeError) as e:
+        logging.error(f"Error loading latest history index from {DB_FILE}: {e}")
+        return None
+    with _latest_lock:
+        entry = _latest_history.get(check_id)
+        return dict(entry) if entry else None
+
+def get_latest_history_entries():
+    """Останні записи історії всіх перевірок: {check_id: запис}."""
+    try:
+        _ensure_latest_index()
+    except (sqlite3.Error, json.JSONDecodeError, zlib.error, UnicodeDecodeError) as e:
+        logging.error(f"Error loading latest history index from {DB_FILE}: {e}")
+        return {}
+    with _latest_lock:
+        return {check_id: dict(entry) for check_id, entry in _latest_history.items()}
+
+def _to_utc_iso(value):
+    """ISO-рядок часу у формі, в якій зберігаються timestamp історії (UTC, +00:00). Наївний час вважається UTC."""
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat()
+
+def query_check_history(check_id, limit=MAX_HISTORY_ENTRIES, cursor=None, since=None, until=None, statuses=None):
+    """
+    Сторінка історії перевірки від найновіших записів до старіших.
+    cursor - id запису, після якого (у бік старіших) продовжується сторінка (next_cursor попередньої сторінки);
+    since / until - межі часу (ISO), statuses - список статусів.
+    Записи читаються з індексу (check_id, id) з кінця; значення з history_blobs розпаковуються лише для записів сторінки.
+    Повертає (записи з полем 'id', next_cursor або None). Некоректні параметри - ValueError.
+    """
+    conditions = ["check_id = ?"]
+    params = [check_id]
+    if cursor is not None:
+        conditions.append("history.id < ?")
+        params.append(int(cursor))
+    if since:
+        conditions.append("timestamp >= ?")
+        params.append(_to_utc_iso(since))
+    if until:
+        conditions.append("timestamp <= ?")
+        params.append(_to_utc_iso(until))
+    if statuses:
+        conditions.append(f"status IN ({', '.join('?' for _ in statuses)})")
+        params.extend(statuses)
+
+    _wait_for_pending_history(check_id)
+    rows = get_connection().execute(
+        _SELECT_HISTORY_SQL + f" WHERE {' AND '.join(conditions)} ORDER BY history.id DESC LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+    entries = []
+    for row in rows[:limit]:
+        entry = _history_entry(row)
+        entry['id'] = row['id']
+        entries.append(entry)
+    next_cursor = str(rows[limit - 1]['id']) if len(rows) > limit else None
+    return entries, next_cursor
+
 def save_check_history_entry(check_id, history_entry):
     """
     Добавляет новую запись в историю проверок для указанного check_id.
-    Ограничивает количество записей до MAX_HISTORY_ENTRIES.
+    Запис - лише INSERT (O(1)); політику зберігання застосовує фоновий compact_history.
+    У режимах 'batched' та 'none' запис ставиться в чергу потоку запису історії (HISTORY_DURABILITY).
+    Індекс останніх записів (get_latest_history_entry) оновлюється одразу.
     """
-    os.makedirs(HISTORY_DIR, exist_ok=True)
-    
-    filepath = get_history_filepath(check_id)
-    history = load_check_history(check_id) 
+    _set_latest_entry(check_id, history_entry)
+    if HISTORY_DURABILITY != "per_entry":
+        _get_history_writer().submit(check_id, history_entry)
+        return
 
-    history.append(history_entry)
-    logging.debug(f"History for {check_id} before trim: {len(history)} entries")
+    try:
+        conn = get_connection()
+        with conn:
+            _insert_history(conn, [(check_id, history_entry)])
+        logging.debug(f"Saved history entry for check_id {check_id} to {DB_FILE}")
+    except sqlite3.Error as e:
+        logging.error(f"Error saving history for check_id {check_id} to {DB_FILE}: {e}")
+        return
+    _note_history_written([check_id])
 
-    if len(history) > MAX_HISTORY_ENTRIES:
-        history = history[-MAX_HISTORY_ENTRIES:] 
-    
-    logging.debug(f"History for {check_id} after trim (before save): {len(history)} entries")
+def _note_history_written(check_ids):
+    """Позначає перевірки для наступного ущільнення історії."""
+    with _compact_lock:
+        _compact_pending_ids.update(check_ids)
+    _ensure_history_compactor()
 
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(history, f, indent=4, ensure_ascii=False, default=str)
-            f.flush()  # <<< ДОБАВЛЕНО
-            os.fsync(f.fileno()) # <<< ДОБАВЛЕНО
-        logging.debug(f"Saved history entry for check_id {check_id} to {filepath}. Actual saved length: {len(history)}")
-    except IOError as e:
-        logging.error(f"Error saving history for check_id {check_id} to {filepath}: {e}")
-    except Exception as e: # Ловим другие возможные ошибки от fsync
-        logging.error(f"Unexpected error during saving/flushing history for {check_id}: {e}")
+class HistoryWriter:
+    """
+    Потік групового запису історії: записи всіх перевірок збираються в чергу і записуються
+    однією транзакцією (одна синхронізація диску на пакет) - коли набирається
+    HISTORY_BATCH_SIZE записів або минає HISTORY_BATCH_INTERVAL_SECONDS від першого запису в черзі.
+    Пакет, який не вдалося записати, повертається в початок черги і повторюється з затримкою;
+    flush() у цей час повертає False, а не вважає записи збереженими.
+    """
 
-def add_check(check_data):
+    def __init__(self, durability, batch_size, batch_interval_seconds):
+        self.durability = durability
+        self.batch_size = max(1, batch_size)
+        self.batch_interval_seconds = batch_interval_seconds
+        self._cond = threading.Condition()
+        self._queue = []  # (check_id, entry)
+        self._queued_since = None
+        self._pending_per_check = {}  # check_id -> кількість незаписаних записів
+        self._submitted_seq = 0
+        self._committed_seq = 0
+        self._flush_requested = False
+        self._stopped = False
+        self._failures = 0  # невдалих спроб запису поспіль
+        self._last_error = None
+        self._stats = {"batches": 0, "entries": 0, "errors": 0, "last_batch_size": 0, "last_commit_ms": 0.0}
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, check_id, entry):
+        with self._cond:
+            self._queue.append((check_id, entry))
+            self._pending_per_check[check_id] = self._pending_per_check.get(check_id, 0) + 1
+            self._submitted_seq += 1
+            if self._queued_since is None:
+                self._queued_since = time.monotonic()
+            if len(self._queue) >= self.batch_size or len(self._queue) == 1:
+                self._cond.notify_all()
+
+    def has_pending(self, check_id):
+        with self._cond:
+            return check_id in self._pending_per_check
+
+    def flush(self, timeout=10):
+        """
+        Записує чергу негайно та чекає на завершення (для читання щойно доданих записів).
+        Повертає False, якщо не встигли за timeout або спроба запису не вдалася (записи лишаються в черзі).
+        """
+        with self._cond:
+            target_seq = self._submitted_seq
+            if self._committed_seq >= target_seq:
+                return True
+            self._flush_requested = True
+            self._cond.notify_all()
+            errors = self._stats["errors"]
+            self._cond.wait_for(lambda: self._committed_seq >= target_seq or self._stopped
+                                or self._stats["errors"] != errors, timeout=timeout)
+            if self._committed_seq < target_seq:
+                logging.warning(f"History writer: flush incomplete, {len(self._queue)} entries still queued "
+                                f"(last error: {self._last_error})")
+                return False
+            return True
+
+    def stop(self):
+        self.flush()
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+
+    def get_stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "durability": self.durability,
+                "queued": len(self._queue),
+                "batch_size": self.batch_size,
+                "batch_interval_seconds": self.batch_interval_seconds,
+                "consecutive_failures": self._failures,
+                "last_error": self._last_error,
+                "avg_batch_size": round(stats["entries"] / stats["batches"], 1) if stats["batches"] else 0.0
+            })
+            return stats
+
+    def _take_batch(self):
+        """Чекає на умову запису пакета та забирає його з черги. Викликається під self._cond."""
+        while not self._stopped:
+            if self._queue:
+                if self._flush_requested or len(self._queue) >= self.batch_size:
+                    break
+                remaining = self.batch_interval_seconds - (time.monotonic() - self._queued_since)
+                if remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+            else:
+                self._flush_requested = False
+                self._cond.wait()
+        batch = self._queue
+        self._queue = []
+        self._queued_since = None
+        self._flush_requested = False
+        return batch, self._submitted_seq
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch, batch_seq = self._take_batch()
+                if not batch and self._stopped:
+                    return
+            started = time.monotonic()
+            try:
+                conn = get_connection()
+                conn.execute("PRAGMA synchronous=" + ("OFF" if self.durability == "none" else "FULL"))
+                with conn:
+                    _insert_history(conn, batch)
+                _note_history_written({check_id for check_id, _ in batch})
+                failed = False
+            except sqlite3.Error as e:
+                failed = True
+                error = e
+            with self._cond:
+                self._stats["last_batch_size"] = len(batch)
+                self._stats["last_commit_ms"] = round((time.monotonic() - started) * 1000, 2)
+                if failed:
+                    # Записи не втрачаються: пакет повертається в початок черги, _committed_seq не змінюється
+                    self._queue = batch + self._queue
+                    self._queued_since = self._queued_since or time.monotonic()
+                    self._failures += 1
+                    self._last_error = str(error)
+                    self._stats["errors"] += 1
+                    self._cond.notify_all()
+                    delay = min(HISTORY_RETRY_BASE_SECONDS * 2 ** (self._failures - 1), HISTORY_RETRY_MAX_SECONDS)
+                    if self._stopped:
+                        logging.error(f"History writer: stopped with {len(self._queue)} unwritten entries: {error}")
+                        return
+                    logging.error(f"History writer: failed to write batch of {len(batch)} entries, "
+                                  f"retrying in {delay:.1f}s: {error}")
+                    self._cond.wait_for(lambda: self._stopped, timeout=delay)
+                    continue
+                for check_id, _ in batch:
+                    self._pending_per_check[check_id] -= 1
+                    if not self._pending_per_check[check_id]:
+                        del self._pending_per_check[check_id]
+                self._committed_seq = max(self._committed_seq, batch_seq)
+                self._failures = 0
+                self._last_error = None
+                self._stats["batches"] += 1
+                self._stats["entries"] += len(batch)
+                self._cond.notify_all()
+
+def _get_history_writer():
+    global _history_writer
+    with _history_writer_lock:
+        if _history_writer is None:
+            _history_writer = HistoryWriter(HISTORY_DURABILITY, HISTORY_BATCH_SIZE, HISTORY_BATCH_INTERVAL_SECONDS)
+        return _history_writer
+
+def flush_history(timeout=10):
+    """Записує всі записи історії з черги потоку запису. Повертає False, якщо не встигли за timeout."""
+    writer = _history_writer
+    return writer.flush(timeout) if writer is not None else True
+
+def _wait_for_pending_history(check_id):
+    """Перед читанням історії перевірки дописуємо її записи з черги (читання власних записів)."""
+    writer = _history_writer
+    if writer is not None and writer.has_pending(check_id):
+        writer.flush()
+
+def set_history_durability(mode, batch_size=None, batch_interval_seconds=None):
     """
-    Додає нову перевірку до списку та зберігає у файл checks.json.
-    Генерує унікальний ID та додає системні поля.
+    Змінює режим запису історії ('none', 'batched', 'per_entry'); черга попереднього потоку дописується.
+    Використовується бенчмарком; з'єднання інших потоків зберігають попередній режим synchronous.
+    """
+    global HISTORY_DURABILITY, HISTORY_BATCH_SIZE, HISTORY_BATCH_INTERVAL_SECONDS, _history_writer
+    if mode not in HISTORY_DURABILITY_MODES:
+        raise ValueError(f"Unknown history durability mode: {mode}")
+    with _history_writer_lock:
+        if _history_writer is not None:
+            _history_writer.stop()
+        _history_writer = None
+        HISTORY_DURABILITY = mode
+        if batch_size is not None:
+            HISTORY_BATCH_SIZE = batch_size
+        if batch_interval_seconds is not None:
+            HISTORY_BATCH_INTERVAL_SECONDS = batch_interval_seconds
+    close_connection()
+
+def get_history_writer_stats():
+    """Стан потоку запису історії (для /api/system-status)."""
+    writer = _history_writer
+    if writer is None:
+        return {"durability": HISTORY_DURABILITY, "queued": 0, "batches": 0, "entries": 0}
+    return writer.get_stats()
+
+def _stop_history_writer():
+    writer = _history_writer
+    if writer is not None:
+        writer.stop()
+
+def get_history_retention(check_config):
+    """Політика зберігання історії перевірки: значення за замовчуванням, перекриті полем 'history_retention'."""
+    retention = dict(DEFAULT_HISTORY_RETENTION)
+    overrides = (check_config or {}).get('history_retention') or {}
+    retention.update({key: value for key, value in overrides.items() if key in DEFAULT_HISTORY_RETENTION})
+    return retention
+
+def validate_history_retention(retention):
+    """Повертає текст помилки для некоректного 'history_retention' або None."""
+    if retention is None:
+        return None
+    if not isinstance(retention, dict) or set(retention) - set(DEFAULT_HISTORY_RETENTION):
+        return f"history_retention must be an object with keys: {', '.join(DEFAULT_HISTORY_RETENTION)}"
+    for key, value in retention.items():
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+            return f"history_retention.{key} must be a non-negative number or null"
+    return None
+
+def _summary_of(row):
+    """(кількість, перший, останній timestamp) для запису 'no_change' - звичайного або підсумкового."""
+    extra = json.loads(row['extra']) if row['extra'] else {}
+    summary = extra.get('summary')
+    if summary:
+        return summary['count'], summary['first_timestamp'], summary['last_timestamp']
+    return 1, row['timestamp'], row['timestamp']
+
+def _compact_check_history(conn, check_id, retention, now):
+    """
+    Застосовує політику зберігання до історії однієї перевірки. Повертає кількість видалених записів.
+    Записи 'changed' та помилки зберігаються; 'no_change' старші за raw_no_change_hours
+    згортаються: з кожної серії підряд залишається останній запис з підсумком (кількість, перший/останній час).
+    """
+    removed = 0
+
+    max_age_days = retention.get('max_age_days')
+    if max_age_days:
+        age_cutoff = (now - timedelta(days=max_age_days)).isoformat()
+        removed += conn.execute(
+            "DELETE FROM history WHERE check_id = ? AND timestamp < ?", (check_id, age_cutoff)
+        ).rowcount
+
+    raw_cutoff = (now - timedelta(hours=retention.get('raw_no_change_hours') or 0)).isoformat()
+    rows = conn.execute(
+        "SELECT id, timestamp, status, extra FROM history WHERE check_id = ? AND timestamp < ? ORDER BY id",
+        (check_id, raw_cutoff)
+    ).fetchall()
+
+    run = []
+    for row in rows + [None]:
+        if row is not None and row['status'] == 'no_change':
+            run.append(row)
+            continue
+        # Кінець серії 'no_change': згортаємо, якщо в ній більше одного запису
+        if len(run) > 1:
+            summaries = [_summary_of(run_row) for run_row in run]
+            last_row = run[-1]
+            extra = json.loads(last_row['extra']) if last_row['extra'] else {}
+            extra['summary'] = {
+                "count": sum(count for count, _, _ in summaries),
+                "first_timestamp": min(first for _, first, _ in summaries),
+                "last_timestamp": max(last for _, _, last in summaries)
+            }
+            conn.execute("UPDATE history SET extra = ? WHERE id = ?", (json.dumps(extra, ensure_ascii=False), last_row['id']))
+            conn.executemany("DELETE FROM history WHERE id = ?", [(run_row['id'],) for run_row in run[:-1]])
+            removed += len(run) - 1
+        run = []
+
+    max_entries = retention.get('max_entries')
+    if max_entries:
+        removed += conn.execute(
+            "DELETE FROM history WHERE check_id = ? AND id <= "
+            "(SELECT id FROM history WHERE check_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (check_id, check_id, max_entries)
+        ).rowcount
+    return removed
+
+def compact_history(check_ids=None, now=None):
     """
+    Застосовує політики зберігання історії (get_history_retention) у фоні, поза шляхом запису.
+    check_ids - перевірки для ущільнення; None - перевірки, в які писали після попереднього ущільнення.
+    Повертає кількість видалених записів.
+    """
+    if check_ids is None:
+        with _compact_lock:
+            check_ids = list(_compact_pending_ids)
+            _compact_pending_ids.clear()
+    if not check_ids:
+        return 0
+
+    now = now or datetime.now(timezone.utc)
+    removed = 0
+    try:
+        conn = get_connection()
+        compacted_ids = []
+        for check_id in check_ids:
+            with _registry_lock:
+                check_config = _registry.get(check_id)
+            with conn:
+                check_removed = _compact_check_history(conn, check_id, get_history_retention(check_config), now)
+            if check_removed:
+                removed += check_removed
+                compacted_ids.append(check_id)
+        # Ущільнення могло видалити або змінити останній запис (max_age_days, підсумки)
+        _refresh_latest_entries(conn, compacted_ids)
+        if removed:
+            logging.info(f"History compaction: removed {removed} entries for {len(check_ids)} checks")
+    except (sqlite3.Error, json.JSONDecodeError) as e:
+        with _compact_lock:
+            _compact_pending_ids.update(check_ids)
+        logging.error(f"Error compacting history: {e}")
+    return removed
+
+def gc_history_blobs():
+    """Видаляє значення з history_blobs, на які не посилається жоден запис історії. Повертає кількість видалених."""
+    try:
+        conn = get_connection()
+        with conn:
+            removed = conn.execute(
+                "DELETE FROM history_blobs WHERE NOT EXISTS "
+                "(SELECT 1 FROM history WHERE history.blob_hash = history_blobs.hash)"
+            ).rowcount
+        if removed:
+            logging.info(f"History blob GC: removed {removed} unreferenced blobs")
+        return removed
+    except sqlite3.Error as e:
+        logging.error(f"Error collecting unreferenced history blobs: {e}")
+        return 0
+
+def get_history_blob_stats():
+    """Кількість значень у history_blobs та їх розмір до і після стиснення (для /api/system-status)."""
+    try:
+        row = get_connection().execute(
+            "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS raw_bytes, "
+            "COALESCE(SUM(LENGTH(data)), 0) AS stored_bytes, COALESCE(SUM(compressed), 0) AS compressed "
+            "FROM history_blobs"
+        ).fetchone()
+        stats = dict(row)
+        stats["compression_enabled"] = HISTORY_BLOB_COMPRESSION
+        return stats
+    except sqlite3.Error as e:
+        logging.error(f"Error reading history blob stats: {e}")
+        return {"error": str(e)}
+
+def _history_compactor_loop():
+    passes = 0
+    while not _compactor_stop.wait(HISTORY_COMPACT_INTERVAL_SECONDS):
+        passes += 1
+        if passes % HISTORY_FULL_COMPACT_EVERY == 0:
+            # Періодично - всі перевірки, щоб старіли й історії перевірок без нових записів
+            with _registry_lock:
+                all_ids = list(_registry_order)
+            compact_history(all_ids)
+            gc_history_blobs()
+        elif compact_history():
+            gc_history_blobs()
+
+def _ensure_history_compactor():
+    """Запускає фоновий потік ущільнення історії (один на процес)."""
+    global _compactor_thread
+    with _compact_lock:
+        if _compactor_thread is not None and _compactor_thread.is_alive():
+            return
+        _compactor_thread = threading.Thread(target=_history_compactor_loop, name="history-compactor", daemon=True)
+        _compactor_thread.start()
+
+def _build_new_check(check_data):
+    """Повна конфігурація нової перевірки: унікальний ID та системні поля."""
     # Генеруємо унікальний ID
     check_id = str(uuid.uuid4())
     current_time = datetime.now(timezone.utc).isoformat()
@@ -103,45 +1249,75 @@ def add_check(check_data):
         "selector": check_data.get("selector"),
         "change_threshold": check_data.get("change_threshold"),
         "interval": check_data["interval"],
+        "parser": check_data.get("parser"),  # None - глобальний бекенд розбору за замовчуванням
+        "max_body_bytes": check_data.get("max_body_bytes"),  # None - глобальний ліміт MAX_BODY_BYTES
+        "target_within_kb": check_data.get("target_within_kb"),  # Елемент у перших N КБ - ранній розрив
+        "host_policy": check_data.get("host_policy"),  # Перекриття політики хоста (host_policies.py)
+        "history_retention": check_data.get("history_retention"),  # Перекриття DEFAULT_HISTORY_RETENTION
         "status": "active",  # За замовчуванням нові перевірки активні
         "created_at": current_time,
         "last_checked_at": None,
         "last_result": None,
         "last_content_hash": None,
+        "http_etag": None,
+        "http_last_modified": None,
+        "last_body_hash": None,
         "next_check_at": None,
         "last_error_message": None
     }
+    return new_check
+
+def add_check(check_data):
+    """
+    Додає нову перевірку до списку та зберігає у базу.
+    Генерує унікальний ID та додає системні поля.
+    """
+    new_check = _build_new_check(check_data)
     
-    # Завантажуємо існуючі перевірки
-    all_checks = load_checks()
-    
-    # Додаємо нову перевірку
-    all_checks.append(new_check)
-    
-    # Зберігаємо оновлений список
-    save_checks(all_checks)
+    # Додаємо нову перевірку в кінець списку
+    save_check(new_check)
     
-    logging.info(f"Нову перевірку створено: ID={check_id}, Name='{new_check['name']}', URL={new_check['url']}")
+    logging.info(f"Нову перевірку створено: ID={new_check['id']}, Name='{new_check['name']}', URL={new_check['url']}")
     
     return new_check
 
+def add_checks(checks_data):
+    """
+    Додає кілька нових перевірок (масовий імпорт): усі додаються в реєстр разом
+    і записуються в базу однією транзакцією. Повертає створені перевірки в тому ж порядку.
+    """
+    new_checks = [_build_new_check(check_data) for check_data in checks_data]
+    if not new_checks:
+        return []
+    with _registry_lock:
+        _ensure_registry()
+        for new_check in new_checks:
+            _registry_order.append(new_check['id'])
+            _positions[new_check['id']] = _next_position()
+            _registry[new_check['id']] = copy.deepcopy(_config_only(new_check))
+        _mark_changes([new_check['id'] for new_check in new_checks])
+    flush_checks()
+    logging.info(f"Bulk: {len(new_checks)} new checks created")
+    return new_checks
+
 def delete_check_history(check_id):
     """
-    Видаляє файл історії для вказаного check_id.
-    Повертає True, якщо файл було видалено або його не існувало.
+    Видаляє історію для вказаного check_id.
+    Повертає True, якщо записи було видалено або їх не існувало.
     """
-    filepath = get_history_filepath(check_id)
-    if os.path.exists(filepath):
-        try:
-            os.remove(filepath)
-            logging.info(f"Deleted history file for check_id {check_id}: {filepath}")
-            return True
-        except OSError as e:
-            logging.error(f"Error deleting history file for check_id {check_id} at {filepath}: {e}")
-            return False
-    else:
-        logging.info(f"History file for check_id {check_id} does not exist: {filepath}")
-        return True  # Вважаємо успіхом, якщо файлу не було
+    _wait_for_pending_history(check_id)
+    try:
+        conn = get_connection()
+        with conn:
+            deleted = conn.execute("DELETE FROM history WHERE check_id = ?", (check_id,)).rowcount
+        _set_latest_entry(check_id, None)
+        logging.info(f"Deleted {deleted} history entries for check_id {check_id}")
+        if deleted:
+            gc_history_blobs()
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Error deleting history for check_id {check_id}: {e}")
+        return False
 
 def debug_check_data(check_id):
     """
@@ -202,34 +1378,35 @@ def clean_duplicate_history_entries(check_id):
             return
         
         # Створюємо множину для відстеження унікальних комбінацій
+        conn = get_connection()
+        rows = conn.execute(
+            "SELECT id, timestamp, content_hash FROM history WHERE check_id = ? ORDER BY id", (check_id,)
+        ).fetchall()
         seen = set()
-        cleaned_history = []
-        removed_count = 0
+        duplicate_ids = []
         
-        for entry in history:
-            timestamp = entry.get('timestamp', '')
-            content_hash = entry.get('content_hash', '')
+        for row in rows:
+            timestamp = row['timestamp'] or ''
+            content_hash = row['content_hash'] or ''
             key = (timestamp, content_hash)
             
             if key not in seen:
                 seen.add(key)
-                cleaned_history.append(entry)
             else:
-                removed_count += 1
+                duplicate_ids.append(row['id'])
                 logging.info(f"Removing duplicate entry: {timestamp} with hash {content_hash}")
         
+        removed_count = len(duplicate_ids)
         if removed_count > 0:
-            logging.info(f"Cleaned history for {check_id}: {len(history)} -> {len(cleaned_history)} entries (removed {removed_count} duplicates)")
+            logging.info(f"Cleaned history for {check_id}: {len(history)} -> {len(history) - removed_count} entries (removed {removed_count} duplicates)")
             
-            # Зберігаємо очищену історію
-            filepath = get_history_filepath(check_id)
+            # Видаляємо дублікати однією транзакцією
             try:
-                with open(filepath, 'w', encoding='utf-8') as f:
-                    json.dump(cleaned_history, f, indent=4, ensure_ascii=False, default=str)
-                    f.flush()
-                    os.fsync(f.fileno())
+                with conn:
+                    conn.executemany("DELETE FROM history WHERE id = ?", [(entry_id,) for entry_id in duplicate_ids])
+                _refresh_latest_entries(conn, [check_id])
                 logging.info(f"Saved cleaned history for {check_id}")
-            except IOError as e:
+            except sqlite3.Error as e:
                 logging.error(f"Error saving cleaned history for {check_id}: {e}")
                 raise
         else:
@@ -244,49 +1421,33 @@ def sync_check_with_latest_history(check_id):
     Синхронізує основні дані перевірки з найсвіжішим записом в історії.
     """
     try:
-        history = load_check_history(check_id)
-        if not history:
+        latest_entry = get_latest_history_entry(check_id)
+        if not latest_entry:
             logging.info(f"No history found for check {check_id}, nothing to sync")
             return False
         
-        # Сортуємо історію за часом (найновіші спочатку)
-        history.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-        latest_entry = history[0]
-        
-        # Завантажуємо всі перевірки
-        all_checks = load_checks()
-        check_config = None
-        check_index = -1
-        
-        for i, check in enumerate(all_checks):
-            if check['id'] == check_id:
-                check_config = check
-                check_index = i
-                break
-        
+        check_config = get_check_by_id(check_id)
         if not check_config:
             logging.error(f"Check with ID {check_id} not found for sync")
             return False
         
-        # Оновлюємо основні дані з історії
+        # Оновлюємо стан виконання з історії
         old_time = check_config.get('last_checked_at')
         old_result = check_config.get('last_result')
         old_hash = check_config.get('last_content_hash')
         
-        check_config['last_checked_at'] = latest_entry.get('timestamp')
-        check_config['last_result'] = latest_entry.get('status')
-        
+        state_changes = {
+            'last_checked_at': latest_entry.get('timestamp'),
+            'last_result': latest_entry.get('status'),
+            'last_error_message': latest_entry.get('error_message') or None
+        }
         if latest_entry.get('content_hash'):
-            check_config['last_content_hash'] = latest_entry.get('content_hash')
+            state_changes['last_content_hash'] = latest_entry.get('content_hash')
+            if latest_entry.get('content_hash') != old_hash:
+                # Валідатори HTTP-кешу та хеш тіла відносяться до старого хешу - наступна перевірка завантажить сторінку повністю
+                state_changes.update({'http_etag': None, 'http_last_modified': None, 'last_body_hash': None})
         
-        if latest_entry.get('error_message'):
-            check_config['last_error_message'] = latest_entry.get('error_message')
-        else:
-            check_config['last_error_message'] = None
-        
-        # Зберігаємо оновлені дані
-        all_checks[check_index] = check_config
-        save_checks(all_checks)
+        update_check_state(check_id, state_changes)
         
         logging.info(f"Synced check {check_id}:")
         logging.info(f"  time: '{old_time}' -> '{latest_entry.get('timestamp')}'")
@@ -299,18 +1460,39 @@ def sync_check_with_latest_history(check_id):
         logging.error(f"Error in sync_check_with_latest_history for {check_id}: {e}")
         raise
 
+def load_check_rollups():
+    """Завантажує агрегати перевірок (rollups.py): {check_id: дані}."""
+    try:
+        rows = get_connection().execute("SELECT check_id, data FROM check_rollups").fetchall()
+        return {row['check_id']: json.loads(row['data']) for row in rows}
+    except (sqlite3.Error, json.JSONDecodeError) as e:
+        logging.error(f"Error loading check rollups from {DB_FILE}: {e}")
+        return {}
+
+def save_check_rollups(rollups, deleted_ids=()):
+    """Записує агрегати перевірок {check_id: дані} однією транзакцією; deleted_ids - видаляються. Повертає True при успіху."""
+    try:
+        conn = get_connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO check_rollups (check_id, data) VALUES (?, ?) "
+                "ON CONFLICT(check_id) DO UPDATE SET data = excluded.data",
+                [(check_id, json.dumps(data)) for check_id, data in rollups.items()]
+            )
+            conn.executemany("DELETE FROM check_rollups WHERE check_id = ?", [(check_id,) for check_id in deleted_ids])
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Error saving check rollups to {DB_FILE}: {e}")
+        return False
+
 def get_current_content(check_id):
     """
-    Повертає поточний контент для вказаної перевірки з останнього запису історії.
+    Повертає поточний контент для вказаної перевірки з останнього запису історії (індекс останніх записів).
     """
-    history = load_check_history(check_id)
-    if not history:
+    latest_entry = get_latest_history_entry(check_id)
+    if not latest_entry:
         return None
     
-    # Сортуємо за часом (найновіші спочатку)
-    history.sort(key=lambda x: x.get('timestamp', ''), reverse=True)
-    latest_entry = history[0]
-    
     return {
         'content': latest_entry.get('extracted_value'),
         'timestamp': latest_entry.get('timestamp'),
@@ -334,95 +1516,190 @@ def get_check_with_current_content(check_id):
     
     return check
 
+# Примусовий запис незбережених змін при завершенні процесу
+atexit.register(flush_checks)
+atexit.register(_compactor_stop.set)
+atexit.register(_stop_history_writer)
+
 if __name__ == '__main__':
     if not logging.getLogger().hasHandlers():
         logging.basicConfig(level=logging.DEBUG, 
                             format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+
+    # Тести працюють з тимчасовою базою, щоб не чіпати робочі дані
+    import tempfile
+    test_dir = tempfile.mkdtemp(prefix='monitor_test_')
+    DB_FILE = os.path.join(test_dir, 'test.db')
+    CHECKS_FILE = os.path.join(test_dir, 'checks.json')
+    HISTORY_DIR = os.path.join(test_dir, 'history')
+
+    # Міграція зі старого формату
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with open(CHECKS_FILE, 'w', encoding='utf-8') as f:
+        json.dump([{"id": "legacy1", "name": "Legacy", "url": "http://example.com", "selector": "h1", "status": "active"}], f)
+    with open(get_history_filepath("legacy1"), 'w', encoding='utf-8') as f:
+        json.dump([{"timestamp": "2024-01-01T00:00:00+00:00", "status": "changed", "extracted_value": "old",
+                    "content_hash": "h0", "error_message": None}], f)
+    assert [c['id'] for c in load_checks()] == ["legacy1"], "Legacy checks were not migrated"
+    assert load_check_history("legacy1")[0]["extracted_value"] == "old", "Legacy history was not migrated"
+    assert migrate_json_to_sqlite() == 0, "Migration must run only once"
     
     test_check_id = "example-check-id-for-test-123"
-    history_file_path = get_history_filepath(test_check_id)
-    if os.path.exists(history_file_path):
-        try:
-            os.remove(history_file_path)
-            logging.info(f"Removed old history file: {history_file_path}")
-        except OSError as e:
-            logging.error(f"Error removing old history file {history_file_path}: {e}")
-
-    logging.info(f"Testing history functions for check_id: {test_check_id} with MAX_HISTORY_ENTRIES = {MAX_HISTORY_ENTRIES}")
-    for i in range(MAX_HISTORY_ENTRIES + 5): # Add 25 entries if MAX_HISTORY_ENTRIES is 20
-        entry_timestamp = datetime.now().isoformat() 
+
+    logging.info(f"Testing history functions for check_id: {test_check_id} with {DEFAULT_HISTORY_RETENTION}")
+    # Стара історія: 10 no_change, changed, 5 no_change, error; свіжа: 8 no_change
+    old_statuses = ["no_change"] * 10 + ["changed"] + ["no_change"] * 5 + ["error"]
+    old_start = datetime.now(timezone.utc) - timedelta(hours=DEFAULT_HISTORY_RETENTION["raw_no_change_hours"] + 24)
+    statuses = [(old_start + timedelta(minutes=i), status) for i, status in enumerate(old_statuses)]
+    statuses += [(datetime.now(timezone.utc), "no_change")] * 8
+    for i, (entry_time, status) in enumerate(statuses):
         entry = {
-            "timestamp": entry_timestamp,
-            "status": "no_change" if i % 2 == 0 else "changed",
+            "timestamp": entry_time.isoformat(),
+            "status": status,
             "extracted_value": f"Test Value {i+1}",
             "content_hash": f"testhash_{i+1}",
-            "error_message": None
+            "error_message": "boom" if status == "error" else None
         }
         save_check_history_entry(test_check_id, entry)
 
-    # Небольшая пауза перед финальной загрузкой, на всякий случай
-    import time
-    time.sleep(0.1) 
+    assert len(load_check_history(test_check_id)) == len(statuses), "Writes must not trim history"
+    assert [e["extracted_value"] for e in load_check_history(test_check_id, limit=2)] == \
+        [f"Test Value {len(statuses) - 1}", f"Test Value {len(statuses)}"], "limit must return the newest entries"
+    assert compact_history() == 9 + 4, "Old no_change runs must collapse into one summary entry each"
+    assert compact_history([test_check_id]) == 0, "Compaction must be idempotent"
+    assert get_latest_history_entry(test_check_id)["extracted_value"] == f"Test Value {len(statuses)}", \
+        "Latest history index must point to the newest entry"
 
     loaded_history = load_check_history(test_check_id)
-    logging.info(f"Loaded history for {test_check_id} contains {len(loaded_history)} entries (expected {MAX_HISTORY_ENTRIES}).")
-    
-    if loaded_history:
-        logging.info(f"First entry in loaded history (oldest of the last {MAX_HISTORY_ENTRIES}):")
-        logging.info(json.dumps(loaded_history[0], indent=2))
-        logging.info("Last entry in loaded history (newest):")
-        logging.info(json.dumps(loaded_history[-1], indent=2))
-    
-    assert len(loaded_history) == MAX_HISTORY_ENTRIES, \
-        f"History length mismatch: expected {MAX_HISTORY_ENTRIES}, got {len(loaded_history)}"
-    
-    expected_first_value_index = (MAX_HISTORY_ENTRIES + 5) - MAX_HISTORY_ENTRIES
-    if loaded_history:
-         assert loaded_history[0]["extracted_value"] == f"Test Value {expected_first_value_index + 1}", \
-             f"Expected first value to be 'Test Value {expected_first_value_index + 1}', but got '{loaded_history[0]['extracted_value']}'"
+    logging.info(f"Loaded history for {test_check_id} contains {len(loaded_history)} entries after compaction.")
+    assert [e["status"] for e in loaded_history[:4]] == ["no_change", "changed", "no_change", "error"], \
+        "Changed and error entries must be kept"
+    assert loaded_history[0]["summary"] == {"count": 10, "first_timestamp": old_start.isoformat(),
+                                            "last_timestamp": (old_start + timedelta(minutes=9)).isoformat()}, \
+        f"Unexpected summary: {loaded_history[0].get('summary')}"
+    assert loaded_history[0]["extracted_value"] == "Test Value 10", "Summary must keep the newest entry of the run"
+    assert loaded_history[2]["summary"]["count"] == 5
+    assert len(loaded_history) == 4 + 8 and "summary" not in loaded_history[-1], "Recent entries must stay raw"
 
-    logging.info("Test for data_manager.py (history part) completed successfully.")
+    # Коли свіжі записи старіють, вони теж згортаються; max_entries обрізає найстаріші
+    assert compact_history([test_check_id], now=datetime.now(timezone.utc) + timedelta(days=3)) == 7
+    assert load_check_history(test_check_id)[-1]["summary"]["count"] == 8
+    with _registry_lock:
+        _registry[test_check_id] = {"id": test_check_id, "history_retention": {"max_entries": 2}}
+    compact_history([test_check_id])
+    with _registry_lock:
+        _registry.pop(test_check_id)
+    assert len(load_check_history(test_check_id)) == 2, "max_entries must trim the oldest entries"
 
-    # Тестирование checks.json (остальная часть теста)
-    original_checks_file_const = CHECKS_FILE 
-    sample_checks_path = os.path.join(os.path.dirname(CHECKS_FILE), 'sample_checks_for_test.json')
-    
-    original_checks_content = None
-    if os.path.exists(original_checks_file_const):
-        try:
-            with open(original_checks_file_const, 'r', encoding='utf-8') as f_orig:
-                original_checks_content = f_orig.read()
-            logging.info(f"Backed up content of {original_checks_file_const}")
-        except Exception as e:
-            logging.error(f"Could not back up {original_checks_file_const}: {e}")
+    # Однакові значення зберігаються одним (стиснутим) blob, GC прибирає значення без посилань
+    big_value = "Великий блок тексту. " * 100
+    for blob_check_id in (test_check_id, "blob-check-2"):
+        save_check_history_entry(blob_check_id, {"timestamp": datetime.now(timezone.utc).isoformat(), "status": "changed",
+                                                 "extracted_value": big_value, "content_hash": "big", "error_message": None})
+    flush_history()
+    blob_stats = get_history_blob_stats()
+    logging.info(f"History blob stats: {blob_stats}")
+    assert load_check_history("blob-check-2")[0]["extracted_value"] == big_value, "Blob value was not rehydrated"
+    assert get_current_content(test_check_id)["content"] == big_value, "get_current_content must rehydrate the value"
+    assert get_connection().execute("SELECT COUNT(*) FROM history_blobs WHERE size = ?",
+                                    (len(big_value.encode('utf-8')),)).fetchone()[0] == 1, "Equal values must share one blob"
+    assert blob_stats["stored_bytes"] < blob_stats["raw_bytes"], "Large values must be compressed"
+    assert delete_check_history("blob-check-2") and get_current_content(test_check_id)["content"] == big_value, \
+        "Blobs still referenced by other checks must be kept"
+
+    assert delete_check_history(test_check_id) and load_check_history(test_check_id) == [], "History was not deleted"
+    assert get_latest_history_entry(test_check_id) is None, "Deleted history must leave the latest history index"
+    assert get_history_blob_stats()["blobs"] == 1, "Blobs of deleted history must be collected (legacy entry remains)"
 
-    CHECKS_FILE = sample_checks_path 
+    logging.info("Test for data_manager.py (history part) completed successfully.")
 
+    # Тестирование checks (остальная часть теста)
     sample_checks_data = [
         {"id": "check1", "name": "Test Check 1", "url": "http://example.com", "selector": "h1"},
         {"id": "check2", "name": "Test Check 2", "url": "http://example.org", "selector": "title"}
     ]
     save_checks(sample_checks_data)
     loaded_s_checks = load_checks() 
-    logging.info(f"Loaded sample checks from {CHECKS_FILE}: {loaded_s_checks}")
+    logging.info(f"Loaded sample checks from {DB_FILE}: {loaded_s_checks}")
     assert len(loaded_s_checks) == 2, f"Expected 2 sample checks, got {len(loaded_s_checks)}"
-    
-    if os.path.exists(sample_checks_path):
-        try:
-            os.remove(sample_checks_path) 
-            logging.info(f"Removed sample checks file: {sample_checks_path}")
-        except OSError as e:
-            logging.error(f"Error removing sample checks file {sample_checks_path}: {e}")
-    
-    CHECKS_FILE = original_checks_file_const 
-    if original_checks_content is not None:
-        try:
-            os.makedirs(os.path.dirname(CHECKS_FILE), exist_ok=True)
-            with open(CHECKS_FILE, 'w', encoding='utf-8') as f_orig_write:
-                f_orig_write.write(original_checks_content)
-            logging.info(f"Restored original checks file: {CHECKS_FILE}")
-        except Exception as e:
-            logging.error(f"Could not restore {CHECKS_FILE}: {e}")
+    assert get_check_by_id("check2")["selector"] == "title", "get_check_by_id returned wrong check"
+    assert get_check_by_id("legacy1") is None, "Checks missing from the saved list must be deleted"
+
+    # Транзакції однієї перевірки виконуються послідовно - паралельні інкременти не губляться
+    def increment_counter():
+        for _ in range(50):
+            with check_transaction("check1") as check:
+                check["counter"] = check.get("counter", 0) + 1
+                check["last_result"] = f"run {check['counter']}"
+    workers = [threading.Thread(target=increment_counter) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert get_check_by_id("check1")["counter"] == 200, "Concurrent transactions lost updates"
+    assert get_check_by_id("check1")["last_result"] == "run 200", "Runtime state must be updated by the transaction"
+    try:
+        with check_transaction("check1") as check:
+            check["counter"] = -1
+            raise ValueError("rollback")
+    except ValueError:
+        pass
+    assert get_check_by_id("check1")["counter"] == 200, "Failed transactions must not write changes"
+
+    bulk_checks = add_checks([{"url": f"http://bulk{i}.example.com", "interval": 5} for i in range(3)])
+    assert [c['id'] for c in list(iter_checks())[-3:]] == [c['id'] for c in bulk_checks], "Bulk checks must be appended in order"
+    for bulk_check in bulk_checks:
+        delete_check(bulk_check['id'])
+
+    # Реєстр у пам'яті: зміни потрапляють у базу після flush_checks і переживають перезавантаження
+    save_check({"id": "check3", "name": "Test Check 3", "url": "http://example.net", "selector": "p"})
+    flush_checks()
+    reset_registry()
+    assert [c['id'] for c in load_checks()] == ["check1", "check2", "check3"], "Registry was not persisted in order"
+    assert get_check_by_id("legacy1") is None, "Deleted check came back from the database"
+
+    # Стан виконання зберігається окремо і не перезаписується застарілою копією конфігурації
+    stale_copy = get_check_by_id("check3")
+    update_check_state("check3", {"last_result": "changed", "last_checked_at": "2024-01-02T00:00:00+00:00"})
+    stale_copy["name"] = "Renamed"
+    save_check(stale_copy)
+    flush_checks()
+    reset_registry()
+    merged = get_check_by_id("check3")
+    assert merged["name"] == "Renamed" and merged["last_result"] == "changed", f"Runtime state was lost: {merged}"
+    stored_config = json.loads(get_connection().execute("SELECT data FROM checks WHERE id = 'check3'").fetchone()['data'])
+    assert "last_result" not in stored_config, "Runtime fields must not be stored with the config"
+    assert delete_check("check3") and get_check_by_id("check3") is None, "Check was not deleted"
+
+    # Пакет, який не вдалося записати, повторюється; flush() до успішного запису повертає False
+    HISTORY_RETRY_BASE_SECONDS = 0.05
+    real_insert_history = _insert_history
+    def _insert_history(conn, entries):
+        raise sqlite3.OperationalError("database is locked")
+    save_check_history_entry("retry-check", {"timestamp": datetime.now(timezone.utc).isoformat(), "status": "changed",
+                                             "extracted_value": "kept", "content_hash": "h1", "error_message": None})
+    assert not flush_history(timeout=2), "flush must report a failed write"
+    assert get_history_writer_stats()["last_error"] == "database is locked"
+    _insert_history = real_insert_history
+    assert flush_history(timeout=5), "Failed batch must be retried"
+    assert [e["extracted_value"] for e in load_check_history("retry-check")] == ["kept"], "Failed batch was lost"
+    assert get_history_writer_stats()["consecutive_failures"] == 0
+
+    # Версія сховища змінюється при зміні стану та запису історії, але не при читанні
+    store_version = get_store_version()
+    load_checks()
+    get_latest_history_entries()
+    assert get_store_version() == store_version, "Reads must not change the store version"
+    update_check_state("check1", {"last_result": "no_change"})
+    assert get_store_version() != store_version, "State updates must change the store version"
+    store_version = get_store_version()
+    save_check_history_entry("check1", {"timestamp": datetime.now(timezone.utc).isoformat(), "status": "no_change",
+                                        "extracted_value": "v", "content_hash": "h", "error_message": None})
+    assert get_store_version() != store_version, "History writes must change the store version"
+
+    flush_checks()
+    close_connection()
+    import shutil
+    shutil.rmtree(test_dir, ignore_errors=True)
             
     logging.info("All tests for data_manager.py passed.")
-
@@ -0,0 +1,363 @@
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+# Кількість пакетів, що виконуються одночасно (кожен пакет має власну конкурентність у monitor_engine)
+DISPATCHER_WORKERS = int(os.getenv('MONITOR_DISPATCHER_WORKERS', 2))
+# Максимальна кількість перевірок в одному пакеті
+DISPATCH_BATCH_SIZE = int(os.getenv('MONITOR_DISPATCH_BATCH_SIZE', 50))
+# Вікно об'єднання (секунди): разом із простроченими забираються перевірки, що настануть у межах вікна
+DISPATCH_WINDOW_SECONDS = float(os.getenv('MONITOR_COALESCE_WINDOW_SECONDS', 2))
+# Випадковий зсув кожного запуску (секунди, 0 - вимкнено); не більше чверті інтервалу перевірки
+SCHEDULE_JITTER_SECONDS = float(os.getenv('MONITOR_SCHEDULE_JITTER_SECONDS', 0))
+
+def _hash_fraction(*parts):
+    """Детерміноване число з [0, 1) від частин ключа."""
+    digest = hashlib.blake2b('|'.join(str(part) for part in parts).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+def get_phase_offset(phase_key, interval_seconds):
+    """
+    Детермінований зсув фази перевірки в межах інтервалу (хеш від ключа фази та інтервалу).
+    Ключ фази - нормалізований URL перевірки: перевірки однієї сторінки з однаковим інтервалом
+    запускаються одночасно і потрапляють в один пакет (одне завантаження сторінки),
+    різні сторінки рівномірно розподіляються в часі, а фаза не змінюється між перезапусками.
+    """
+    return _hash_fraction(phase_key, interval_seconds) * interval_seconds
+
+def get_next_phase_time(phase_key, interval_seconds, now=None):
+    """Найближчий момент після now (timestamp), що відповідає фазі перевірки."""
+    now = time.time() if now is None else now
+    offset = get_phase_offset(phase_key, interval_seconds)
+    periods = (now - offset) // interval_seconds + 1
+    return periods * interval_seconds + offset
+
+class DispatcherJob:
+    """
+    Запланована перевірка в диспетчері.
+    Атрибути сумісні з Job з APScheduler, які використовує застосунок
+    (id, name, next_run_time, func, args, trigger).
+    """
+
+    def __init__(self, job_id, name, interval_seconds, func, phase_key=None):
+        self.id = job_id
+        self.name = name
+        self.phase_key = phase_key or job_id  # задачі з однаковим ключем мають спільну фазу та jitter
+        self.interval_seconds = interval_seconds
+        self.func = func
+        self.args = [job_id]
+        self.next_run_time = None  # datetime (UTC); None - задачу призупинено
+        self.base_run_ts = None  # запланований момент без jitter, від нього рахується наступний запуск
+        self.generation = 0  # записи купи зі старим поколінням ігноруються
+
+    @property
+    def trigger(self):
+        return f"interval[{timedelta(seconds=self.interval_seconds)}]"
+
+    def __repr__(self):
+        return f"<DispatcherJob (id={self.id} name={self.name} trigger={self.trigger})>"
+
+class CheckDispatcher:
+    """
+    Диспетчер перевірок: купа (next_run, job_id) та обмежений пул виконавців.
+    Потік диспетчера забирає всі перевірки, що настали, пакетами до DISPATCH_BATCH_SIZE
+    і передає їх batch_handler(check_ids) у пул з DISPATCHER_WORKERS потоків.
+    Поки всі виконавці зайняті, перевірки чекають у купі (це і є глибина черги).
+    """
+
+    def __init__(self, batch_handler, max_workers=None, max_batch_size=None, window_seconds=None, jitter_seconds=None):
+        self.batch_handler = batch_handler
+        self.max_workers = max(1, max_workers or DISPATCHER_WORKERS)
+        self.max_batch_size = max(1, max_batch_size or DISPATCH_BATCH_SIZE)
+        self.window_seconds = DISPATCH_WINDOW_SECONDS if window_seconds is None else window_seconds
+        self.jitter_seconds = SCHEDULE_JITTER_SECONDS if jitter_seconds is None else jitter_seconds
+
+        self._jobs = {}  # job_id -> DispatcherJob
+        self._heap = []  # (next_run_ts, seq, job_id, generation)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._in_flight = set()  # перевірки, що зараз виконуються (не більше одного запуску на перевірку)
+        self._active_batches = 0
+        self._executor = None
+        self._thread = None
+        self._running = False
+        self._paused = False
+
+        self._metrics = {
+            "dispatched_batches": 0,
+            "dispatched_checks": 0,
+            "skipped_overlapping": 0,
+            "failed_batches": 0,
+            "last_batch_size": 0,
+            "last_dispatch_lag_seconds": 0.0,
+            "max_dispatch_lag_seconds": 0.0,
+            "total_dispatch_lag_seconds": 0.0
+        }
+
+    # --- Керування життєвим циклом (як у BackgroundScheduler) ---
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, paused=False):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._paused = paused
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="check-dispatch")
+            self._thread = threading.Thread(target=self._run_loop, name="check-dispatcher", daemon=True)
+            self._thread.start()
+        logging.info(f"Dispatcher: Started with {self.max_workers} workers, batch size {self.max_batch_size}")
+
+    def shutdown(self, wait=True):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+        logging.info("Dispatcher: Shut down")
+
+    def pause(self):
+        with self._cond:
+            self._paused = True
+
+    def resume(self):
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+
+    # --- Керування задачами ---
+
+    def add_job(self, job_id, interval_minutes, name=None, first_run_time=None, phase_key=None):
+        """
+        Додає або замінює задачу. Перший запуск - у найближчий момент фази перевірки
+        (get_next_phase_time від phase_key, за замовчуванням - від id) або в first_run_time.
+        """
+        interval_seconds = float(interval_minutes) * 60
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                job = DispatcherJob(job_id, name or job_id, interval_seconds, self.batch_handler, phase_key)
+                self._jobs[job_id] = job
+            else:
+                job.name = name or job.name
+                job.interval_seconds = interval_seconds
+                job.phase_key = phase_key or job_id
+            if first_run_time is None:
+                first_run_ts = get_next_phase_time(job.phase_key, interval_seconds)
+            else:
+                first_run_ts = first_run_time.timestamp()
+            self._schedule(job, first_run_ts)
+            return job
+
+    def add_jobs(self, jobs):
+        """Додає кілька задач [(job_id, interval_minutes, name, phase_key)] за одне захоплення блокування."""
+        with self._cond:
+            return [self.add_job(job_id, interval_minutes, name=name, phase_key=phase_key)
+                    for job_id, interval_minutes, name, phase_key in jobs]
+
+    def get_job(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def get_jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def remove_job(self, job_id):
+        with self._cond:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                raise KeyError(job_id)
+            job.generation += 1
+
+    def pause_job(self, job_id):
+        with self._cond:
+            job = self._jobs[job_id]
+            job.generation += 1
+            job.next_run_time = None
+
+    def resume_job(self, job_id):
+        with self._cond:
+            job = self._jobs[job_id]
+            if job.next_run_time is None:
+                self._schedule(job, get_next_phase_time(job.phase_key, job.interval_seconds))
+
+    def _schedule(self, job, base_ts):
+        """
+        Ставить задачу в купу на base_ts (+ jitter). Викликається під self._cond.
+        Jitter - хеш від ключа фази та base_ts: змінюється від запуску до запуску,
+        але однаковий для всіх перевірок однієї сторінки, тож він не розводить їх по різних пакетах.
+        """
+        run_ts = base_ts
+        jitter = min(self.jitter_seconds, job.interval_seconds / 4)
+        if jitter > 0:
+            run_ts += _hash_fraction(job.phase_key, job.interval_seconds, base_ts) * jitter
+        job.generation += 1
+        job.base_run_ts = base_ts
+        job.next_run_time = datetime.fromtimestamp(run_ts, timezone.utc)
+        heapq.heappush(self._heap, (run_ts, next(self._seq), job.id, job.generation))
+        self._cond.notify_all()
+
+    def _is_current(self, entry):
+        run_ts, _, job_id, generation = entry
+        job = self._jobs.get(job_id)
+        return job is not None and job.generation == generation
+
+    # --- Цикл диспетчера ---
+
+    def _run_loop(self):
+        while True:
+            with self._cond:
+                batch = None
+                while self._running:
+                    # Прибираємо записи видалених / перепланованих задач
+                    while self._heap and not self._is_current(self._heap[0]):
+                        heapq.heappop(self._heap)
+
+                    if self._paused or not self._heap:
+                        self._cond.wait()
+                        continue
+                    if self._active_batches >= self.max_workers:
+                        self._cond.wait()
+                        continue
+
+                    now = time.time()
+                    delay = self._heap[0][0] - now
+                    if delay > 0:
+                        self._cond.wait(timeout=delay)
+                        continue
+
+                    batch = self._pop_due_batch(now)
+                    if batch:
+                        break
+                if not self._running:
+                    return
+
+                self._active_batches += 1
+                self._in_flight.update(batch)
+
+            try:
+                self._executor.submit(self._run_batch, batch)
+            except RuntimeError as e:
+                logging.error(f"Dispatcher: Could not submit batch: {e}")
+                self._finish_batch(batch)
+                return
+
+    def _pop_due_batch(self, now):
+        """Забирає з купи перевірки, що настали (з урахуванням вікна), та переплановує їх."""
+        batch = []
+        while self._heap and len(batch) < self.max_batch_size:
+            entry = self._heap[0]
+            if not self._is_current(entry):
+                heapq.heappop(self._heap)
+                continue
+            run_ts, _, job_id, _ = entry
+            if run_ts > now + self.window_seconds:
+                break
+            heapq.heappop(self._heap)
+            job = self._jobs[job_id]
+
+            # Наступний запуск зберігає фазу; пропущені запуски об'єднуються в один
+            next_ts = job.base_run_ts + job.interval_seconds
+            if next_ts <= now:
+                missed = int((now - next_ts) // job.interval_seconds) + 1
+                next_ts += missed * job.interval_seconds
+            self._schedule(job, next_ts)
+
+            if job_id in self._in_flight:
+                # Попередній запуск ще триває - цей пропускаємо
+                self._metrics["skipped_overlapping"] += 1
+                continue
+
+            lag = max(now - run_ts, 0.0)
+            self._metrics["last_dispatch_lag_seconds"] = round(lag, 3)
+            self._metrics["max_dispatch_lag_seconds"] = round(max(self._metrics["max_dispatch_lag_seconds"], lag), 3)
+            self._metrics["total_dispatch_lag_seconds"] += lag
+            batch.append(job_id)
+
+        if batch:
+            self._metrics["dispatched_batches"] += 1
+            self._metrics["dispatched_checks"] += len(batch)
+            self._metrics["last_batch_size"] = len(batch)
+        return batch
+
+    def _run_batch(self, check_ids):
+        try:
+            logging.info(f"Dispatcher: Running batch of {len(check_ids)} checks")
+            self.batch_handler(check_ids)
+        except Exception as e:
+            with self._cond:
+                self._metrics["failed_batches"] += 1
+            logging.error(f"Dispatcher: Error in batch of {len(check_ids)} checks: {e}", exc_info=True)
+        finally:
+            self._finish_batch(check_ids)
+
+    def _finish_batch(self, check_ids):
+        with self._cond:
+            self._active_batches -= 1
+            self._in_flight.difference_update(check_ids)
+            self._cond.notify_all()
+
+    # --- Метрики ---
+
+    def get_metrics(self):
+        """Глибина черги, затримка диспетчеризації та лічильники пакетів."""
+        with self._cond:
+            now = time.time()
+            due = [entry for entry in self._heap if entry[0] <= now and self._is_current(entry)]
+            oldest_due_lag = now - min(entry[0] for entry in due) if due else 0.0
+            dispatched = self._metrics["dispatched_checks"]
+            metrics = dict(self._metrics)
+            total_lag = metrics.pop("total_dispatch_lag_seconds")
+            metrics.update({
+                "running": self._running,
+                "paused": self._paused,
+                "scheduled_jobs": len(self._jobs),
+                "queue_depth": len(due),
+                "oldest_due_lag_seconds": round(oldest_due_lag, 3),
+                "in_flight_checks": len(self._in_flight),
+                "active_batches": self._active_batches,
+                "max_workers": self.max_workers,
+                "max_batch_size": self.max_batch_size,
+                "jitter_seconds": self.jitter_seconds,
+                "avg_dispatch_lag_seconds": round(total_lag / dispatched, 3) if dispatched else 0.0
+            })
+            return metrics
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+
+    # Перевірки однієї сторінки (спільний ключ фази) з однаковим інтервалом потрапляють в один пакет навіть з jitter
+    batches = []
+    test_dispatcher = CheckDispatcher(lambda check_ids: batches.append(sorted(check_ids)),
+                                      window_seconds=0.5, jitter_seconds=2)
+    test_dispatcher.start()
+    try:
+        for job_id, phase_key in (("same-1", "https://example.com/a"), ("same-2", "https://example.com/a"),
+                                  ("other", "https://example.com/b")):
+            test_dispatcher.add_job(job_id, 0.1, phase_key=phase_key)
+        same_jobs = [test_dispatcher.get_job("same-1"), test_dispatcher.get_job("same-2")]
+        assert same_jobs[0].next_run_time == same_jobs[1].next_run_time, "Same-URL checks must share phase and jitter"
+        deadline = time.time() + 15
+        while time.time() < deadline and not any("same-1" in batch for batch in batches):
+            time.sleep(0.1)
+        time.sleep(0.2)
+        logging.info(f"Dispatched batches: {batches}")
+        batch = next(batch for batch in batches if "same-1" in batch)
+        assert "same-2" in batch, "Same-URL checks must be dispatched in one batch"
+        logging.info("All tests for dispatcher.py passed.")
+    finally:
+        test_dispatcher.shutdown()
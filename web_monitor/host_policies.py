@@ -0,0 +1,481 @@
+import asyncio
+import json
+import os
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Файл політик хостів: {"default": {...}, "example.com": {"rate_per_second": 0.5, "burst": 1, "max_in_flight": 1}}
+HOST_POLICY_FILE = 'data/host_policies.json'
+
+# Політика за замовчуванням для хостів без окремих налаштувань
+DEFAULT_HOST_POLICY = {
+    "rate_per_second": float(os.getenv('MONITOR_HOST_RATE_PER_SECOND', 1.0)),
+    "burst": int(os.getenv('MONITOR_HOST_BURST', 3)),
+    "max_in_flight": int(os.getenv('MONITOR_HOST_MAX_IN_FLIGHT', 2))
+}
+
+# Як часто (секунди) пакетний запуск перепитує лімітер, поки всі слоти хоста зайняті
+HOST_SLOT_POLL_SECONDS = 0.05
+
+# Верхня межа паузи за заголовком Retry-After (секунд), щоб не тримати черги годинами
+MAX_RETRY_AFTER_SECONDS = int(os.getenv('MONITOR_MAX_RETRY_AFTER_SECONDS', 300))
+
+# Запобіжник (circuit breaker) хоста: після N помилок з'єднання/таймаутів поспіль
+# перевірки хоста одразу завершуються статусом 'circuit_open', а пробні запити
+# виконуються з експоненційною затримкою
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('MONITOR_CIRCUIT_FAILURE_THRESHOLD', 3))
+CIRCUIT_BASE_COOLDOWN_SECONDS = int(os.getenv('MONITOR_CIRCUIT_BASE_COOLDOWN_SECONDS', 60))
+CIRCUIT_MAX_COOLDOWN_SECONDS = int(os.getenv('MONITOR_CIRCUIT_MAX_COOLDOWN_SECONDS', 3600))
+
+_policy_file_cache = {"mtime": None, "policies": {}}
+_policy_file_lock = threading.Lock()
+
+_limiters = {}  # хост -> HostLimiter (один на хост, лише політика хоста)
+_check_limiters = {}  # "хост політика" -> HostLimiter власної політики перевірки (додатковий до лімітера хоста)
+_limiters_lock = threading.Lock()
+
+_breakers = {}  # host -> CircuitBreaker
+_breakers_lock = threading.Lock()
+
+def get_host(url):
+    """Повертає хост (netloc у нижньому регістрі), за яким застосовуються ліміти."""
+    return urlsplit(url).netloc.lower()
+
+def load_host_policies():
+    """Завантажує політики хостів з HOST_POLICY_FILE (перечитує файл лише після його зміни)."""
+    if not os.path.exists(HOST_POLICY_FILE):
+        return {}
+    try:
+        mtime = os.path.getmtime(HOST_POLICY_FILE)
+        with _policy_file_lock:
+            if _policy_file_cache["mtime"] != mtime:
+                with open(HOST_POLICY_FILE, 'r', encoding='utf-8') as f:
+                    _policy_file_cache["policies"] = json.load(f)
+                _policy_file_cache["mtime"] = mtime
+                logging.info(f"Host policies loaded from {HOST_POLICY_FILE}: {len(_policy_file_cache['policies'])} entries")
+            return _policy_file_cache["policies"]
+    except (IOError, json.JSONDecodeError) as e:
+        logging.error(f"Error loading host policies from {HOST_POLICY_FILE}: {e}")
+        return {}
+
+def validate_host_policy(policy):
+    """Повертає текст помилки для некоректного 'host_policy' перевірки або None."""
+    if policy is None:
+        return None
+    if not isinstance(policy, dict) or set(policy) - set(DEFAULT_HOST_POLICY):
+        return f"host_policy must be an object with keys: {', '.join(DEFAULT_HOST_POLICY)}"
+    for key, value in policy.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            return f"host_policy.{key} must be a positive number"
+        if key != "rate_per_second" and value != int(value):
+            return f"host_policy.{key} must be a positive integer"
+    return None
+
+def _check_policy_override(check_config):
+    """Власна політика перевірки ('host_policy') або None; некоректна політика ігнорується."""
+    override = check_config.get('host_policy') if check_config else None
+    if not override:
+        return None
+    error = validate_host_policy(override)
+    if error:
+        logging.warning(f"Ignoring invalid host_policy of check {check_config.get('id')}: {error}")
+        return None
+    return override
+
+def get_host_policy(url, check_config=None):
+    """
+    Повертає політику для хоста URL: значення за замовчуванням,
+    перекриті секцією 'default' та секцією хоста з файлу, а потім полем 'host_policy' перевірки.
+    """
+    policies = load_host_policies()
+    policy = dict(DEFAULT_HOST_POLICY)
+    policy.update(policies.get("default", {}))
+    policy.update(policies.get(get_host(url), {}))
+    override = _check_policy_override(check_config)
+    if override:
+        policy.update(override)
+    return policy
+
+class HostLimiter:
+    """
+    Ліміти ввічливості для одного хоста: token bucket (rate_per_second, burst)
+    та максимальна кількість одночасних запитів (max_in_flight).
+    Запити чекають у черзі, а не завершуються помилкою.
+    """
+
+    def __init__(self, host, policy, key=None):
+        self.host = host
+        self.key = key or host
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._blocked_until = 0.0
+        self._updated_at = time.monotonic()
+        self.configure(policy)
+        self._tokens = float(self.burst)
+        self.stats = {"acquired": 0, "waited": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0}
+
+    def configure(self, policy):
+        """Застосовує (можливо оновлену) політику хоста."""
+        self.rate_per_second = max(float(policy.get("rate_per_second") or 0), 0.001)
+        self.burst = max(int(policy.get("burst") or 1), 1)
+        self.max_in_flight = max(int(policy.get("max_in_flight") or 1), 1)
+
+    def _refill(self, now):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated_at) * self.rate_per_second)
+        self._updated_at = now
+
+    def _try_take(self):
+        """
+        Забирає слот і токен, якщо можна. Повертає 0, якщо слот отримано, інакше скільки чекати
+        (None - до звільнення слота). Викликається під self._condition.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self._in_flight >= self.max_in_flight:
+            return None
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.rate_per_second
+        self._tokens -= 1
+        self._in_flight += 1
+        return 0
+
+    def _record_wait(self, started):
+        """Оновлює метрики очікування. Викликається під self._condition."""
+        waited = time.monotonic() - started
+        self.stats["acquired"] += 1
+        if waited > 0.001:
+            self.stats["waited"] += 1
+        self.stats["total_wait_seconds"] += waited
+        self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], waited)
+        return waited
+
+    def acquire(self):
+        """Чекає (блокуючи потік) на вільний слот та токен. Повертає час очікування в секундах."""
+        started = time.monotonic()
+        with self._condition:
+            self._waiting += 1
+            try:
+                while True:
+                    delay = self._try_take()
+                    if delay == 0:
+                        break
+                    self._condition.wait(delay)
+            finally:
+                self._waiting -= 1
+            return self._record_wait(started)
+
+    async def acquire_async(self):
+        """
+        Як acquire, але чекає в event loop, не займаючи потік: пакетний запуск отримує слот хоста
+        до того, як перевірка потрапить у спільний пул потоків.
+        """
+        started = time.monotonic()
+        with self._condition:
+            self._waiting += 1
+        try:
+            while True:
+                with self._condition:
+                    delay = self._try_take()
+                    if delay == 0:
+                        return self._record_wait(started)
+                await asyncio.sleep(HOST_SLOT_POLL_SECONDS if delay is None else min(delay, 1.0))
+        finally:
+            with self._condition:
+                self._waiting -= 1
+
+    def release(self):
+        """Звільняє слот одночасного запиту."""
+        with self._condition:
+            self._in_flight = max(self._in_flight - 1, 0)
+            self._condition.notify_all()
+
+    def block_for(self, seconds):
+        """Призупиняє нові запити до хоста (наприклад, за заголовком Retry-After)."""
+        with self._condition:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                **self.stats,
+                "total_wait_seconds": round(self.stats["total_wait_seconds"], 3),
+                "max_wait_seconds": round(self.stats["max_wait_seconds"], 3),
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "blocked_for_seconds": round(max(self._blocked_until - time.monotonic(), 0), 1),
+                "rate_per_second": self.rate_per_second,
+                "burst": self.burst,
+                "max_in_flight": self.max_in_flight
+            }
+
+class CheckLimiter:
+    """
+    Ліміти одного запиту перевірки: лімітер хоста та, якщо перевірка має власний 'host_policy',
+    додатковий лімітер цієї політики. Слоти беруться в обох, тож власна політика може лише
+    посилити обмеження хоста, але не обійти його.
+    """
+
+    def __init__(self, host_limiter, policy_limiter=None):
+        self.host = host_limiter.host
+        self._limiters = [limiter for limiter in (policy_limiter, host_limiter) if limiter is not None]
+
+    def acquire(self):
+        """Чекає на слоти всіх лімітерів (спершу власної політики, потім хоста). Повертає час очікування."""
+        waited = 0.0
+        acquired = []
+        try:
+            for limiter in self._limiters:
+                waited += limiter.acquire()
+                acquired.append(limiter)
+        except BaseException:
+            for limiter in reversed(acquired):
+                limiter.release()
+            raise
+        return waited
+
+    async def acquire_async(self):
+        """Як acquire, але в event loop (див. HostLimiter.acquire_async)."""
+        waited = 0.0
+        acquired = []
+        try:
+            for limiter in self._limiters:
+                waited += await limiter.acquire_async()
+                acquired.append(limiter)
+        except BaseException:
+            for limiter in reversed(acquired):
+                limiter.release()
+            raise
+        return waited
+
+    def release(self):
+        for limiter in reversed(self._limiters):
+            limiter.release()
+
+def get_host_limiter(url):
+    """Повертає єдиний лімітер хоста URL з актуальною політикою хоста."""
+    host = get_host(url)
+    policy = get_host_policy(url)
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter(host, policy)
+            _limiters[host] = limiter
+            return limiter
+    limiter.configure(policy)
+    return limiter
+
+def get_limiter(url, check_config=None):
+    """
+    Повертає лімітер запиту перевірки (CheckLimiter): спільний лімітер хоста і, якщо перевірка має
+    власний 'host_policy', додатковий лімітер цієї політики. Значення власної політики не можуть
+    перевищувати політику хоста, а спільний лімітер хоста від них не змінюється.
+    """
+    host_limiter = get_host_limiter(url)
+    override = _check_policy_override(check_config)
+    if not override:
+        return CheckLimiter(host_limiter)
+
+    host_policy = get_host_policy(url)
+    policy = dict(host_policy)
+    policy.update({key: min(value, host_policy[key]) for key, value in override.items()})
+    key = f"{host_limiter.host} {json.dumps(override, sort_keys=True)}"
+    with _limiters_lock:
+        policy_limiter = _check_limiters.get(key)
+        if policy_limiter is None:
+            policy_limiter = HostLimiter(host_limiter.host, policy, key)
+            _check_limiters[key] = policy_limiter
+        else:
+            policy_limiter.configure(policy)
+    return CheckLimiter(host_limiter, policy_limiter)
+
+@contextmanager
+def host_slot(url, check_config=None):
+    """Контекстний менеджер: чекає на дозвіл лімітера хоста перед запитом і звільняє слот після нього."""
+    limiter = get_limiter(url, check_config)
+    waited = limiter.acquire()
+    if waited > 0.001:
+        logging.info(f"Host limiter: waited {waited:.2f}s for {limiter.host}")
+    try:
+        yield limiter
+    finally:
+        limiter.release()
+
+def note_retry_after(url, retry_after):
+    """Враховує заголовок Retry-After (секунди) у відповіді 429/503 - нові запити до хоста чекають."""
+    try:
+        seconds = float(retry_after)
+    except (TypeError, ValueError):
+        return
+    seconds = min(seconds, MAX_RETRY_AFTER_SECONDS)
+    if seconds > 0:
+        # Усі запити до хоста проходять через його лімітер, тож пауза діє і для перевірок з власною політикою
+        get_host_limiter(url).block_for(seconds)
+        logging.warning(f"Host limiter: {get_host(url)} asked to retry after {seconds:.0f}s")
+
+def get_limiter_stats():
+    """Повертає метрики лімітерів по хостах та сумарний час очікування."""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+        policy_limiters = list(_check_limiters.values())
+    hosts = {limiter.host: limiter.get_stats() for limiter in limiters}
+    return {
+        "hosts": hosts,
+        "check_policies": {limiter.key: limiter.get_stats() for limiter in policy_limiters},
+        "total_wait_seconds": round(sum(h["total_wait_seconds"] for h in hosts.values()), 3),
+        "total_waited_requests": sum(h["waited"] for h in hosts.values()),
+        "default_policy": DEFAULT_HOST_POLICY
+    }
+
+class CircuitBreaker:
+    """
+    Запобіжник одного хоста зі станами closed / open / half_open.
+    closed: запити йдуть як звичайно, рахуються помилки з'єднання поспіль.
+    open: запити відхиляються до retry_at; затримка подвоюється з кожним повторним розмиканням.
+    half_open: пропускається один пробний запит; успіх замикає запобіжник, помилка - розмикає знову.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.trips = 0  # розмикань поспіль, визначає експоненційну затримку
+        self.opened_at = None
+        self.retry_at = 0.0
+        self._probe_in_flight = False
+        self.rejected = 0
+
+    def _cooldown(self):
+        return min(CIRCUIT_BASE_COOLDOWN_SECONDS * (2 ** max(self.trips - 1, 0)), CIRCUIT_MAX_COOLDOWN_SECONDS)
+
+    def _open(self, now):
+        self.trips += 1
+        self.state = "open"
+        self.opened_at = now
+        self.retry_at = now + self._cooldown()
+        self._probe_in_flight = False
+        logging.warning(f"Circuit breaker OPEN for {self.host} after {self.consecutive_failures} consecutive failures. "
+                        f"Next probe in {self._cooldown()}s")
+
+    def allow_request(self):
+        """Повертає True, якщо запит до хоста дозволено (або це пробний запит у стані half_open)."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open" and now >= self.retry_at:
+                self.state = "half_open"
+                logging.info(f"Circuit breaker HALF-OPEN for {self.host}: sending probe request")
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        """Хост відповів - запобіжник замикається."""
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"Circuit breaker CLOSED for {self.host}")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.trips = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        """Помилка з'єднання або таймаут."""
+        with self._lock:
+            self.consecutive_failures += 1
+            now = time.monotonic()
+            if self.state == "half_open":
+                self._open(now)
+            elif self.state == "closed" and self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                self._open(now)
+
+    def retry_in_seconds(self):
+        with self._lock:
+            return max(self.retry_at - time.monotonic(), 0) if self.state != "closed" else 0
+
+    def get_stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "trips": self.trips,
+                "open_for_seconds": round(now - self.opened_at, 1) if self.opened_at else None,
+                "retry_in_seconds": round(max(self.retry_at - now, 0), 1) if self.state != "closed" else 0,
+                "rejected_requests": self.rejected
+            }
+
+def get_circuit_breaker(url):
+    """Повертає запобіжник хоста URL."""
+    host = get_host(url)
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host)
+            _breakers[host] = breaker
+        return breaker
+
+def get_circuit_stats():
+    """Повертає стан запобіжників по хостах (для /api/system-status)."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    hosts = {breaker.host: breaker.get_stats() for breaker in breakers}
+    return {
+        "hosts": hosts,
+        "open_hosts": [host for host, stats in hosts.items() if stats["state"] != "closed"],
+        "failure_threshold": CIRCUIT_FAILURE_THRESHOLD,
+        "base_cooldown_seconds": CIRCUIT_BASE_COOLDOWN_SECONDS,
+        "max_cooldown_seconds": CIRCUIT_MAX_COOLDOWN_SECONDS
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+    HOST_POLICY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', '__no_host_policies__.json')
+    DEFAULT_HOST_POLICY.update({"rate_per_second": 1000.0, "burst": 1000, "max_in_flight": 2})
+
+    # Перевірки з власною політикою та без неї разом не перевищують max_in_flight хоста
+    in_flight = {"host": 0, "strict": 0}
+    peaks = {"host": 0, "strict": 0}
+    counter_lock = threading.Lock()
+    test_configs = [None, {"id": "strict", "host_policy": {"max_in_flight": 1}},
+                    {"id": "loose", "host_policy": {"max_in_flight": 5, "rate_per_second": 5000}}]
+
+    def worker(index):
+        check_config = test_configs[index % len(test_configs)]
+        strict = bool(check_config) and check_config["id"] == "strict"
+        for _ in range(5):
+            with host_slot(f"https://example.com/{index}", check_config):
+                with counter_lock:
+                    in_flight["host"] += 1
+                    in_flight["strict"] += int(strict)
+                    peaks["host"] = max(peaks["host"], in_flight["host"])
+                    peaks["strict"] = max(peaks["strict"], in_flight["strict"])
+                time.sleep(0.01)
+                with counter_lock:
+                    in_flight["host"] -= 1
+                    in_flight["strict"] -= int(strict)
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(12)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    logging.info(f"Peak in-flight requests: {peaks}, limiters: {list(get_limiter_stats()['check_policies'])}")
+    assert peaks["host"] <= 2, "Check policies must not exceed the host max_in_flight"
+    assert peaks["strict"] <= 1, "A stricter check policy must be enforced"
+    assert get_host_limiter("https://example.com/a").max_in_flight == 2, "Check policies must not reconfigure the host limiter"
+    assert _check_limiters["example.com " + json.dumps(test_configs[2]["host_policy"], sort_keys=True)].max_in_flight == 2, \
+        "Check policies must be capped at the host policy"
+    logging.info("All tests for host_policies.py passed.")
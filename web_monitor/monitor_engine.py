@@ -1,7 +1,161 @@
 import requests
 import hashlib
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 import logging
+import os
+import math
+import asyncio
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import urlsplit, urlunsplit
+from requests.adapters import HTTPAdapter
+import host_policies
+
+# Швидкі парсери необов'язкові - використовуються, якщо встановлені
+try:
+    import lxml  # noqa: F401
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+    SELECTOLAX_AVAILABLE = True
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser
+        SELECTOLAX_AVAILABLE = True
+    except ImportError:
+        SELECTOLAX_AVAILABLE = False
+
+# Глобальний ліміт одночасних перевірок: розмір спільного пулу потоків, через який проходять усі пакети
+MAX_CONCURRENT_CHECKS = int(os.getenv('MONITOR_MAX_CONCURRENT_CHECKS', 20))
+
+# Налаштування пулу keep-alive сесій (одна сесія на хост)
+SESSION_POOL_CONNECTIONS = int(os.getenv('MONITOR_SESSION_POOL_CONNECTIONS', 4))
+SESSION_POOL_MAXSIZE = int(os.getenv('MONITOR_SESSION_POOL_MAXSIZE', 10))
+SESSION_IDLE_TIMEOUT = int(os.getenv('MONITOR_SESSION_IDLE_TIMEOUT', 600))  # секунд
+
+# Потокове завантаження: максимальний розмір тіла відповіді (байт); перевірка може
+# перевизначити його полем 'max_body_bytes', а полем 'target_within_kb' - обмежити читання префіксом
+MAX_BODY_BYTES = int(os.getenv('MONITOR_MAX_BODY_BYTES', 5 * 1024 * 1024))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Статуси результату, які означають невдалу перевірку
+ERROR_STATUSES = ("error", "oversized", "circuit_open")
+
+# Бекенди розбору HTML; бекенд задається глобально або полем 'parser' перевірки
+PARSER_BACKENDS = ('html.parser', 'lxml', 'selectolax')
+FALLBACK_PARSER_BACKEND = 'html.parser'
+DEFAULT_PARSER_BACKEND = os.getenv('MONITOR_PARSER_BACKEND', FALLBACK_PARSER_BACKEND)
+
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36 WebMonitorBot/1.0'
+}
+
+_session_pool = {}  # host_key -> {"session": requests.Session, "last_used": float}
+_session_pool_lock = threading.Lock()
+_session_pool_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Спільний пул потоків перевірок (диспетчер, прогрів, примусові перевірки, ручні перевірки)
+_check_executor = None
+_check_executor_lock = threading.Lock()
+_worker_local = threading.local()  # is_check_worker = True у потоках спільного пулу
+
+def get_host_key(url):
+    """Повертає ключ хоста (scheme://netloc) для URL."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+def _create_session():
+    """Створює сесію з налаштованим пулом з'єднань та заголовками за замовчуванням."""
+    session = requests.Session()
+    session.headers.update(REQUEST_HEADERS)
+    adapter = HTTPAdapter(pool_connections=SESSION_POOL_CONNECTIONS, pool_maxsize=SESSION_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def _evict_idle_sessions(now):
+    """Закриває сесії, що простоювали довше за SESSION_IDLE_TIMEOUT. Викликається під _session_pool_lock."""
+    for host_key in [k for k, v in _session_pool.items() if now - v["last_used"] > SESSION_IDLE_TIMEOUT]:
+        entry = _session_pool.pop(host_key)
+        try:
+            entry["session"].close()
+        except Exception as e:
+            logging.warning(f"Error closing idle session for {host_key}: {e}")
+        _session_pool_stats["evictions"] += 1
+        logging.debug(f"Evicted idle HTTP session for {host_key}")
+
+def get_session_for_url(url):
+    """Повертає keep-alive сесію для хоста URL, створюючи її за потреби."""
+    host_key = get_host_key(url)
+    now = time.monotonic()
+    with _session_pool_lock:
+        _evict_idle_sessions(now)
+        entry = _session_pool.get(host_key)
+        if entry:
+            _session_pool_stats["hits"] += 1
+        else:
+            _session_pool_stats["misses"] += 1
+            entry = {"session": _create_session(), "last_used": now}
+            _session_pool[host_key] = entry
+        entry["last_used"] = now
+        return entry["session"]
+
+def get_session_pool_stats():
+    """Повертає лічильники пулу сесій (hits/misses/evictions) та кількість відкритих сесій."""
+    with _session_pool_lock:
+        return {
+            **_session_pool_stats,
+            "open_sessions": len(_session_pool),
+            "hosts": sorted(_session_pool.keys()),
+            "pool_connections": SESSION_POOL_CONNECTIONS,
+            "pool_maxsize": SESSION_POOL_MAXSIZE,
+            "idle_timeout_seconds": SESSION_IDLE_TIMEOUT
+        }
+
+def close_all_sessions():
+    """Закриває всі сесії пулу."""
+    with _session_pool_lock:
+        for entry in _session_pool.values():
+            try:
+                entry["session"].close()
+            except Exception:
+                pass
+        _session_pool.clear()
+
+atexit.register(close_all_sessions)
+
+def _mark_check_worker():
+    """Ініціалізатор потоків спільного пулу (див. is_check_worker)."""
+    _worker_local.is_check_worker = True
+
+def is_check_worker():
+    """True, якщо поточний потік належить спільному пулу перевірок (не залежить від назви потоку)."""
+    return getattr(_worker_local, 'is_check_worker', False)
+
+def get_check_executor():
+    """
+    Пул потоків перевірок, спільний для всіх пакетів: одночасно виконується не більше MAX_CONCURRENT_CHECKS
+    завантажень, скільки б пакетів (диспетчер, прогрів, примусові перевірки) не працювало паралельно.
+    """
+    global _check_executor
+    with _check_executor_lock:
+        if _check_executor is None:
+            _check_executor = ThreadPoolExecutor(max_workers=max(1, MAX_CONCURRENT_CHECKS), thread_name_prefix="check-worker",
+                                                 initializer=_mark_check_worker)
+        return _check_executor
+
+def _shutdown_check_executor():
+    with _check_executor_lock:
+        if _check_executor is not None:
+            _check_executor.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(_shutdown_check_executor)
 
 # Настройка логування (якщо ще не налаштовано глобально)
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,75 +177,135 @@ def get_content_hash_from_element(element):
     content_hash = hashlib.md5(text_content.encode('utf-8')).hexdigest()
     return text_content, content_hash
 
-def perform_check(check_id, name, url, selector, last_hash):
+class _SelectolaxElement:
     """
-    Выполняет проверку веб-страницы.
-    Возвращает кортеж: (status, new_hash, extracted_text, error_message)
-    status: 'changed', 'no_change', 'error'
-    new_hash: MD5 хеш текущего контента или None в случае ошибки
-    extracted_text: извлеченный текст или None в случае ошибки
-    error_message: сообщение об ошибке или None
+    Обгортка над вузлом selectolax з get_text() у семантиці BeautifulSoup:
+    текстові вузли без script/style/template та коментарів, кожен обрізаний, порожні пропускаються.
+    """
+    _SKIPPED_PARENTS = ('script', 'style', 'template')
+
+    def __init__(self, node):
+        self.node = node
+
+    def get_text(self, separator='', strip=False):
+        parts = []
+        for text_node in self.node.traverse(include_text=True):
+            if text_node.tag != '-text':
+                continue
+            if text_node.parent is not None and text_node.parent.tag in self._SKIPPED_PARENTS:
+                continue
+            value = text_node.text_content or ''
+            if strip:
+                value = value.strip()
+                if not value:
+                    continue
+            parts.append(value)
+        return separator.join(parts)
+
+def get_available_parser_backends():
+    """Повертає список бекендів розбору, доступних у поточному середовищі."""
+    available = ['html.parser']
+    if LXML_AVAILABLE:
+        available.append('lxml')
+    if SELECTOLAX_AVAILABLE:
+        available.append('selectolax')
+    return available
+
+def resolve_parser_backend(backend=None):
+    """Повертає бекенд, який буде використано: заданий, глобальний або резервний, якщо заданий недоступний."""
+    backend = backend or DEFAULT_PARSER_BACKEND
+    if backend not in get_available_parser_backends():
+        logging.warning(f"Parser backend '{backend}' is not available. Falling back to '{FALLBACK_PARSER_BACKEND}'")
+        return FALLBACK_PARSER_BACKEND
+    return backend
+
+def parse_document(body, backend):
+    """Розбирає сирі байти сторінки вказаним бекендом."""
+    if backend == 'selectolax':
+        # Кодування визначаємо так само, як BeautifulSoup, щоб текст збігався між бекендами
+        return SelectolaxParser(UnicodeDammit(body, is_html=True).unicode_markup or '')
+    return BeautifulSoup(body, backend)
+
+def select_element(document, backend, selector):
+    """Повертає перший елемент за CSS-селектором (з методом get_text) або None."""
+    if backend == 'selectolax':
+        node = document.css_first(selector)
+        return _SelectolaxElement(node) if node is not None else None
+    return document.select_one(selector)
+
+def _select_with_fallback(documents, body, backend, selector, check_id):
+    """
+    Знаходить елемент бекендом перевірки, розбираючи документ один раз на бекенд.
+    Якщо бекенд не впорався із селектором, повторює пошук резервним html.parser.
+    """
+    def get_document(name):
+        if name not in documents:
+            documents[name] = parse_document(body, name)
+        return documents[name]
+
+    if backend != FALLBACK_PARSER_BACKEND:
+        try:
+            element = select_element(get_document(backend), backend, selector)
+            if element is not None:
+                return element
+            logging.debug(f"Parser backend '{backend}' found nothing for selector '{selector}' (ID: {check_id}). Retrying with '{FALLBACK_PARSER_BACKEND}'")
+        except Exception as e:
+            logging.warning(f"Parser backend '{backend}' failed on selector '{selector}' (ID: {check_id}): {e}. Falling back to '{FALLBACK_PARSER_BACKEND}'")
+
+    return select_element(get_document(FALLBACK_PARSER_BACKEND), FALLBACK_PARSER_BACKEND, selector)
+
+def get_fetch_state(check_config):
+    """
+    Повертає стан HTTP-кешу перевірки (валідатори ETag / Last-Modified та хеш сирого тіла) для perform_check.
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36 WebMonitorBot/1.0'
+    return {
+        "etag": check_config.get('http_etag'),
+        "last_modified": check_config.get('http_last_modified'),
+        "body_hash": check_config.get('last_body_hash')
     }
-    
-    status = "error" # Default status
-    current_hash = None
-    extracted_text = None
-    error_message = None
 
-    try:
-        logging.info(f"Performing check for '{name}' (ID: {check_id}), URL: {url}, Selector: {selector}")
-        
-        # ВИПРАВЛЕНО: Збільшуємо timeout та додаємо більше параметрів
-        response = requests.get(
-            url, 
-            headers=headers, 
-            timeout=(10, 30),  # (connection timeout, read timeout) 
-            allow_redirects=True,
-            verify=True  # Перевіряємо SSL сертифікати
-        )
-        response.raise_for_status() # Вызовет исключение для плохих ответов (4xx, 5xx)
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        selected_element = soup.select_one(selector)
-
-        if not selected_element:
-            error_message = f"Element not found with selector: '{selector}'"
-            logging.warning(f"{error_message} for '{name}' (ID: {check_id}) on URL {url}")
-            return status, current_hash, extracted_text, error_message
-
-        extracted_text, current_hash = get_content_hash_from_element(selected_element)
-        
-        # ВИПРАВЛЕНО: Детальне логування для діагностики
-        logging.info(f"Check for '{name}' (ID: {check_id}:")
-        logging.info(f"  Extracted text: '{extracted_text}'")
-        logging.info(f"  Current hash: '{current_hash}'")
-        logging.info(f"  Last hash: '{last_hash}'")
-        logging.info(f"  Hash comparison: current==last -> {current_hash == last_hash}")
-
-        if last_hash is None: # Перша перевірка для цього елемента
-            status = "changed" # Считаем первой проверкой как изменение
-            logging.info(f"First check for '{name}' (ID: {check_id}). Status: {status}. Hash: {current_hash}")
-        elif current_hash == last_hash:
-            status = "no_change"
-            logging.info(f"No change detected for '{name}' (ID: {check_id}). Status: {status}. Hash unchanged: {current_hash}")
-        else:
-            status = "changed"
-            logging.info(f"Change detected for '{name}' (ID: {check_id}). Status: {status}. Old hash: {last_hash}, New hash: {current_hash}")
-        
-        # ДОДАНО: Додаткова перевірка для діагностики
-        if status == "changed" and last_hash is not None and extracted_text:
-            logging.info(f"CHANGE ANALYSIS for '{name}' (ID: {check_id}:")
-            logging.info(f"  Text length: {len(extracted_text)} chars")
-            logging.info(f"  Text content: '{extracted_text[:100]}{'...' if len(extracted_text) > 100 else ''}'")
-            
-        # error_message остается None, так как ошибок не было на этом этапе
-        return status, current_hash, extracted_text, error_message
+def get_body_hash(body):
+    """Швидкий BLAKE2 хеш сирих байтів відповіді (для пропуску розбору незмінних сторінок)."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+def _update_fetch_state(fetch_state, response, body_hash):
+    """Запам'ятовує валідатори та хеш тіла успішної відповіді для наступної перевірки."""
+    if fetch_state is None:
+        return
+    fetch_state["etag"] = response.headers.get('ETag')
+    fetch_state["last_modified"] = response.headers.get('Last-Modified')
+    fetch_state["body_hash"] = body_hash
+
+def _build_conditional_headers(last_hash, fetch_state):
+    """Формує заголовки умовного GET, якщо є попередній хеш та збережені валідатори."""
+    headers = {}
+    if last_hash is None or not fetch_state:
+        return headers
+    if fetch_state.get("etag"):
+        headers['If-None-Match'] = fetch_state["etag"]
+    if fetch_state.get("last_modified"):
+        headers['If-Modified-Since'] = fetch_state["last_modified"]
+    return headers
 
+def normalize_url(url):
+    """
+    Нормалізує URL для групування перевірок однієї сторінки:
+    нижній регістр схеми та хоста, без порту за замовчуванням і без фрагмента.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+def _request_error_message(e, check_id, name, url):
+    """
+    Формує повідомлення про помилку запиту/обробки та логує її.
+    Викликається з блоку except.
+    """
     # ВИПРАВЛЕНО: Детальна обробка різних типів помилок мережі
-    except requests.exceptions.Timeout as e:
+    if isinstance(e, requests.exceptions.Timeout):
         if "Read timed out" in str(e):
             error_message = f"Сервер '{url}' не відповідає (timeout через {30}с). Можливо сайт перевантажений або недоступний."
         elif "Connection timeout" in str(e):
@@ -99,15 +313,20 @@ def perform_check(check_id, name, url, selector, last_hash):
         else:
             error_message = f"Timeout при підключенні до '{url}': {str(e)}"
         logging.warning(f"TIMEOUT ERROR for '{name}' (ID: {check_id}): {error_message}")
-        return status, None, None, error_message
-        
-    except requests.exceptions.ConnectionError as e:
+
+    elif isinstance(e, requests.exceptions.SSLError):
+        error_message = f"Помилка SSL сертифікату для '{url}': сертифікат недійсний або застарілий"
+        logging.error(f"SSL ERROR for '{name}' (ID: {check_id}): {error_message} | Details: {str(e)}")
+
+    elif isinstance(e, requests.exceptions.ConnectionError):
         error_message = f"Помилка з'єднання з '{url}': сервер недоступний або проблеми з мережею"
         logging.error(f"CONNECTION ERROR for '{name}' (ID: {check_id}): {error_message} | Details: {str(e)}")
-        return status, None, None, error_message
-        
-    except requests.exceptions.HTTPError as e:
-        status_code = e.response.status_code if e.response else "Unknown"
+
+    elif isinstance(e, requests.exceptions.HTTPError):
+        status_code = e.response.status_code if e.response is not None else "Unknown"
+        # Сервер просить зачекати - наступні запити до хоста стануть у чергу лімітера
+        if status_code in (429, 503):
+            host_policies.note_retry_after(url, e.response.headers.get('Retry-After'))
         if status_code == 404:
             error_message = f"Сторінка не знайдена (404): '{url}'"
         elif status_code == 403:
@@ -116,28 +335,412 @@ def perform_check(check_id, name, url, selector, last_hash):
             error_message = f"Помилка сервера (500): '{url}' - внутрішня помилка сайту"
         elif status_code == 503:
             error_message = f"Сервіс недоступний (503): '{url}' - сайт тимчасово недоступний"
+        elif status_code == 429:
+            error_message = f"Забагато запитів (429): '{url}' - сайт обмежує частоту запитів"
         else:
             error_message = f"HTTP помилка {status_code}: '{url}'"
         logging.error(f"HTTP ERROR for '{name}' (ID: {check_id}): {error_message}")
-        return status, None, None, error_message
-        
-    except requests.exceptions.SSLError as e:
-        error_message = f"Помилка SSL сертифікату для '{url}': сертифікат недійсний або застарілий"
-        logging.error(f"SSL ERROR for '{name}' (ID: {check_id}): {error_message} | Details: {str(e)}")
-        return status, None, None, error_message
-        
-    except requests.exceptions.TooManyRedirects as e:
+
+    elif isinstance(e, requests.exceptions.TooManyRedirects):
         error_message = f"Забагато перенаправлень для '{url}': можливо циклічні редиректи"
         logging.error(f"REDIRECT ERROR for '{name}' (ID: {check_id}): {error_message}")
-        return status, None, None, error_message
-        
-    except requests.exceptions.RequestException as e:
+
+    elif isinstance(e, requests.exceptions.RequestException):
         error_message = f"Загальна помилка запиту до '{url}': {str(e)}"
         logging.error(f"REQUEST ERROR for '{name}' (ID: {check_id}): {error_message}")
-        return status, None, None, error_message
-        
-    except Exception as e:
+
+    else:
         error_message = f"Неочікувана помилка для '{url}': {str(e)}"
         logging.exception(f"UNEXPECTED ERROR for '{name}' (ID: {check_id}): {error_message}")
-        return status, None, None, error_message
 
+    return error_message
+
+def _build_group_conditional_headers(members):
+    """
+    Умовний GET для групи перевірок однієї сторінки можливий лише тоді,
+    коли всі перевірки мають попередній хеш і однакові валідатори.
+    """
+    validators = set()
+    for check_config, fetch_state in members:
+        if check_config.get('last_content_hash') is None or not fetch_state:
+            return {}
+        validators.add((fetch_state.get("etag"), fetch_state.get("last_modified")))
+    if len(validators) != 1:
+        return {}
+    check_config, fetch_state = members[0]
+    return _build_conditional_headers(check_config.get('last_content_hash'), fetch_state)
+
+def _evaluate_selector(check_id, name, url, selected_element, selector, last_hash):
+    """
+    Обчислює хеш знайденого елемента та порівнює його з попереднім.
+    Повертає кортеж (status, new_hash, extracted_text, error_message).
+    """
+    if not selected_element:
+        error_message = f"Element not found with selector: '{selector}'"
+        logging.warning(f"{error_message} for '{name}' (ID: {check_id}) on URL {url}")
+        return "error", None, None, error_message
+
+    extracted_text, current_hash = get_content_hash_from_element(selected_element)
+    
+    # ВИПРАВЛЕНО: Детальне логування для діагностики
+    logging.info(f"Check for '{name}' (ID: {check_id}:")
+    logging.info(f"  Extracted text: '{extracted_text}'")
+    logging.info(f"  Current hash: '{current_hash}'")
+    logging.info(f"  Last hash: '{last_hash}'")
+    logging.info(f"  Hash comparison: current==last -> {current_hash == last_hash}")
+
+    if last_hash is None: # Перша перевірка для цього елемента
+        status = "changed" # Считаем первой проверкой как изменение
+        logging.info(f"First check for '{name}' (ID: {check_id}). Status: {status}. Hash: {current_hash}")
+    elif current_hash == last_hash:
+        status = "no_change"
+        logging.info(f"No change detected for '{name}' (ID: {check_id}). Status: {status}. Hash unchanged: {current_hash}")
+    else:
+        status = "changed"
+        logging.info(f"Change detected for '{name}' (ID: {check_id}). Status: {status}. Old hash: {last_hash}, New hash: {current_hash}")
+    
+    # ДОДАНО: Додаткова перевірка для діагностики
+    if status == "changed" and last_hash is not None and extracted_text:
+        logging.info(f"CHANGE ANALYSIS for '{name}' (ID: {check_id}:")
+        logging.info(f"  Text length: {len(extracted_text)} chars")
+        logging.info(f"  Text content: '{extracted_text[:100]}{'...' if len(extracted_text) > 100 else ''}'")
+
+    return status, current_hash, extracted_text, None
+
+def _get_max_body_bytes(check_config):
+    """Максимальний розмір тіла відповіді для перевірки (байт)."""
+    return int(check_config.get('max_body_bytes') or MAX_BODY_BYTES)
+
+def _get_group_read_limits(members):
+    """
+    Повертає (max_body_bytes, prefix_bytes) для спільного завантаження групи.
+    Префікс використовується лише тоді, коли всі перевірки групи оголосили target_within_kb.
+    """
+    max_body_bytes = max(_get_max_body_bytes(c) for c, _ in members)
+    prefixes = [c.get('target_within_kb') for c, _ in members]
+    if all(prefixes):
+        return max_body_bytes, min(max(int(kb) for kb in prefixes) * 1024, max_body_bytes)
+    return max_body_bytes, None
+
+def _read_body(response, max_body_bytes, prefix_bytes=None):
+    """
+    Читає тіло відповіді частинами.
+    Якщо задано prefix_bytes - зупиняється після префікса (ранній розрив з'єднання).
+    Повертає байти або None, якщо тіло перевищує max_body_bytes.
+    """
+    content_length = response.headers.get('Content-Length')
+    if prefix_bytes is None and content_length and content_length.isdigit() and int(content_length) > max_body_bytes:
+        return None
+
+    limit = prefix_bytes or max_body_bytes
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= limit:
+            if prefix_bytes:
+                break
+            if size > max_body_bytes:
+                return None
+
+    body = b''.join(chunks)
+    return body[:prefix_bytes] if prefix_bytes else body
+
+def _oversized_result(check_config, url, max_body_bytes):
+    """Результат для відповіді, що перевищує ліміт розміру."""
+    error_message = f"Відповідь від '{url}' перевищує ліміт {max_body_bytes} байт. Завантаження перервано."
+    logging.error(f"OVERSIZED RESPONSE for '{check_config.get('name', 'N/A')}' (ID: {check_config['id']}): {error_message}")
+    return "oversized", None, None, error_message
+
+def _record_fetch_latency(members, fetch_started):
+    """Час завантаження (від запиту до прочитаного тіла, без очікування лімітів хоста) - у fetch_state['fetch_ms']."""
+    fetch_ms = round((time.perf_counter() - fetch_started) * 1000, 1)
+    for check_config, fetch_state in members:
+        if fetch_state is not None:
+            fetch_state["fetch_ms"] = fetch_ms
+
+def _record_reachable(members, reachable):
+    """
+    Чи була сторінка доступна (для uptime у rollups) - у fetch_state['reachable'].
+    Недоступність - лише помилка з'єднання, таймаут, відповідь 5xx або розімкнений запобіжник;
+    'oversized', 4xx та помилки селектора означають, що сервер відповів.
+    """
+    for check_config, fetch_state in members:
+        if fetch_state is not None:
+            fetch_state["reachable"] = reachable
+
+def _is_fetch_failure(e):
+    """Помилки запиту, що рахуються як недоступність сторінки (див. _record_reachable)."""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def _is_connection_failure(e):
+    """Помилки, що свідчать про недоступність хоста (рахуються запобіжником)."""
+    if isinstance(e, requests.exceptions.SSLError):
+        return False
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+def _circuit_open_result(check_config, url, breaker):
+    """Результат для перевірки, відхиленої розімкненим запобіжником хоста."""
+    error_message = (f"Хост '{breaker.host}' недоступний: {breaker.consecutive_failures} помилок з'єднання поспіль. "
+                     f"Перевірку пропущено, наступна спроба через {math.ceil(breaker.retry_in_seconds())}с.")
+    logging.warning(f"CIRCUIT OPEN for '{check_config.get('name', 'N/A')}' (ID: {check_config['id']}): {error_message}")
+    return "circuit_open", None, None, error_message
+
+def perform_checks_for_url(url, members, limiter=None):
+    """
+    Виконує кілька перевірок однієї сторінки: одне завантаження та один розбір документа,
+    після чого селектор кожної перевірки обчислюється на цьому документі.
+    members - список пар (check_config, fetch_state), fetch_state може бути None.
+    limiter - лімітер хоста, слот якого викликач уже отримав (і звільнить сам); без нього слот береться тут.
+    Повертає список результатів (status, new_hash, extracted_text, error_message) у тому ж порядку.
+    """
+    results = [None] * len(members)
+    max_body_bytes, prefix_bytes = _get_group_read_limits(members)
+
+    # Хост недоступний кілька разів поспіль - не чекаємо на таймаути, завершуємо одразу
+    breaker = host_policies.get_circuit_breaker(url)
+    if not breaker.allow_request():
+        _record_reachable(members, False)
+        for i, (check_config, fetch_state) in enumerate(members):
+            results[i] = _circuit_open_result(check_config, url, breaker)
+        return results
+
+    try:
+        # Ліміти ввічливості хоста: запит чекає на токен і вільний слот, а не завершується помилкою
+        with nullcontext() if limiter is not None else host_policies.host_slot(url, members[0][0]):
+            # ВИПРАВЛЕНО: Збільшуємо timeout та додаємо більше параметрів
+            # User-Agent задано на рівні сесії, з'єднання з хостом перевикористовуються
+            # stream=True: тіло читається частинами з обмеженням розміру
+            session = get_session_for_url(url)
+            fetch_started = time.perf_counter()
+            response = session.get(
+                url, 
+                headers=_build_group_conditional_headers(members),
+                timeout=(10, 30),  # (connection timeout, read timeout) 
+                allow_redirects=True,
+                verify=True,  # Перевіряємо SSL сертифікати
+                stream=True
+            )
+            # Хост відповів (будь-яким статусом) - запобіжник замикається
+            breaker.record_success()
+            _record_reachable(members, response.status_code < 500)
+
+            try:
+                # Сервер підтвердив, що сторінка не змінилась - тіло не завантажується і не розбирається
+                if response.status_code == 304:
+                    _record_fetch_latency(members, fetch_started)
+                    for i, (check_config, fetch_state) in enumerate(members):
+                        last_hash = check_config.get('last_content_hash')
+                        logging.info(f"Not modified (304) for '{check_config.get('name', 'N/A')}' (ID: {check_config['id']}). Status: no_change. Hash unchanged: {last_hash}")
+                        results[i] = ("no_change", last_hash, None, None)
+                    return results
+
+                response.raise_for_status() # Вызовет исключение для плохих ответов (4xx, 5xx)
+                body = _read_body(response, max_body_bytes, prefix_bytes)
+                _record_fetch_latency(members, fetch_started)
+            finally:
+                # Недочитане з'єднання закривається, прочитане повертається в пул
+                response.close()
+    except Exception as e:
+        if _is_connection_failure(e):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        _record_reachable(members, not _is_fetch_failure(e))
+        for i, (check_config, fetch_state) in enumerate(members):
+            error_message = _request_error_message(e, check_config['id'], check_config.get('name', 'N/A'), url)
+            results[i] = ("error", None, None, error_message)
+        return results
+
+    # Тіло більше за ліміт - завантаження перервано, пам'ять не витрачається
+    if body is None:
+        for i, (check_config, fetch_state) in enumerate(members):
+            results[i] = _oversized_result(check_config, url, max_body_bytes)
+        return results
+
+    body_hash = get_body_hash(body)
+    documents = {}  # бекенд -> розібраний документ (кожен бекенд розбирає сторінку не більше одного разу)
+
+    for i, (check_config, fetch_state) in enumerate(members):
+        check_id = check_config['id']
+        name = check_config.get('name', 'N/A')
+        last_hash = check_config.get('last_content_hash')
+
+        # Ліміт цієї перевірки менший за груповий
+        if prefix_bytes is None and len(body) > _get_max_body_bytes(check_config):
+            results[i] = _oversized_result(check_config, url, _get_max_body_bytes(check_config))
+            continue
+
+        # Тіло побайтово не змінилось - хеш селектора теж не зміниться, розбір не потрібен
+        if last_hash is not None and fetch_state and fetch_state.get("body_hash") == body_hash:
+            logging.info(f"Raw body unchanged for '{name}' (ID: {check_id}). Status: no_change. Hash unchanged: {last_hash}")
+            _update_fetch_state(fetch_state, response, body_hash)
+            results[i] = ("no_change", last_hash, None, None)
+            continue
+
+        try:
+            backend = resolve_parser_backend(check_config.get('parser'))
+            selector = check_config['selector']
+            selected_element = _select_with_fallback(documents, body, backend, selector, check_id)
+            results[i] = _evaluate_selector(check_id, name, url, selected_element, selector, last_hash)
+        except Exception as e:
+            results[i] = ("error", None, None, _request_error_message(e, check_id, name, url))
+            continue
+
+        # Запам'ятовуємо валідатори та хеш тіла для наступної перевірки
+        if results[i][0] not in ERROR_STATUSES:
+            _update_fetch_state(fetch_state, response, body_hash)
+
+    return results
+
+def perform_check(check_id, name, url, selector, last_hash, fetch_state=None, parser=None):
+    """
+    Выполняет проверку веб-страницы.
+    Возвращает кортеж: (status, new_hash, extracted_text, error_message)
+    status: 'changed', 'no_change', 'error', 'oversized' (тіло більше за ліміт),
+            'circuit_open' (хост тимчасово вимкнено запобіжником)
+    new_hash: MD5 хеш текущего контента или None в случае ошибки
+    extracted_text: извлеченный текст или None в случае ошибки
+    error_message: сообщение об ошибке или None
+
+    fetch_state (необов'язково) - словник з get_fetch_state(). Валідатори з нього
+    відправляються як умовний GET, а після успішної відповіді оновлюються на місці;
+    туди ж записується час завантаження 'fetch_ms'.
+    Відповідь 304 або побайтово ідентичне тіло дають 'no_change' з last_hash
+    та extracted_text=None без розбору сторінки.
+    parser (необов'язково) - бекенд розбору HTML, за замовчуванням DEFAULT_PARSER_BACKEND.
+    """
+    check_config = {
+        "id": check_id,
+        "name": name,
+        "url": url,
+        "selector": selector,
+        "last_content_hash": last_hash,
+        "parser": parser
+    }
+    return perform_check_for_config(check_config, fetch_state)
+
+def perform_check_for_config(check_config, fetch_state=None):
+    """
+    Виконує перевірку за словником конфігурації з checks.json
+    (враховує також 'parser', 'max_body_bytes' та 'target_within_kb').
+    Повертає той самий кортеж, що й perform_check.
+    """
+    logging.info(f"Performing check for '{check_config.get('name', 'N/A')}' (ID: {check_config['id']}), URL: {check_config['url']}, Selector: {check_config['selector']}")
+    members = [(check_config, fetch_state)]
+    # Окрема перевірка теж займає місце в спільному пулі (крім виклику з потоку самого пулу).
+    # Слот хоста отримується до цього в потоці викликача, щоб очікування ліміту не тримало потік пулу
+    if is_check_worker():
+        return perform_checks_for_url(check_config['url'], members)[0]
+    with host_policies.host_slot(check_config['url'], check_config) as limiter:
+        return get_check_executor().submit(perform_checks_for_url, check_config['url'], members, limiter).result()[0]
+
+def group_checks_by_url(check_configs):
+    """Групує конфігурації перевірок за нормалізованим URL, зберігаючи порядок."""
+    groups = {}
+    for check_config in check_configs:
+        groups.setdefault(normalize_url(check_config['url']), []).append(check_config)
+    return groups
+
+async def _perform_checks_async(check_configs, max_concurrency, on_result):
+    """
+    Запускає перевірки конкурентно через asyncio у спільному пулі get_check_executor().
+    Глобальний ліміт задає розмір пулу, max_concurrency лише додатково обмежує цей пакет.
+    Перевірки однієї сторінки завантажуються та розбираються один раз.
+    on_result викликається в потоці event loop, тобто послідовно для кожного результату.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_check_executor()
+    batch_slots = asyncio.Semaphore(max_concurrency)
+    results = {}
+
+    async def run_group(url, group_configs):
+        members = [(c, get_fetch_state(c)) for c in group_configs]
+        names = ', '.join(f"'{c.get('name', c['id'])}'" for c in group_configs)
+        group_url = members[0][0]['url']
+
+        # Розімкнений запобіжник відхилить перевірки одразу - слот хоста не потрібен
+        if host_policies.get_circuit_breaker(group_url).retry_in_seconds() > 0:
+            async with batch_slots:
+                group_results = await loop.run_in_executor(executor, perform_checks_for_url, group_url, members)
+            return members, group_results
+
+        # Ліміт хоста очікується в event loop: перевірки повільного хоста не займають потоки спільного пулу,
+        # поки перевірки інших хостів чекають на вільний потік
+        limiter = host_policies.get_limiter(group_url, members[0][0])
+        waited = await limiter.acquire_async()
+        if waited > 0.001:
+            logging.info(f"Host limiter: waited {waited:.2f}s for {limiter.host}")
+        try:
+            async with batch_slots:
+                logging.info(f"Performing {len(members)} check(s) for URL {url}: {names}")
+                group_results = await loop.run_in_executor(executor, perform_checks_for_url, group_url, members, limiter)
+        finally:
+            limiter.release()
+        return members, group_results
+
+    groups = group_checks_by_url(check_configs)
+    for next_done in asyncio.as_completed([run_group(url, configs) for url, configs in groups.items()]):
+        members, group_results = await next_done
+        for (check_config, fetch_state), result in zip(members, group_results):
+            results[check_config['id']] = result
+            if on_result:
+                try:
+                    on_result(check_config, result, fetch_state)
+                except Exception as e:
+                    logging.error(f"Error handling result for check {check_config['id']}: {e}")
+
+    return results
+
+def perform_checks_batch(check_configs, max_concurrency=None, on_result=None):
+    """
+    Виконує пакет перевірок конкурентно в межах глобального ліміту MAX_CONCURRENT_CHECKS (спільний пул).
+    Перевірки з однаковим нормалізованим URL виконуються одним запитом (див. perform_checks_for_url).
+    Повертає словник check_id -> (status, new_hash, extracted_text, error_message).
+    on_result(check_config, result, fetch_state) викликається по мірі завершення кожної перевірки.
+    """
+    if not check_configs:
+        return {}
+
+    max_concurrency = max(1, min(max_concurrency or MAX_CONCURRENT_CHECKS, len(check_configs)))
+    logging.info(f"Performing batch of {len(check_configs)} checks with concurrency {max_concurrency}")
+    return asyncio.run(_perform_checks_async(check_configs, max_concurrency, on_result))
+
+if __name__ == '__main__':
+    if not logging.getLogger().hasHandlers():
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+
+    # Перевірка паритету бекендів: однаковий текст і хеш для get_content_hash_from_element
+    parity_fixtures = [
+        ('<html><body><h1>Hello</h1></body></html>', 'h1'),
+        ('<div class="price"> 1 299 <span>грн</span>\n </div>', 'div.price'),
+        ('<span data-qaid="product_price">  100 </span><span data-qaid="product_price">200</span>', 'span[data-qaid="product_price"]'),
+        ('<div id="a"> Hi <b>there</b>\n <!-- comment --> <script>var x=1</script><style>.a{}</style> <i> x </i>&amp; y</div>', '#a'),
+        ('<ul><li>one</li><li> two </li><li>three</li></ul>', 'ul > li:nth-of-type(2)'),
+        ('<div class="count">Результатів: <strong>42</strong></div>', 'div.count'),
+        ('<p>Caf&eacute; &nbsp; &#8470;5</p>', 'p'),
+        ('<table><tr><td>a</td><td></td><td>c</td></tr></table>', 'tr'),
+    ]
+
+    available = get_available_parser_backends()
+    logging.info(f"Available parser backends: {available}")
+    mismatches = 0
+
+    for html, selector in parity_fixtures:
+        body = html.encode('utf-8')
+        reference = get_content_hash_from_element(
+            select_element(parse_document(body, FALLBACK_PARSER_BACKEND), FALLBACK_PARSER_BACKEND, selector))
+        for backend in available:
+            result = get_content_hash_from_element(select_element(parse_document(body, backend), backend, selector))
+            if result != reference:
+                mismatches += 1
+                logging.error(f"Parity mismatch for '{backend}' on selector '{selector}': {result!r} != {reference!r}")
+            else:
+                logging.info(f"OK {backend:<12} {selector:<35} -> {result[0]!r}")
+
+    assert mismatches == 0, f"{mismatches} parser parity mismatches"
+    logging.info("Parser backend parity tests for monitor_engine.py passed.")
@@ -0,0 +1,227 @@
+import atexit
+import copy
+import logging
+import os
+import threading
+import time
+
+import data_manager
+
+# Вікна агрегатів: назва -> (розмір кошика в секундах, кількість кошиків).
+# Кожен результат оновлює по одному кошику кожного вікна, читання підсумовує сталу кількість кошиків
+ROLLUP_WINDOWS = {
+    "1h": (300, 12),
+    "24h": (3600, 24),
+    "30d": (86400, 30)
+}
+
+# Межі гістограми часу завантаження (мс); останній кошик гістограми - усе, що більше
+LATENCY_BOUNDS_MS = (
+    10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 750,
+    1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000
+)
+
+# Uptime - частка перевірок, у яких сторінка була доступна. Недоступність - лише збій завантаження:
+# помилка з'єднання, таймаут, відповідь 5xx або 'circuit_open' (monitor_engine пише це у fetch_state['reachable']).
+# 'oversized', 4xx та "елемент не знайдено" - сторінка відповіла, це не простій.
+# UP_STATUSES - запасне правило для результатів без fetch_state['reachable']
+UP_STATUSES = ("changed", "no_change")
+
+# Затримка відкладеного запису агрегатів у базу (секунди)
+ROLLUP_FLUSH_DELAY_SECONDS = float(os.getenv('MONITOR_ROLLUP_FLUSH_DELAY_SECONDS', 10))
+
+_rollups = {}  # check_id -> {вікно: [кошик, ...]}
+_rollups_loaded = False
+_rollups_lock = threading.Lock()
+_dirty_ids = set()
+_deleted_ids = set()
+_flush_timer = None
+
+def _ensure_loaded():
+    """Завантажує агрегати з бази при першому зверненні. Викликається під _rollups_lock."""
+    global _rollups_loaded
+    if not _rollups_loaded:
+        _rollups.update(data_manager.load_check_rollups())
+        _rollups_loaded = True
+
+def _latency_bin(fetch_ms):
+    for index, bound in enumerate(LATENCY_BOUNDS_MS):
+        if fetch_ms <= bound:
+            return index
+    return len(LATENCY_BOUNDS_MS)
+
+def _new_bucket(start):
+    return {"start": start, "total": 0, "up": 0, "changed": 0, "max_ms": 0.0,
+            "latency": [0] * (len(LATENCY_BOUNDS_MS) + 1)}
+
+def record_check_result(check_id, status, fetch_ms=None, now=None, reachable=None):
+    """
+    Додає результат перевірки до агрегатів усіх вікон (O(1)).
+    fetch_ms - час завантаження сторінки з monitor_engine (fetch_state['fetch_ms']), якщо був запит.
+    reachable - чи була сторінка доступна (fetch_state['reachable']); None - за статусом (UP_STATUSES).
+    """
+    now = time.time() if now is None else now
+    is_up = status in UP_STATUSES if reachable is None else bool(reachable)
+    with _rollups_lock:
+        _ensure_loaded()
+        windows = _rollups.setdefault(check_id, {})
+        for window, (bucket_seconds, bucket_count) in ROLLUP_WINDOWS.items():
+            buckets = windows.setdefault(window, [])
+            start = int(now // bucket_seconds * bucket_seconds)
+            if not buckets or buckets[-1]["start"] != start:
+                buckets.append(_new_bucket(start))
+                # Кошики, що вийшли за межі вікна, відкидаються
+                while buckets[0]["start"] <= start - bucket_seconds * bucket_count:
+                    buckets.pop(0)
+            bucket = buckets[-1]
+            bucket["total"] += 1
+            bucket["up"] += int(is_up)
+            bucket["changed"] += int(status == "changed")
+            if fetch_ms is not None:
+                bucket["latency"][_latency_bin(fetch_ms)] += 1
+                bucket["max_ms"] = max(bucket["max_ms"], fetch_ms)
+        _dirty_ids.add(check_id)
+        _deleted_ids.discard(check_id)
+    _schedule_flush()
+
+def _percentile(histogram, samples, max_ms, fraction):
+    """Верхня межа кошика гістограми, в який потрапляє перцентиль (не більше за максимум вікна)."""
+    target = samples * fraction
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        cumulative += count
+        if count and cumulative >= target:
+            bound = LATENCY_BOUNDS_MS[index] if index < len(LATENCY_BOUNDS_MS) else max_ms
+            return min(bound, max_ms)
+    return max_ms
+
+def _summarize(buckets, window_start):
+    total = up = changed = 0
+    max_ms = 0.0
+    histogram = [0] * (len(LATENCY_BOUNDS_MS) + 1)
+    for bucket in buckets:
+        if bucket["start"] < window_start:
+            continue
+        total += bucket["total"]
+        up += bucket["up"]
+        changed += bucket["changed"]
+        max_ms = max(max_ms, bucket["max_ms"])
+        for index, count in enumerate(bucket["latency"]):
+            histogram[index] += count
+    samples = sum(histogram)
+    return {
+        "checks": total,
+        "uptime_percent": round(up / total * 100, 2) if total else None,
+        "changes": changed,
+        "change_rate_percent": round(changed / total * 100, 2) if total else None,
+        "latency_ms": {
+            "samples": samples,
+            "p50": _percentile(histogram, samples, max_ms, 0.50) if samples else None,
+            "p95": _percentile(histogram, samples, max_ms, 0.95) if samples else None,
+            "p99": _percentile(histogram, samples, max_ms, 0.99) if samples else None
+        }
+    }
+
+def get_check_rollups(check_id, now=None):
+    """
+    Uptime, частота змін та перцентилі часу завантаження перевірки за вікнами ROLLUP_WINDOWS.
+    Точність вікна - один кошик (напр. '1h' - останні 55-60 хвилин), перцентилі - межі кошиків гістограми.
+    """
+    now = time.time() if now is None else now
+    with _rollups_lock:
+        _ensure_loaded()
+        windows = _rollups.get(check_id, {})
+        result = {}
+        for window, (bucket_seconds, bucket_count) in ROLLUP_WINDOWS.items():
+            window_start = int(now // bucket_seconds * bucket_seconds) - bucket_seconds * (bucket_count - 1)
+            result[window] = _summarize(windows.get(window, []), window_start)
+        return result
+
+def delete_check_rollups(check_id):
+    """Видаляє агрегати перевірки (при видаленні перевірки)."""
+    with _rollups_lock:
+        _ensure_loaded()
+        _rollups.pop(check_id, None)
+        _dirty_ids.discard(check_id)
+        _deleted_ids.add(check_id)
+    _schedule_flush()
+
+def _schedule_flush():
+    global _flush_timer
+    with _rollups_lock:
+        if _flush_timer is not None:
+            return
+        _flush_timer = threading.Timer(ROLLUP_FLUSH_DELAY_SECONDS, flush_rollups)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def flush_rollups():
+    """Записує змінені агрегати в базу (викликається таймером та при завершенні процесу)."""
+    global _flush_timer
+    with _rollups_lock:
+        _flush_timer = None
+        if not _dirty_ids and not _deleted_ids:
+            return True
+        changed = {check_id: copy.deepcopy(_rollups[check_id]) for check_id in _dirty_ids if check_id in _rollups}
+        deleted = set(_deleted_ids)
+        _dirty_ids.clear()
+        _deleted_ids.clear()
+
+    if data_manager.save_check_rollups(changed, deleted):
+        logging.debug(f"Rollups saved for {len(changed)} checks ({len(deleted)} deleted)")
+        return True
+    # Не вдалося записати - повторимо з наступним записом
+    with _rollups_lock:
+        _dirty_ids.update(check_id for check_id in changed if check_id in _rollups)
+        _deleted_ids.update(deleted - set(_rollups))
+    return False
+
+atexit.register(flush_rollups)
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+    test_dir = tempfile.mkdtemp(prefix='monitor_rollups_')
+    data_manager.DB_FILE = os.path.join(test_dir, 'test.db')
+    data_manager.CHECKS_FILE = os.path.join(test_dir, 'checks.json')
+    data_manager.HISTORY_DIR = os.path.join(test_dir, 'history')
+    try:
+        now = time.time()
+        # 2 доби тому: 10 помилок; остання година: 97 успішних (3 зі змінами) та 3 помилки
+        for i in range(10):
+            record_check_result("c1", "error", now=now - 2 * 86400 + i)
+        for i in range(100):
+            status = "error" if i < 3 else ("changed" if i % 33 == 0 else "no_change")
+            record_check_result("c1", status, fetch_ms=None if status == "error" else 100 + i * 10, now=now - 1800 + i)
+
+        stats = get_check_rollups("c1", now=now)
+        logging.info(f"Rollups: {stats}")
+        assert stats["1h"]["checks"] == 100 and stats["1h"]["uptime_percent"] == 97.0
+        assert stats["24h"] == stats["1h"], "Older results must stay out of the 24h window"
+        assert stats["30d"]["checks"] == 110 and stats["30d"]["uptime_percent"] == round(97 / 110 * 100, 2)
+        assert stats["1h"]["changes"] == 3
+        assert stats["1h"]["latency_ms"]["samples"] == 97
+        assert stats["1h"]["latency_ms"]["p50"] == 750 and stats["1h"]["latency_ms"]["p99"] == 1090.0
+        assert get_check_rollups("c1", now=now + 7200)["1h"]["checks"] == 0, "Window must slide"
+
+        # Сторінка відповіла (oversized, елемент не знайдено) - не простій; збій завантаження - простій
+        record_check_result("c2", "oversized", now=now, reachable=True)
+        record_check_result("c2", "error", now=now, reachable=True)
+        record_check_result("c2", "error", now=now, reachable=False)
+        record_check_result("c2", "circuit_open", now=now)
+        assert get_check_rollups("c2", now=now)["1h"]["uptime_percent"] == 50.0
+        delete_check_rollups("c2")
+
+        assert flush_rollups()
+        _rollups.clear()
+        _rollups_loaded = False
+        assert get_check_rollups("c1", now=now) == stats, "Rollups must survive a restart"
+
+        delete_check_rollups("c1")
+        assert flush_rollups() and data_manager.load_check_rollups() == {}
+        logging.info("All tests for rollups.py passed.")
+    finally:
+        data_manager.close_connection()
+        shutil.rmtree(test_dir, ignore_errors=True)
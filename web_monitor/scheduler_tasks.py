@@ -1,18 +1,56 @@
 from datetime import datetime, timezone
-from apscheduler.schedulers.background import BackgroundScheduler
 import logging
 import atexit
+import os
+import threading
 import data_manager
+import dispatcher
 import monitor_engine
+import rollups
+
+# Конкурентність фонового початкового проходу (нижча за звичайну, щоб не заважати запланованим перевіркам)
+WARM_START_CONCURRENCY = int(os.getenv('MONITOR_WARM_START_CONCURRENCY', 5))
+
+_warm_start_state = {
+    "status": "idle",  # idle / running / completed / failed
+    "total": 0,
+    "completed": 0,
+    "errors": 0,
+    "skipped_recent": 0,
+    "error": None,
+    "started_at": None,
+    "finished_at": None
+}
+_warm_start_lock = threading.Lock()
+
+def run_due_checks(check_ids):
+    """
+    Обробник пакета диспетчера: виконує перевірки, що настали, одним пакетом
+    (перевірки однієї сторінки - одним запитом).
+    """
+    if not check_ids:
+        return 0
 
-scheduler = BackgroundScheduler(timezone="UTC") # Используем UTC для планировщика
+    try:
+        due_checks = [data_manager.get_check_by_id(check_id) for check_id in check_ids]
+        due_checks = [c for c in due_checks if c and c.get("status") != "paused"]
+        logging.info(f"Scheduler: Running dispatched batch of {len(due_checks)} checks")
+        return run_checks_batch(due_checks)
+    except Exception as e:
+        logging.error(f"Scheduler: Error running dispatched batch: {e}")
+        return 0
+
+def _create_scheduler():
+    """Створює диспетчер перевірок (замість BackgroundScheduler з окремою задачею на кожну перевірку)."""
+    return dispatcher.CheckDispatcher(run_due_checks)
+
+scheduler = _create_scheduler()
 
 def scheduled_check_task(check_id):
     """
     Задача, выполняемая по расписанию для одной проверки.
     """
-    all_checks = data_manager.load_checks()
-    check_config = next((c for c in all_checks if c['id'] == check_id), None)
+    check_config = data_manager.get_check_by_id(check_id)
 
     if not check_config:
         logging.error(f"Scheduler: Check with ID {check_id} not found for scheduled task.")
@@ -25,13 +63,25 @@ def scheduled_check_task(check_id):
     logging.info(f"Scheduler: Running task for check_id: {check_id} ('{check_config.get('name', '')}')")
     
     # Выполняем проверку
-    status, new_hash, extracted_text, error_msg = monitor_engine.perform_check(
-        check_id=check_config['id'],
-        name=check_config.get('name', 'N/A'),
-        url=check_config['url'],
-        selector=check_config['selector'],
-        last_hash=check_config.get('last_content_hash')
-    )
+    fetch_state = monitor_engine.get_fetch_state(check_config)
+    result = monitor_engine.perform_check_for_config(check_config, fetch_state)
+    save_check_result(check_id, result, fetch_state)
+
+def save_check_result(check_id, result, fetch_state=None):
+    """
+    Зберігає результат перевірки: запис в історію та оновлення основних даних перевірки.
+    result - кортеж (status, new_hash, extracted_text, error_message) від monitor_engine.
+    fetch_state - оновлені валідатори HTTP-кешу (ETag / Last-Modified, хеш тіла), якщо є.
+    Використовується і для ручних перевірок: хеш вмісту та валідатори мають оновлюватись разом,
+    інакше пропуск незмінного тіла приховає зміну. Повертає збережений запис історії.
+    """
+    status, new_hash, extracted_text, error_msg = result
+
+    # 304 або незмінне тіло не дають тексту - переносимо останнє значення з історії
+    if status == "no_change" and extracted_text is None:
+        current_content = data_manager.get_current_content(check_id)
+        if current_content:
+            extracted_text = current_content.get('content')
 
     current_time_utc = datetime.now(timezone.utc)
     current_time_iso = current_time_utc.isoformat()
@@ -49,58 +99,61 @@ def scheduled_check_task(check_id):
     data_manager.save_check_history_entry(check_id, history_entry)
     logging.info(f"Scheduler: History entry saved for check_id: {check_id}")
 
-    # ВИПРАВЛЕНО: Завантажуємо найсвіжіші дані перевірки перед оновленням
-    all_checks = data_manager.load_checks()
-    check_config = next((c for c in all_checks if c['id'] == check_id), None)
-    
-    if not check_config:
-        logging.error(f"Scheduler: Check with ID {check_id} not found after history save.")
-        return
+    # Агрегати uptime / змін / часу завантаження оновлюються інкрементально
+    rollups.record_check_result(check_id, status, (fetch_state or {}).get('fetch_ms'),
+                                reachable=(fetch_state or {}).get('reachable'))
 
-    # Обновляем основную конфигурацию проверки
-    check_config['last_checked_at'] = current_time_iso
-    check_config['last_result'] = status
-    
-    # ВИПРАВЛЕНО: Детальне логування оновлення хешу
-    old_hash = check_config.get('last_content_hash')
-    if status in ["changed", "no_change"]:
-        check_config['last_content_hash'] = new_hash
-        logging.info(f"Hash update for check {check_id}: '{old_hash}' -> '{new_hash}' (Status: {status})")
-    else:
-        logging.info(f"Hash NOT updated for check {check_id} due to error status: {status}")
+    # Стан оновлюється транзакційно під блокуванням перевірки: паралельні ручні перевірки,
+    # перемикання статусу та редагування не перезаписують результат і не відкочують хеш
+    with data_manager.check_transaction(check_id) as check_config:
+        if not check_config:
+            logging.error(f"Scheduler: Check with ID {check_id} not found after history save.")
+            return history_entry
+
+        # Оновлюємо лише стан виконання; конфігурацію перевірки не перезаписуємо
+        state_changes = {}
+        state_changes['last_checked_at'] = current_time_iso
+        state_changes['last_result'] = status
     
-    # Очищуємо повідомлення про помилку при успішній перевірці
-    if status != "error":
-        check_config['last_error_message'] = None
-    else:
-        check_config['last_error_message'] = error_msg
+        # ВИПРАВЛЕНО: Детальне логування оновлення хешу
+        old_hash = check_config.get('last_content_hash')
+        if status in ["changed", "no_change"]:
+            state_changes['last_content_hash'] = new_hash
+            logging.info(f"Hash update for check {check_id}: '{old_hash}' -> '{new_hash}' (Status: {status})")
+            # Без fetch_state валідатори належать до старого хешу - скидаємо їх
+            fetch_state = fetch_state or {}
+            state_changes['http_etag'] = fetch_state.get("etag")
+            state_changes['http_last_modified'] = fetch_state.get("last_modified")
+            state_changes['last_body_hash'] = fetch_state.get("body_hash")
+        else:
+            logging.info(f"Hash NOT updated for check {check_id} due to error status: {status}")
     
-    # Рассчитываем следующее время запуска для информации
-    try:
-        job = scheduler.get_job(check_id)
-        if job and job.next_run_time:
-            # ВИПРАВЛЕНО: Правильне відображення наступного часу
-            next_run_utc = job.next_run_time
-            next_run_local = next_run_utc.astimezone()
-            check_config['next_check_at'] = next_run_local.isoformat()
-            logging.info(f"Next run for {check_id}: UTC={next_run_utc.isoformat()}, Local={next_run_local.isoformat()}")
+        # Очищуємо повідомлення про помилку при успішній перевірці
+        if status not in monitor_engine.ERROR_STATUSES:
+            state_changes['last_error_message'] = None
         else:
-            check_config['next_check_at'] = None
-            logging.warning(f"Could not get next_run_time for job {check_id} - job may not exist")
-    except Exception as e:
-        logging.warning(f"Scheduler: Could not get next_run_time for job {check_id}: {e}")
-        check_config['next_check_at'] = None
-
-    # ВИПРАВЛЕНО: Зберігаємо оновлений список
-    data_manager.save_checks(all_checks)
+            state_changes['last_error_message'] = error_msg
     
-    # ДОДАНО: Перевіряємо, чи хеш справді збережено
-    saved_checks = data_manager.load_checks()
-    saved_check = next((c for c in saved_checks if c['id'] == check_id), None)
-    if saved_check:
-        logging.info(f"Verification after save - Check {check_id}: saved hash = '{saved_check.get('last_content_hash')}', expected = '{new_hash if status in ['changed', 'no_change'] else old_hash}'")
+        # Рассчитываем следующее время запуска для информации
+        try:
+            job = scheduler.get_job(check_id)
+            if job and job.next_run_time:
+                # ВИПРАВЛЕНО: Правильне відображення наступного часу
+                next_run_utc = job.next_run_time
+                next_run_local = next_run_utc.astimezone()
+                state_changes['next_check_at'] = next_run_local.isoformat()
+                logging.info(f"Next run for {check_id}: UTC={next_run_utc.isoformat()}, Local={next_run_local.isoformat()}")
+            else:
+                state_changes['next_check_at'] = None
+                logging.warning(f"Could not get next_run_time for job {check_id} - job may not exist")
+        except Exception as e:
+            logging.warning(f"Scheduler: Could not get next_run_time for job {check_id}: {e}")
+            state_changes['next_check_at'] = None
+
+        # Запис у базу - відкладений, з реєстру
+        check_config.update(state_changes)
     
-    logging.info(f"Scheduler: Task for check_id: {check_id} ('{check_config.get('name', '')}') completed. Status: {status}. Next run: {check_config.get('next_check_at', 'N/A')}")
+    logging.info(f"Scheduler: Task for check_id: {check_id} ('{check_config.get('name', '')}') completed. Status: {status}. Next run: {state_changes.get('next_check_at', 'N/A')}")
 
     # Отправка уведомления, если статус 'changed' или 'error' (будет добавлено позже)
     # if status == "changed" or status == "error":
@@ -111,6 +164,12 @@ def scheduled_check_task(check_id):
     #         message += f"\nError: {error_msg}"
     #     # telegram_sender.send_telegram_message(message) # Раскомментировать, когда telegram_sender будет готов
 
+    return history_entry
+
+def get_phase_key(check_config):
+    """Ключ фази диспетчера: перевірки однієї сторінки запускаються разом і завантажують її один раз."""
+    return monitor_engine.normalize_url(check_config['url']) if check_config.get('url') else check_config['id']
+
 def init_scheduler(app_checks):
     """
     Инициализирует и запускает планировщик с задачами из app_checks.
@@ -121,7 +180,7 @@ def init_scheduler(app_checks):
         scheduler.shutdown(wait=False)
         
     # Пересоздаем планировщик для чистоти стано
-    globals()['scheduler'] = BackgroundScheduler(timezone="UTC")
+    globals()['scheduler'] = _create_scheduler()
     logging.info("Scheduler: Initializing...")
     
     active_checks_count = 0
@@ -140,13 +199,10 @@ def init_scheduler(app_checks):
                 
                 # ВИПРАВЛЕНО: Додаємо check_id як аргумент функції
                 scheduler.add_job(
-                    func=scheduled_check_task,
-                    trigger='interval',
-                    minutes=interval_minutes,
-                    args=[check_config['id']],
-                    id=check_config['id'],
+                    check_config['id'],
+                    interval_minutes,
                     name=f"Check: {check_config.get('name', check_config['id'])}",
-                    replace_existing=True
+                    phase_key=get_phase_key(check_config)
                 )
                 active_checks_count += 1
                 logging.info(f"Scheduler: Added job for check_id: {check_config['id']} ('{check_config.get('name', '')}'), Interval: {interval_minutes} minutes.")
@@ -179,7 +235,8 @@ def init_scheduler(app_checks):
     # ДОДАНО: Зберігаємо оновлені дані після ініціалізації планувальника
     if updated_checks:
         try:
-            data_manager.save_checks(updated_checks)
+            for check_config in updated_checks:
+                data_manager.update_check_state(check_config['id'], {'next_check_at': check_config.get('next_check_at')})
             logging.info(f"Updated next_check_at times for {len(updated_checks)} checks after scheduler initialization")
         except Exception as e:
             logging.error(f"Error saving updated check times after scheduler init: {e}")
@@ -207,8 +264,7 @@ def update_job(check_id, interval_minutes):
             scheduler.remove_job(check_id)
         
         # Завантажуємо дані перевірки
-        all_checks = data_manager.load_checks()
-        check_config = next((c for c in all_checks if c['id'] == check_id), None)
+        check_config = data_manager.get_check_by_id(check_id)
         
         if not check_config:
             logging.warning(f"Scheduler: Check {check_id} not found in config. Cannot add job.")
@@ -220,16 +276,13 @@ def update_job(check_id, interval_minutes):
         
         # ВИПРАВЛЕНО: Створюємо нове завдання з чіткими параметрами
         try:
+            # Диспетчер не запускає перевірку, поки попередній запуск триває,
+            # а пропущені запуски об'єднує в один
             scheduler.add_job(
-                func=scheduled_check_task,
-                trigger='interval',
-                minutes=interval_minutes,
-                args=[check_id],
-                id=check_id,
+                check_id,
+                interval_minutes,
                 name=f"Check: {check_config.get('name', check_config['id'])}",
-                replace_existing=True,
-                max_instances=1,  # ДОДАНО: Запобігаємо одночасному виконанню
-                coalesce=True     # ДОДАНО: Об'єднуємо пропущені запуски
+                phase_key=get_phase_key(check_config)
             )
             logging.info(f"✅ Successfully created new job for {check_id} with interval {interval_minutes} minutes")
         except Exception as e:
@@ -261,6 +314,24 @@ def update_job(check_id, interval_minutes):
         logging.error(f"Scheduler: Error updating job for check_id {check_id}: {e}")
         return False
 
+def add_jobs(check_configs):
+    """
+    Додає задачі для кількох нових перевірок одним пакетом (масовий імпорт), без перевірок і пауз update_job.
+    Повертає кількість доданих задач.
+    """
+    try:
+        jobs = scheduler.add_jobs([
+            (c['id'], c['interval'], f"Check: {c.get('name', c['id'])}", get_phase_key(c))
+            for c in check_configs if c.get("status") == "active" and c.get('interval', 0) > 0
+        ])
+        for job in jobs:
+            data_manager.update_check_state(job.id, {'next_check_at': job.next_run_time.astimezone().isoformat()})
+        logging.info(f"Scheduler: Added {len(jobs)} jobs in one batch")
+        return len(jobs)
+    except Exception as e:
+        logging.error(f"Scheduler: Error adding jobs in batch: {e}")
+        return 0
+
 def remove_job(check_id):
     """Удаляет задачу из планировщика."""
     try:
@@ -298,8 +369,7 @@ def resume_job(check_id):
             logging.info(f"Scheduler: Resumed job for check_id: {check_id}.")
         else:
             # Если задачи нет, но проверка активна, попробуем ее добавить
-            all_checks = data_manager.load_checks()
-            check_config = next((c for c in all_checks if c['id'] == check_id), None)
+            check_config = data_manager.get_check_by_id(check_id)
             if check_config and check_config.get("status") != "paused": # Должен быть 'active'
                 interval_minutes = int(check_config.get('interval', 5))
                 update_job(check_id, interval_minutes) # update_job добавит, если нет
@@ -334,7 +404,8 @@ def get_scheduler_diagnostics():
             "is_overdue": job.next_run_time < current_time if job.next_run_time else False,
             "func": str(job.func),
             "trigger": str(job.trigger),
-            "args": job.args
+            "args": job.args,
+            "phase_offset_seconds": round(dispatcher.get_phase_offset(job.phase_key, job.interval_seconds), 1)
         }
         jobs_info.append(job_info)
     
@@ -343,7 +414,8 @@ def get_scheduler_diagnostics():
         "current_time_utc": current_time.isoformat(),
         "current_time_local": current_time.astimezone().isoformat(),
         "jobs_count": len(jobs_info),
-        "jobs": jobs_info
+        "jobs": jobs_info,
+        "dispatcher": scheduler.get_metrics()
     }
 
 def force_scheduler_check():
@@ -356,19 +428,19 @@ def force_scheduler_check():
     
     try:
         current_time = datetime.now(timezone.utc)
-        forced_jobs = 0
+        overdue_ids = []
         
         for job in scheduler.get_jobs():
             if job.next_run_time and job.next_run_time < current_time:
                 logging.warning(f"Found overdue job {job.id}: should have run at {job.next_run_time}, now is {current_time}")
-                
-                # Примусово запускаємо завдання
-                try:
-                    scheduled_check_task(job.id)
-                    forced_jobs += 1
-                    logging.info(f"Forced execution of overdue job {job.id}")
-                except Exception as e:
-                    logging.error(f"Error during forced execution of job {job.id}: {e}")
+                overdue_ids.append(job.id)
+        
+        # Примусово запускаємо прострочені завдання одним пакетом
+        forced_jobs = 0
+        if overdue_ids:
+            all_checks = data_manager.load_checks()
+            overdue_checks = [c for c in all_checks if c['id'] in overdue_ids and c.get("status") != "paused"]
+            forced_jobs = run_checks_batch(overdue_checks)
         
         if forced_jobs > 0:
             logging.info(f"Forced execution of {forced_jobs} overdue jobs")
@@ -381,6 +453,23 @@ def force_scheduler_check():
         logging.error(f"Error during forced scheduler check: {e}")
         return False
 
+def run_checks_batch(check_configs, max_concurrency=None, on_saved=None):
+    """
+    Виконує пакет перевірок конкурентно через monitor_engine.perform_checks_batch.
+    Результати зберігаються послідовно по мірі завершення. Повертає кількість виконаних перевірок.
+    on_saved(check_id, status) викликається після збереження кожного результату (для прогресу).
+    """
+    executed = []
+
+    def on_result(check_config, result, fetch_state):
+        save_check_result(check_config['id'], result, fetch_state)
+        executed.append(check_config['id'])
+        if on_saved:
+            on_saved(check_config['id'], result[0])
+
+    monitor_engine.perform_checks_batch(check_configs, max_concurrency=max_concurrency, on_result=on_result)
+    return len(executed)
+
 def execute_all_active_checks():
     """
     Виконує всі активні перевірки одразу.
@@ -394,15 +483,7 @@ def execute_all_active_checks():
             logging.info("No active checks found for execution")
             return 0
         
-        executed_count = 0
-        
-        for check_config in active_checks:
-            try:
-                logging.info(f"Executing check: {check_config.get('name', check_config['id'])}")
-                scheduled_check_task(check_config['id'])
-                executed_count += 1
-            except Exception as e:
-                logging.error(f"Error executing check {check_config['id']}: {e}")
+        executed_count = run_checks_batch(active_checks)
         
         logging.info(f"Executed {executed_count}/{len(active_checks)} active checks")
         return executed_count
@@ -411,6 +492,91 @@ def execute_all_active_checks():
         logging.error(f"Error during execute_all_active_checks: {e}")
         return 0
 
+def _is_recently_checked(check_config, now):
+    """True, якщо перевірка виконувалась менше ніж інтервал тому (початковий прохід її пропускає)."""
+    last_checked_at = check_config.get('last_checked_at')
+    if not last_checked_at:
+        return False
+    try:
+        last_checked = datetime.fromisoformat(last_checked_at.replace('Z', '+00:00'))
+        if last_checked.tzinfo is None:
+            last_checked = last_checked.replace(tzinfo=timezone.utc)
+        interval_seconds = int(check_config.get('interval', 5)) * 60
+        return (now - last_checked).total_seconds() < interval_seconds
+    except (ValueError, TypeError):
+        return False
+
+def _update_warm_start_state(**changes):
+    with _warm_start_lock:
+        _warm_start_state.update(changes)
+
+def _run_warm_start_sweep(max_concurrency):
+    """Тіло фонового початкового проходу."""
+    try:
+        all_checks = data_manager.load_checks()
+        now = datetime.now(timezone.utc)
+        active_checks = [c for c in all_checks if c.get("status") == "active"]
+        due_checks = [c for c in active_checks if not _is_recently_checked(c, now)]
+
+        _update_warm_start_state(
+            total=len(due_checks),
+            skipped_recent=len(active_checks) - len(due_checks)
+        )
+        logging.info(f"Warm start: {len(due_checks)} checks to run, "
+                     f"{len(active_checks) - len(due_checks)} skipped as recently checked")
+
+        def on_saved(check_id, status):
+            with _warm_start_lock:
+                _warm_start_state["completed"] += 1
+                if status in monitor_engine.ERROR_STATUSES:
+                    _warm_start_state["errors"] += 1
+
+        if due_checks:
+            run_checks_batch(due_checks, max_concurrency=max_concurrency, on_saved=on_saved)
+
+        _update_warm_start_state(status="completed", finished_at=datetime.now(timezone.utc).isoformat())
+        logging.info(f"Warm start: completed ({_warm_start_state['completed']}/{_warm_start_state['total']} checks)")
+    except Exception as e:
+        _update_warm_start_state(status="failed", error=str(e), finished_at=datetime.now(timezone.utc).isoformat())
+        logging.error(f"Warm start: sweep failed: {e}")
+
+def start_warm_start_sweep(max_concurrency=None):
+    """
+    Запускає початковий прохід по активних перевірках у фоновому потоці, щоб веб-сервер
+    відповідав одразу. Перевірки, що виконувались менше ніж інтервал тому, пропускаються.
+    Повертає False, якщо прохід уже виконується.
+    """
+    with _warm_start_lock:
+        if _warm_start_state["status"] == "running":
+            logging.info("Warm start: sweep is already running")
+            return False
+        _warm_start_state.update({
+            "status": "running",
+            "total": 0,
+            "completed": 0,
+            "errors": 0,
+            "skipped_recent": 0,
+            "error": None,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "finished_at": None
+        })
+
+    thread = threading.Thread(
+        target=_run_warm_start_sweep,
+        args=(max_concurrency or WARM_START_CONCURRENCY,),
+        name="warm-start-sweep",
+        daemon=True
+    )
+    thread.start()
+    return True
+
+def get_warm_start_status():
+    """Повертає прогрес початкового проходу (для /api/warm-start-status)."""
+    with _warm_start_lock:
+        state = dict(_warm_start_state)
+    state["progress_percent"] = round(state["completed"] / state["total"] * 100, 1) if state["total"] else (100.0 if state["status"] == "completed" else 0.0)
+    return state
+
 def get_checks_summary():
     """
     Повертає короткий звіт про стан всіх перевірок.
@@ -434,7 +600,7 @@ def get_checks_summary():
                     "id": check['id'],
                     "last_checked": check.get('last_checked_at')
                 })
-            elif check.get('last_result') == 'error':
+            elif check.get('last_result') in monitor_engine.ERROR_STATUSES:
                 summary["recent_errors"].append({
                     "name": check.get('name', 'Unnamed'),
                     "id": check['id'],
@@ -554,14 +720,13 @@ def update_next_check_times_after_wake_up():
                         new_time = next_run_local.isoformat()
                         
                         if old_time != new_time:
-                            check['next_check_at'] = new_time
+                            data_manager.update_check_state(check_id, {'next_check_at': new_time})
                             updated = True
                             logging.info(f"Updated next_check_at after wake up for {check_id}: {old_time} -> {new_time}")
                 except Exception as e:
                     logging.warning(f"Error updating next_check_at after wake up for {check_id}: {e}")
         
         if updated:
-            data_manager.save_checks(all_checks)
             logging.info("Next check times updated after wake up")
         
     except Exception as e:
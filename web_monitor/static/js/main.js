@@ -369,6 +369,8 @@ function getStatusClass(status) {
         case 'changed': return 'changed';
         case 'no_change': return 'no-change';
         case 'error': return 'error';
+        case 'oversized': return 'error';
+        case 'circuit_open': return 'error';
         default: return 'unknown';
     }
 }
@@ -378,6 +380,8 @@ function getStatusText(status) {
         case 'changed': return '🔄 Зміни';
         case 'no_change': return '✅ Без змін';
         case 'error': return '❌ Помилка';
+        case 'oversized': return '📦 Завелика відповідь';
+        case 'circuit_open': return '⛔ Хост недоступний';
         default: return '❓ Невідомо';
     }
 }